@@ -0,0 +1,284 @@
+"""
+Benchmarks the hot paths of Crayfish using synthetic frames (see
+pypix/synthetic.py):
+
+    - Frame.from_file for both the lsc and ascii_matrix formats
+    - Frame.calculate_clusters
+    - Every attribute in pypix.attribute_table
+    - FolderNode.calculate_aggregate, from the raw frames (with and without
+      filters), from memoised sub folder aggregates, and from a dataset index
+      (see dataset.py)
+    - KNN.train and KNN.classify, and classifying the folder tree in batch
+      (see batch.py)
+    - Reading and spatio-temporally clustering an event stream (see
+      pypix/events.py)
+
+Results are written as JSON, and may be compared against a previous run to
+catch regressions::
+
+    python benchmarks/benchmark.py --output new.json --compare baseline.json
+
+The exit status is 1 if any benchmark is slower than the baseline by more than
+the tolerance.
+"""
+import argparse
+import json
+import os
+import platform
+import random
+import shutil
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                "..", "crayfish"))
+
+import pypix
+from pypix import events, filters, synthetic
+import folder
+import dataset
+import algorithms
+import batch
+
+# The synthetic frames benchmarked, mapping name to synthetic_frame arguments
+SCENARIOS = {
+    "sparse": dict(alphas=5, betas=10, muons=2, noise=20, seed=1),
+    "busy": dict(occupancy=0.05, noise=200, seed=2),
+}
+
+# The synthetic event stream benchmarked, as synthetic_events arguments, and
+# the time gap it is clustered with
+EVENTS = dict(frames=100, alphas=5, betas=10, muons=3, noise=30, seed=3)
+EVENTS_TIME_GAP = 500.0
+
+# The shape of the folder tree used to benchmark aggregation: the number of
+# sub folders, and the number of frames in each folder
+AGGREGATE_FOLDERS = 3
+AGGREGATE_FRAMES = 10
+
+def bench(name, run, setup=None, items=1, repeat=3):
+    """
+    Times run, returning a dictionary of results.
+
+    Args:
+        name: The name of the benchmark
+
+        run: The function to time. It is passed the return value of setup.
+
+        setup: A function called (untimed) before each run, eg. to create
+        fresh objects so that cached results aren't timed. Defaults to
+        returning None.
+
+        items: The number of items (frames, clusters...) processed by each
+        run, used to calculate a throughput
+
+        repeat: The number of times to time run
+    """
+    times = []
+    for _ in range(repeat):
+        state = setup() if setup else None
+        start = time.time()
+        run(state)
+        times.append(time.time() - start)
+    best = min(times)
+    result = {"name": name, "best": best, "mean": sum(times)/len(times),
+              "repeat": repeat, "items": items,
+              "items_per_second": items/best if best else None}
+    sys.stderr.write("%-45s %10.4fs %12.1f items/s\n"
+                     % (name, best, result["items_per_second"] or 0))
+    return result
+
+def write_scenarios(directory):
+    """
+    Writes each scenario frame to directory in both formats.
+
+    Returns a dictionary mapping (scenario, format) to filepath.
+    """
+    paths = {}
+    for scenario, options in SCENARIOS.items():
+        frame = synthetic.synthetic_frame(**options)
+        for file_format, extension in [("lsc", ".lsc"), ("ascii_matrix", ".txt")]:
+            path = os.path.join(directory, scenario + extension)
+            synthetic.write_frame(frame, path, file_format)
+            paths[(scenario, file_format)] = path
+    return paths
+
+def write_folder_tree(directory):
+    """
+    Writes a tree of synthetic frames to directory for aggregation.
+
+    Returns the number of frames written.
+    """
+    frames = AGGREGATE_FOLDERS * AGGREGATE_FRAMES
+    synthetic.write_dataset(directory, frames, AGGREGATE_FOLDERS, seed="aggregate")
+    return frames
+
+def training_data(clusters, seed=0):
+    """
+    Returns training data lines for clusters, with each cluster assigned a
+    random class.
+    """
+    rng = random.Random(seed)
+    classes = ["Alpha", "Beta", "Gamma"]
+    frame = pypix.Frame()
+    frame.clusters = clusters
+    for cluster in clusters:
+        cluster.manual_class = rng.choice(classes)
+    header = ["UUID", "Classification"] + [attr for attr in pypix.attribute_table
+                    if issubclass(pypix.Cluster, pypix.attribute_table[attr][1]) and
+                    pypix.attribute_table[attr][3]]
+    return [",".join(header)] + frame.get_training_rows().split("\n")
+
+def run_benchmarks(directory, repeat):
+    """
+    Runs every benchmark, using directory for temporary files.
+
+    Returns a list of results, see bench.
+    """
+    results = []
+    paths = write_scenarios(directory)
+
+    def parsed(scenario):
+        return pypix.Frame.from_file(paths[(scenario, "lsc")])
+
+    def clustered(scenario):
+        frame = parsed(scenario)
+        frame.calculate_clusters()
+        return frame
+
+    for (scenario, file_format), path in sorted(paths.items()):
+        results.append(bench("from_file.%s.%s" % (file_format, scenario),
+                lambda state: pypix.Frame.from_file(path, file_format),
+                repeat=repeat))
+
+    for scenario in sorted(SCENARIOS):
+        results.append(bench("calculate_clusters.%s" % scenario,
+                lambda frame: frame.calculate_clusters(),
+                setup=lambda: parsed(scenario),
+                items=len(clustered(scenario).clusters), repeat=repeat))
+
+    for scenario in sorted(SCENARIOS):
+        for name, (function, class_, plottable, trainable, cost) in pypix.attribute_table.items():
+            if issubclass(pypix.Cluster, class_):
+                results.append(bench("attribute.%s.%s" % (name, scenario),
+                        lambda frame: [function(cluster) for cluster in frame.clusters],
+                        setup=lambda: clustered(scenario),
+                        items=len(clustered(scenario).clusters), repeat=repeat))
+            else:
+                results.append(bench("attribute.%s.%s.frame" % (name, scenario),
+                        function, setup=lambda: parsed(scenario), repeat=repeat))
+
+    tree = os.path.join(directory, "tree")
+    os.mkdir(tree)
+    frames = write_folder_tree(tree)
+    results.append(bench("calculate_aggregate",
+            lambda node: node.calculate_aggregate("*.lsc"),
+            setup=lambda: folder.FolderNode(tree), items=frames, repeat=repeat))
+
+    def children_aggregated():
+        node = folder.FolderNode(tree)
+        for sub_folder in node.get_children("*.lsc")[0]:
+            sub_folder.calculate_aggregate("*.lsc")
+        return node
+    results.append(bench("calculate_aggregate.memoised",
+            lambda node: node.calculate_aggregate("*.lsc"),
+            setup=children_aggregated, items=frames, repeat=repeat))
+    frame_filter = filters.Filter.parse("No. of hits < 300", pypix.Frame)
+    cluster_filter = filters.Filter.parse("Volume > 100", pypix.Cluster)
+    results.append(bench("calculate_aggregate.filtered",
+            lambda node: node.calculate_aggregate("*.lsc", frame_filter, cluster_filter),
+            setup=lambda: folder.FolderNode(tree), items=frames, repeat=repeat))
+
+    index = dataset.Dataset(os.path.join(directory, "index.sqlite"), tree, "*.lsc")
+    index.update()
+    results.append(bench("calculate_aggregate.dataset",
+            lambda node: node.calculate_aggregate("*.lsc"),
+            setup=lambda: folder.FolderNode(tree, index), items=frames, repeat=repeat))
+    index.close()
+
+    train_clusters = clustered("busy").clusters
+    data = training_data(train_clusters)
+    results.append(bench("KNN.train", lambda classifier: classifier.train(data),
+            setup=lambda: algorithms.KNN(None), items=len(train_clusters),
+            repeat=repeat))
+    classifier = algorithms.KNN(None)
+    classifier.train(data)
+    test_clusters = clustered("sparse").clusters
+    results.append(bench("KNN.classify",
+            lambda clusters: [classifier.classify(cluster) for cluster in clusters],
+            setup=lambda: clustered("sparse").clusters, items=len(test_clusters),
+            repeat=repeat))
+    results_path = os.path.join(directory, "classification.csv")
+    results.append(bench("batch.classify_folder",
+            lambda node: batch.classify_folder(classifier, node, "*.lsc", results_path),
+            setup=lambda: folder.FolderNode(tree), items=frames, repeat=repeat))
+
+    stream_path = os.path.join(directory, "stream.t3pa")
+    stream = synthetic.synthetic_events(**EVENTS)
+    events.write_events(stream, stream_path)
+    results.append(bench("events.read_events",
+            lambda state: list(events.read_events(stream_path)),
+            items=len(stream), repeat=repeat))
+    results.append(bench("events.stream_labels",
+            lambda chunks: list(events.stream_labels(chunks, EVENTS_TIME_GAP)),
+            setup=lambda: [stream[i:i + 10000] for i in range(0, len(stream), 10000)],
+            items=len(stream), repeat=repeat))
+    results.append(bench("events.stream_clusters",
+            lambda chunks: list(events.stream_clusters(chunks, EVENTS_TIME_GAP)),
+            setup=lambda: [stream[i:i + 10000] for i in range(0, len(stream), 10000)],
+            items=len(stream), repeat=repeat))
+    return results
+
+def compare(results, baseline, tolerance):
+    """
+    Compares results against the results of a previous run.
+
+    Returns a list of the names of the benchmarks whose best time is worse
+    than the baseline by more than the fraction tolerance.
+    """
+    baseline_best = dict((result["name"], result["best"]) for result in baseline["results"])
+    regressions = []
+    for result in results:
+        previous = baseline_best.get(result["name"])
+        if previous and result["best"] > previous * (1 + tolerance):
+            sys.stderr.write("REGRESSION %s: %.4fs -> %.4fs\n"
+                             % (result["name"], previous, result["best"]))
+            regressions.append(result["name"])
+    return regressions
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark Crayfish hot paths.")
+    parser.add_argument("--output", help="File to write JSON results to (default: stdout)")
+    parser.add_argument("--compare", help="JSON results of a previous run to compare against")
+    parser.add_argument("--tolerance", type=float, default=0.2,
+                        help="Allowed fractional slowdown before a benchmark counts "
+                             "as a regression (default: 0.2)")
+    parser.add_argument("--repeat", type=int, default=3,
+                        help="Number of times each benchmark is timed (default: 3)")
+    args = parser.parse_args()
+
+    directory = tempfile.mkdtemp(prefix="crayfish_benchmark_")
+    try:
+        results = run_benchmarks(directory, args.repeat)
+    finally:
+        shutil.rmtree(directory)
+
+    report = {"timestamp": time.time(),
+              "python": platform.python_version(),
+              "platform": platform.platform(),
+              "kernels": pypix.kernels.backend(),
+              "results": results}
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+    else:
+        json.dump(report, sys.stdout, indent=2)
+
+    if args.compare:
+        with open(args.compare) as f:
+            if compare(results, json.load(f), args.tolerance):
+                sys.exit(1)
+
+if __name__ == "__main__":
+    main()
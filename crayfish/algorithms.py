@@ -1,12 +1,22 @@
 """
 Contains the classification aglorithms that are available to the system.
+
+The algorithms may be trained and used without wxPython (eg. by batch.py on a
+server), in which case only their GUI panels are unavailable.
 """
-from collections import Counter
+import numpy
 
-import wx
-from wx.lib.dialogs import ScrolledMessageDialog
+try:
+    import wx
+    import wx.lib.dialogs
+except ImportError:
+    wx = None
 
 import pypix
+from pypix import timing
+import batch
+import folder
+import profiling
 from error_message import display_error_message
 
 # The algorithm table maps a natural algorithm name to an algorithm class
@@ -30,11 +40,28 @@ def algorithm(name):
 class MLAlgorithm(object):
     """
     A base class for machine learing algorithms
+
+    A trained algorithm may be pickled, eg. to classify frames in worker
+    processes (see batch.py). Its GUI objects, listed in gui_attributes, are
+    left out, so subclasses should keep the settings they read from the GUI
+    in plain attributes when pickled.
     """
+    gui_attributes = ["main_window"]
+
     def __init__(self, main_window):
         self.main_window = main_window
         self.is_trained = False
 
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        for name in self.gui_attributes:
+            state.pop(name, None)
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.main_window = None
+
     def get_display_panel(self, parent):
         """
         Return the display panel containing algorithm settings. In this ML base
@@ -50,14 +77,17 @@ class MLAlgorithm(object):
         info_button = wx.Button(panel, label="Info")
         train_button = wx.Button(panel, label="Train")
         classify_button = wx.Button(panel, label="Classify")
+        classify_folder_button = wx.Button(panel, label="Classify Folder")
 
         panel.Bind(wx.EVT_BUTTON, self.on_info, info_button)
         panel.Bind(wx.EVT_BUTTON, self.on_train, train_button)
         panel.Bind(wx.EVT_BUTTON, self.on_classify, classify_button)
+        panel.Bind(wx.EVT_BUTTON, self.on_classify_folder, classify_folder_button)
 
         v_sizer.Add(info_button, 0, wx.TOP | wx.ALIGN_CENTRE, 5)
         v_sizer.Add(train_button, 0, wx.TOP | wx.ALIGN_CENTRE, 5)
         v_sizer.Add(classify_button, 0, wx.TOP | wx.ALIGN_CENTRE, 5)
+        v_sizer.Add(classify_folder_button, 0, wx.TOP | wx.ALIGN_CENTRE, 5)
         return panel, v_sizer
 
     def on_train(self, evt):
@@ -82,6 +112,7 @@ class MLAlgorithm(object):
                             + ", ".join(missing_items) + ".\nThis may prevent certain algorithms from functioning correctly or at all.")
             self.train(data)
 
+    @profiling.log_event("on_classify")
     def on_classify(self, evt):
         """
         Checks to see if the algorithm has been trained and that there is a
@@ -94,7 +125,50 @@ class MLAlgorithm(object):
         if not self.main_window.frame:
             display_error_message("Classification","Please select a frame or aggregate a subfolder to classify")
             return
-        for cluster in self.main_window.frame.clusters:
+        self.classify_all(self.main_window.frame.clusters)
+
+    @profiling.log_event("on_classify_folder")
+    def on_classify_folder(self, evt):
+        """
+        Classifies every frame below the folder selected in the frame
+        browser, without aggregating it, and writes the class of each cluster
+        and the number of clusters in each class to a results file chosen by
+        the user (see batch.py).
+        """
+        if not self.is_trained:
+            display_error_message("Classification","Algorithm not yet trained. Please select a training file by clicking train.")
+            return
+        file_tree = self.main_window.file_select_panel.file_tree
+        selection = file_tree.GetSelection()
+        file_node = file_tree.GetPyData(selection) if selection.IsOk() else None
+        if not isinstance(file_node, folder.FolderNode):
+            display_error_message("Classification", "Please select a folder to classify")
+            return
+        dialog = wx.FileDialog(None, message="Save classification results",
+                               wildcard="CSV files (*.csv)|*.csv",
+                               style=wx.FD_SAVE | wx.FD_OVERWRITE_PROMPT)
+        if dialog.ShowModal() != wx.ID_OK:
+            return
+        progress_dialog = wx.ProgressDialog("Classify Folder", "Classifying frames...",
+                                            parent=self.main_window)
+        def progress(done, total):
+            progress_dialog.Update(100 * done // total, "Classified %d/%d frames" % (done, total))
+        try:
+            summary = batch.classify_folder(self, file_node, file_tree.extension,
+                                            dialog.GetPath(), progress=progress)
+        finally:
+            progress_dialog.Destroy()
+        if summary["errors"]:
+            display_error_message("Classification", "%d frames couldn't be read, see %s"
+                    % (len(summary["errors"]), batch.summary_path(dialog.GetPath())))
+
+    def classify_all(self, clusters):
+        """
+        Classifies each of clusters, setting their algorithm_class. Sub
+        classes may override this to classify many clusters at once more
+        quickly than with classify.
+        """
+        for cluster in clusters:
             self.classify(cluster)
 
     def on_info(self, evt):
@@ -120,10 +194,34 @@ class KNN(MLAlgorithm):
 
         Checkboxes -- Checked attributes will be include in calculations
     """
+    gui_attributes = MLAlgorithm.gui_attributes + ["k_input", "dim_selector"]
+
+    # The number of clusters whose distances to the training data are
+    # calculated at once by classify_all
+    CHUNK_SIZE = 256
+
     def __init__(self, main_window):
         super(KNN, self).__init__(main_window)
         self.training_data = []
+        self.attributes = []
         self.functions = []
+        # Used for k and the included dimensions when the algorithm is run
+        # without the GUI settings panel. None includes every dimension.
+        self._k = 5
+        self._dimensions = None
+
+    def __getstate__(self):
+        state = super(KNN, self).__getstate__()
+        # Keep the settings chosen in the GUI, and look the attribute
+        # functions up again by name when unpickled
+        state["_k"] = self.k
+        state["_dimensions"] = self.selected_dimensions()
+        del state["functions"]
+        return state
+
+    def __setstate__(self, state):
+        super(KNN, self).__setstate__(state)
+        self.functions = [pypix.attribute_table[attr][0] for attr in self.attributes]
 
     def get_display_panel(self, parent):
         """
@@ -156,8 +254,29 @@ class KNN(MLAlgorithm):
         the algorithm can access it using self.k whether it calls this function
         or it is explicitly defined.
         """
-        return self.k_input.GetValue()
+        if hasattr(self, "k_input"):
+            return self.k_input.GetValue()
+        return self._k
 
+    @k.setter
+    def k(self, value):
+        self._k = value
+
+    def selected_dimensions(self):
+        """
+        Returns the indices of the attributes in self.functions that are to be
+        included in calculations. These are the items selected in the
+        settings panel, or every attribute if the algorithm is being run
+        without the GUI.
+        """
+        if hasattr(self, "dim_selector"):
+            return [i for i in range(len(self.functions))
+                    if self.dim_selector.IsSelected(i)]
+        if self._dimensions is not None:
+            return list(self._dimensions)
+        return range(len(self.functions))
+
+    @timing.timed("KNN.train")
     def train(self, data):
         """
         Trains the algorithm using data, which should be a list of CSV records,
@@ -170,28 +289,32 @@ class KNN(MLAlgorithm):
         cluster type which is of course used in the training process.
         """
         self.training_data = []
-        self.dim_selector.Clear()
         # Load attributes from header row, ignoring first two entries (see
         # docsttring)
         attributes = data[0].strip().split(",")[2:]
-        # Set dimensions GUI checkbox items
-        self.dim_selector.Set(attributes)
+        # Set dimensions GUI checkbox items, if dim_selector is defined
+        if hasattr(self, "dim_selector"):
+            self.dim_selector.Clear()
+            self.dim_selector.Set(attributes)
         # Load calculation functions from attribute_table
+        self.attributes = attributes
         self.functions = [pypix.attribute_table[attr][0] for attr in attributes]
         # [1:] To ignore header row and UUID column
         rows = [row.strip().split(",")[1:] for row in data[1:]]
         # Add data to training_data list, whose elements
-        # have format [class, (properties)]
+        # have format [class code, (properties)]
         for row in rows:
             # Head of list `[0]` - is the classification,
             # the tail `[1:]` contains the properties
-            self.training_data.append((row[0], tuple([float(i) for i in row[1:]])))
+            self.training_data.append((pypix.class_registry.code(row[0]),
+                                       tuple([float(i) for i in row[1:]])))
         # Set appropialte limits for k_input selector, if k_input is defined
         # (ie. alogorithm is being run in the GUI)
         if hasattr(self, "k_input"):
             self.k_input.SetRange(1,len(self.training_data))
         self.is_trained = True
 
+    @timing.timed("KNN.classify")
     def classify(self, cluster):
         """
         Classifies cluster
@@ -199,22 +322,33 @@ class KNN(MLAlgorithm):
         The algorithm_class attribute of cluster is set to the result of the
         classification process.
         """
-        square_distances = []
-        for training_datum in self.training_data:
-            # Sum the squared differences between the training cluster and cluster
-            # to be classified for each dimension if the dimension has been
-            # specified.
-            square_distance = sum([( value - self.functions[i](cluster) )**2
-                                    for i, value in enumerate(training_datum[1])
-                                        if self.dim_selector.IsSelected(i)])
-            square_distances.append((training_datum[0], square_distance))
-        # Find closest k points
-        square_distances.sort(key=lambda x: x[1])
-        nearest_k = square_distances[0:self.k]
-        # Extract types of nearest k items
-        nearest_k_types = [item[0] for item in nearest_k]
-        # Counter.most_common returns a list of (item, frequency)
-        # Ask for the most common, take the 0th one (there may be more than one
-        # with the same frequency) and then take the 0th item of this tuple,
-        # which is the modal class of the nearest k training points.
-        cluster.algorithm_class = Counter(nearest_k_types).most_common(1)[0][0]
+        self.classify_all([cluster])
+
+    def classify_all(self, clusters):
+        """
+        Classifies each of clusters, as classify.
+
+        The attributes of each cluster are calculated once, and the distances
+        to every training point are calculated for chunks of clusters at a
+        time (see pypix.kernels.square_distances).
+        """
+        dimensions = self.selected_dimensions()
+        if not clusters or not self.training_data:
+            return
+        codes = numpy.array([datum[0] for datum in self.training_data])
+        training_points = numpy.array([datum[1] for datum in self.training_data], dtype=float)
+        # Only the selected dimensions of the training points are compared
+        training_points = training_points.reshape(len(codes), -1)[:, list(dimensions)]
+        for start in range(0, len(clusters), self.CHUNK_SIZE):
+            chunk = clusters[start:start + self.CHUNK_SIZE]
+            features = numpy.array([[self.functions[i](cluster) for i in dimensions]
+                                    for cluster in chunk], dtype=float).reshape(len(chunk), -1)
+            square_distances = pypix.kernels.square_distances(features, training_points)
+            # Find closest k points. A stable sort keeps the training order
+            # of equally distant points.
+            nearest_k = numpy.argsort(square_distances, axis=1, kind="mergesort")[:, :self.k]
+            for cluster, nearest in zip(chunk, nearest_k):
+                # The modal class of the nearest k training points is the code
+                # with the highest count (the lowest code, if more than one has
+                # the same count).
+                cluster.algorithm_class_code = int(numpy.bincount(codes[nearest]).argmax())
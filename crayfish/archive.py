@@ -0,0 +1,273 @@
+"""
+Reads frames straight from zip and tar archives (plain, or compressed with
+gzip, bzip2 or xz), so that archived runs can be browsed and aggregated
+without extracting them first.
+
+An archive appears in the file tree as a folder (see folder.FolderNode), whose
+contents are listed from the archive by an ArchiveIndex in the same form as
+the folder listings of scan.DirectoryIndex. The members of an archive are
+listed once when it is first opened (from the central directory of a zip
+file, or the member headers of a tar file), and the archive is kept open so
+that single frames can be read for browsing by seeking straight to their data.
+Seeking within a compressed tar file means decompressing up to the member, so
+frames are quickest to browse in the order they were archived.
+
+Aggregation instead reads every frame below a folder of the archive in a
+single sequential pass over it (see ArchiveIndex.frames), tar files as a
+stream, and the member data is parsed directly from memory (see
+pypix.Frame.from_lines), so nothing is written to disk.
+
+xz compressed tar files need the lzma module, which on Python 2 is provided
+by the backports.lzma package.
+"""
+import fnmatch
+import os
+import posixpath
+import tarfile
+import threading
+import time
+import zipfile
+from collections import OrderedDict
+
+try:
+    import lzma
+except ImportError:
+    try:
+        from backports import lzma
+    except ImportError:
+        lzma = None
+
+import pypix
+from pypix import timing
+
+# The file name patterns of archives, which are shown as folders
+ARCHIVE_PATTERNS = ["*.zip", "*.tar", "*.tar.gz", "*.tgz", "*.tar.bz2", "*.tbz2", "*.tar.xz",
+                    "*.txz"]
+
+# The number of archives kept open, see Archive.open
+MAX_OPEN_ARCHIVES = 16
+
+# The magic number at the start of xz files
+_XZ_MAGIC = b"\xfd7zXZ\x00"
+
+# Archives open by Archive.open, keyed by path, least recently used first
+_open_archives = OrderedDict()
+_open_archives_lock = threading.Lock()
+
+def is_archive(name):
+    """
+    Returns True if the file name is that of an archive.
+    """
+    name = name.lower()
+    return any(fnmatch.fnmatch(name, pattern) for pattern in ARCHIVE_PATTERNS)
+
+def _open_tar(path, stream=False):
+    """
+    Opens the tar file at path, for random access or, if stream is True, as
+    a stream to be read in one pass.
+    """
+    with open(path, "rb") as f:
+        xz = f.read(len(_XZ_MAGIC)) == _XZ_MAGIC
+    if xz and "xz" not in tarfile.TarFile.OPEN_METH:
+        if lzma is None:
+            raise IOError("Reading xz compressed archives needs the lzma module "
+                          "(install backports.lzma on Python 2): %s" % path)
+        return tarfile.open(fileobj=lzma.LZMAFile(path), mode="r|" if stream else "r")
+    return tarfile.open(path, "r|*" if stream else "r:*")
+
+def _member_path(name):
+    """
+    Returns the normalised path of a member of an archive, or None if it is
+    outside of the archive.
+    """
+    path = posixpath.normpath(name.replace("\\", "/")).lstrip("/")
+    if path == "." or path.startswith("../"):
+        return None
+    return path
+
+class Archive(object):
+    """
+    The listing of a zip or tar archive, which is kept open to read its
+    members (and reopened if it has been closed). Archives should be opened
+    with Archive.open, which shares them.
+
+    Args:
+        path: The path of the archive
+    """
+    def __init__(self, path):
+        self.path = os.path.abspath(path)
+        stat = os.stat(self.path)
+        self.size, self.mtime = stat.st_size, stat.st_mtime
+        # Serialises reads, as zip and tar files read through one file object
+        self._lock = threading.Lock()
+        self.is_zip = zipfile.is_zipfile(self.path)
+        # The open ZipFile or TarFile, see _open
+        self._file = None
+        # Maps the path of each file in the archive to (size, mtime, info),
+        # where info is its ZipInfo or TarInfo
+        self.members = OrderedDict()
+        if self.is_zip:
+            for info in self._open().infolist():
+                member_path = _member_path(info.filename)
+                if member_path and not info.filename.endswith("/"):
+                    mtime = time.mktime(info.date_time + (0, 0, -1))
+                    self.members[member_path] = (info.file_size, mtime, info)
+        else:
+            for info in self._open().getmembers():
+                member_path = _member_path(info.name)
+                if member_path and info.isfile():
+                    self.members[member_path] = (info.size, info.mtime, info)
+        # Maps the path of each folder in the archive ("" for the root) to a
+        # tuple of the set of its sub folders' names and a list of (name,
+        # size, mtime) of its files
+        self.folders = {"": (set(), [])}
+        for member_path, (size, mtime, info) in self.members.items():
+            folder_path, name = posixpath.split(member_path)
+            self._add_folder(folder_path)[1].append([name, size, mtime])
+        timing.count("archives listed")
+
+    @classmethod
+    def open(cls, path):
+        """
+        Returns the Archive of the file at path, reusing the one already open
+        unless the file has changed. At most MAX_OPEN_ARCHIVES are kept open.
+        """
+        path = os.path.abspath(path)
+        stat = os.stat(path)
+        with _open_archives_lock:
+            archive = _open_archives.pop(path, None)
+            if archive is None or (archive.size, archive.mtime) != (stat.st_size, stat.st_mtime):
+                archive = cls(path)
+            _open_archives[path] = archive
+            while len(_open_archives) > MAX_OPEN_ARCHIVES:
+                _open_archives.popitem(last=False)[1].close()
+        return archive
+
+    def _open(self):
+        """
+        Returns the open ZipFile or TarFile of the archive, opening it if it
+        isn't open.
+        """
+        if self._file is None:
+            self._file = zipfile.ZipFile(self.path) if self.is_zip else _open_tar(self.path)
+        return self._file
+
+    def _add_folder(self, folder_path):
+        """
+        Returns the listing of the folder at folder_path, adding it (and its
+        parent folders) if it isn't in the archive's folders yet.
+        """
+        listing = self.folders.get(folder_path)
+        if listing is None:
+            listing = self.folders[folder_path] = (set(), [])
+            parent, name = posixpath.split(folder_path)
+            self._add_folder(parent)[0].add(name)
+        return listing
+
+    def read(self, member_path):
+        """
+        Returns the data of the member at member_path.
+        """
+        info = self.members[member_path][2]
+        with self._lock:
+            if self.is_zip:
+                return self._open().read(info)
+            return self._open().extractfile(info).read()
+
+    def stream(self, member_paths):
+        """
+        Yields a tuple (member path, data) for each member whose path is in
+        the set member_paths, in the order they are stored, reading the
+        archive in a single pass.
+        """
+        if self.is_zip:
+            infos = sorted((self.members[member_path][2] for member_path in member_paths),
+                           key=lambda info: info.header_offset)
+            for info in infos:
+                with self._lock:
+                    data = self._open().read(info)
+                yield _member_path(info.filename), data
+            return
+        # A separate file object, so that browsing isn't disturbed
+        stream = _open_tar(self.path, stream=True)
+        try:
+            for info in stream:
+                member_path = _member_path(info.name)
+                if member_path in member_paths and info.isfile():
+                    yield member_path, stream.extractfile(info).read()
+        finally:
+            stream.close()
+
+    def close(self):
+        """
+        Closes the archive file, which is reopened if it is read again.
+        """
+        with self._lock:
+            if self._file is not None:
+                self._file.close()
+                self._file = None
+
+class ArchiveIndex(object):
+    """
+    An index of the frame files in an archive that match extension_pattern,
+    which may be used as the index of a folder.FolderNode in place of a
+    scan.DirectoryIndex. The archive is presented as a folder at its own path,
+    so that the path of the frame "run/frame.lsc" in "/data/runs.tar.gz" is
+    "/data/runs.tar.gz/run/frame.lsc".
+
+    Args:
+        path: The path of the archive
+
+        extension_pattern: The file name pattern of frame files
+    """
+    def __init__(self, path, extension_pattern):
+        self.root = os.path.abspath(path)
+        self.extension_pattern = extension_pattern
+
+    @property
+    def archive(self):
+        """
+        The Archive, which is only opened (and listed) when it is first
+        needed, and reopened if the file has changed.
+        """
+        return Archive.open(self.root)
+
+    def member_path(self, path):
+        """
+        Returns the path within the archive of the file or folder at path.
+        """
+        relative = os.path.relpath(os.path.abspath(path), self.root)
+        return "" if relative == os.curdir else relative.replace(os.sep, "/")
+
+    def folder(self, path):
+        """
+        Returns the listing of the folder at path in the archive, in the form
+        returned by scan.list_folder.
+        """
+        folders, files = self.archive.folders.get(self.member_path(path), ((), ()))
+        return {"mtime": self.archive.mtime, "folders": sorted(folders),
+                "files": sorted(entry for entry in files
+                                if fnmatch.fnmatch(entry[0], self.extension_pattern))}
+
+    def read_frame(self, path, file_format):
+        """
+        Returns the pypix.Frame of the frame file at path in the archive.
+        """
+        data = self.archive.read(self.member_path(path))
+        timing.count("archive frames read")
+        return pypix.Frame.from_lines(data.splitlines(), file_format, name=path)
+
+    def frames(self, path, file_format):
+        """
+        Yields the pypix.Frame of every frame file in the folder at path in
+        the archive and its sub folders, read in a single pass over the
+        archive (in the order the frames are stored).
+        """
+        prefix = self.member_path(path)
+        archive = self.archive
+        member_paths = set(member_path for member_path in archive.members
+                           if (not prefix or member_path.startswith(prefix + "/")) and
+                           fnmatch.fnmatch(posixpath.basename(member_path), self.extension_pattern))
+        for member_path, data in archive.stream(member_paths):
+            frame_path = os.path.join(self.root, *member_path.split("/"))
+            yield pypix.Frame.from_lines(data.splitlines(), file_format, name=frame_path)
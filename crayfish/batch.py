@@ -0,0 +1,234 @@
+"""
+Classifies every frame of a folder tree (or a list of frame files) with a
+trained classification algorithm, without building an aggregate or loading
+the frames into the GUI, so that whole exposure campaigns can be classified
+unattended.
+
+Frames are read, clustered and classified in chunks, in parallel worker
+processes if requested, and the results are streamed to two files:
+
+    <results>: A CSV file with a row per cluster holding the path of its
+    frame, its index in the frame, its UUID and the class assigned to it
+
+    <results>.summary.json: The number of frames and clusters classified, the
+    number of clusters in each class and the frames that couldn't be read
+
+Folders can be classified from the algorithm panel of the GUI (Classify
+Folder), or from the command line::
+
+    python crayfish/batch.py training.csv /path/to/frames --pattern "*.lsc" --processes 4
+"""
+import argparse
+import csv
+import fnmatch
+import json
+import os
+import sys
+from multiprocessing import Pool
+
+import numpy
+
+import pypix
+from pypix import timing
+import folder
+import profiling
+
+# The number of frames classified by each job given to a worker process
+CHUNK_SIZE = 64
+
+# The classifier used by _classify_chunk, set in each worker process by
+# _set_classifier
+_classifier = None
+
+def summary_path(results_path):
+    """
+    Returns the path of the summary file written alongside results_path.
+    """
+    return results_path + ".summary.json"
+
+def frame_paths(folder_node, extension_pattern):
+    """
+    Returns the paths of the frames matching extension_pattern in the folder
+    of folder_node and all of its sub folders, in the order they are listed
+    in the file tree.
+    """
+    index = folder_node._get_index(extension_pattern)
+    paths = []
+    pending = [folder_node.path]
+    while pending:
+        path = pending.pop()
+        listing = index.folder(path)
+        paths.extend(os.path.join(path, name) for name, size, mtime in listing["files"]
+                     if fnmatch.fnmatch(name, extension_pattern))
+        pending.extend(os.path.join(path, name) for name in reversed(listing["folders"]))
+    return paths
+
+def _set_classifier(classifier, mask_pixels=None, calibration_path=None):
+    """
+    Sets the classifier used by _classify_chunk, and in worker processes
+    loads the pixel mask and energy calibration of the parent process.
+    """
+    global _classifier
+    _classifier = classifier
+    if mask_pixels is not None:
+        pypix.pixel_mask.set_pixels(mask_pixels)
+    if calibration_path is not None:
+        pypix.energy_calibration.load(calibration_path)
+
+def _classify_chunk(job):
+    """
+    Reads, clusters and classifies a chunk of frames with the classifier set
+    by _set_classifier. Called in worker processes by classify_frames, so it
+    must be picklable.
+
+    Args:
+        job: A tuple (filepaths, file_format)
+
+    Returns a tuple (rows, errors), where rows is a list of (filepath, cluster
+    index, UUID, class code) for each cluster and errors is a list of
+    (filepath, message) for each frame that couldn't be read.
+    """
+    filepaths, file_format = job
+    rows = []
+    errors = []
+    for filepath in filepaths:
+        try:
+            frame = pypix.Frame.from_file(filepath, file_format)
+        except Exception as error:
+            errors.append((filepath, str(error)))
+            continue
+        frame.calculate_clusters()
+        _classifier.classify_all(frame.clusters)
+        rows.extend((filepath, i, cluster.UUID, cluster.algorithm_class_code)
+                    for i, cluster in enumerate(frame.clusters))
+    return rows, errors
+
+@timing.timed("batch.classify_frames")
+def classify_frames(classifier, filepaths, results_path, file_format="lsc", processes=1,
+                    chunk_size=CHUNK_SIZE, progress=None):
+    """
+    Classifies the clusters of each frame file in filepaths with classifier,
+    writing the class of each cluster to results_path and a summary to
+    summary_path(results_path).
+
+    Args:
+        classifier: A trained algorithms.MLAlgorithm
+
+        filepaths: The paths of the frame files
+
+        results_path: The path of the CSV results file
+
+        file_format: The format of the frame files (see pypix.Frame.from_file)
+
+        processes: The number of processes used to classify frames
+
+        chunk_size: The number of frames classified by each job
+
+        progress: A function called as progress(done, total) after each chunk
+        of frames is classified
+
+    Returns the summary, a dictionary of the number of "frames" and "clusters"
+    classified, the number of clusters of each class ("classes") and a list of
+    [filepath, message] of the frames that couldn't be read ("errors").
+    """
+    jobs = [(filepaths[start:start + chunk_size], file_format)
+            for start in range(0, len(filepaths), chunk_size)]
+    class_counts = numpy.zeros(len(pypix.class_registry.names), dtype=int)
+    errors = []
+    done = 0
+    pool = None
+    if processes > 1 and len(jobs) > 1:
+        pool = Pool(processes, _set_classifier, (classifier, pypix.pixel_mask.pixels,
+                                                 pypix.energy_calibration.path))
+    else:
+        _set_classifier(classifier)
+    try:
+        results = pool.imap(_classify_chunk, jobs) if pool else (_classify_chunk(job) for job in jobs)
+        with open(results_path, "wb") as results_file:
+            writer = csv.writer(results_file)
+            writer.writerow(["Path", "Cluster", "UUID", "Class"])
+            for (chunk, chunk_format), (rows, chunk_errors) in zip(jobs, results):
+                codes = numpy.array([code for path, i, uuid, code in rows], dtype=int)
+                class_counts += numpy.bincount(codes, minlength=len(class_counts))[:len(class_counts)]
+                writer.writerows((path, i, uuid, pypix.class_registry.name(code))
+                                 for path, i, uuid, code in rows)
+                errors.extend(list(error) for error in chunk_errors)
+                done += len(chunk)
+                if progress:
+                    progress(done, len(filepaths))
+    finally:
+        if pool:
+            pool.close()
+            pool.join()
+    summary = {"frames": len(filepaths) - len(errors),
+               "clusters": int(class_counts.sum()),
+               "classes": dict(zip(pypix.class_registry.names, class_counts.tolist())),
+               "errors": errors}
+    with open(summary_path(results_path), "w") as summary_file:
+        json.dump(summary, summary_file, indent=4, sort_keys=True)
+    timing.count("frames classified", summary["frames"])
+    return summary
+
+def classify_folder(classifier, folder_node, extension_pattern, results_path, **options):
+    """
+    Classifies every frame matching extension_pattern in the folder of
+    folder_node (a folder.FolderNode) and its sub folders, as
+    classify_frames, which is passed any further keyword arguments.
+    """
+    return classify_frames(classifier, frame_paths(folder_node, extension_pattern), results_path,
+                           folder.ext_pattern_to_filetype(extension_pattern), **options)
+
+def main():
+    # Imported here as algorithms imports batch for the GUI
+    import algorithms
+    parser = argparse.ArgumentParser(description="Classify every frame of a directory tree.")
+    parser.add_argument("training_file", help="The training file the algorithm is trained with")
+    parser.add_argument("root", help="The directory tree of frames to classify")
+    parser.add_argument("--pattern", default="*.lsc",
+                        help="The extension pattern of frame files (default: *.lsc)")
+    parser.add_argument("--algorithm", default="K Nearest Neighbours",
+                        choices=sorted(algorithms.algorithm_table),
+                        help="The classification algorithm (default: K Nearest Neighbours)")
+    parser.add_argument("--k", type=int, help="The value of k of the K Nearest Neighbours algorithm")
+    parser.add_argument("--output", default="classification.csv",
+                        help="The results file (default: classification.csv)")
+    parser.add_argument("--processes", type=int, default=1,
+                        help="Number of processes used to classify frames (default: 1)")
+    parser.add_argument("--mask", metavar="FILE", help="A pixel mask file to apply to the frames")
+    parser.add_argument("--calibration", metavar="DIRECTORY",
+                        help="An energy calibration to apply to the frames")
+    parser.add_argument("--profile", metavar="FILE",
+                        help="Profile the run, writing the profile to FILE and the timings "
+                             "to FILE.events.json (worker processes aren't profiled)")
+    parser.add_argument("--profiler", choices=profiling.PROFILERS, default="cprofile",
+                        help="The profiler used by --profile (default: cprofile)")
+    args = parser.parse_args()
+    if args.mask:
+        pypix.pixel_mask.load(args.mask)
+    if args.calibration:
+        pypix.energy_calibration.load(args.calibration)
+    classifier = algorithms.algorithm_table[args.algorithm](None)
+    if args.k is not None:
+        classifier.k = args.k
+    with open(args.training_file) as training_file:
+        classifier.train(training_file.readlines())
+    def progress(done, total):
+        sys.stderr.write("\rClassified %d/%d frames" % (done, total))
+    if args.profile:
+        profiling.start_profiling(args.profile, args.profiler)
+    try:
+        summary = classify_folder(classifier, folder.FolderNode(args.root), args.pattern,
+                                  args.output, processes=args.processes, progress=progress)
+    finally:
+        # Write the profile even if the run fails
+        if args.profile:
+            profiling.stop_profiling()
+    if summary["frames"] or summary["errors"]:
+        sys.stderr.write("\n")
+    for name, count in sorted(summary["classes"].items()):
+        sys.stderr.write("%s: %d\n" % (name, count))
+    for filepath, message in summary["errors"]:
+        sys.stderr.write("Couldn't read %s: %s\n" % (filepath, message))
+
+if __name__ == "__main__":
+    main()
@@ -9,9 +9,13 @@ Any method with argument `evt` is called by wx in response to a UI event.
 Likewise any method with argument `event` signifies an event that is called by
 matplotlib.
 """
+import argparse
 import os
+import Queue
+import threading
 
 import wx
+from wx.lib.dialogs import ScrolledMessageDialog
 import matplotlib
 matplotlib.use("WXAgg")
 import matplotlib.pyplot as plt
@@ -19,11 +23,23 @@ from matplotlib.backends.backend_wxagg import FigureCanvasWxAgg as FigureCanvas
 
 import folder
 import pypix
+from pypix import filters, statistics, timing
 import algorithms
+import plotting
+import prefetch
+import profiling
+import scan
+import dataset
 from error_message import display_error_message
 
-# Classes dictionary, for mapping class type to graph plot style
-CLASSES = {"Unclassified": ("k"), "Alpha": ("r"), "Beta": ("y"), "Gamma": ("b")}
+# Config file defining the cluster classes and their graph plot colours, see
+# pypix/classes.py for its format. The default classes are used if it doesn't
+# exist.
+CLASSES_CONFIG = os.path.join(os.path.expanduser("~"), ".crayfish", "classes.json")
+
+# Attributes of cost COST_LINEAR are calculated in the background for objects
+# with more hits than this (see AttributeTable)
+BACKGROUND_HITS = 5000
 
 class MainWindow(wx.Frame):
     """
@@ -34,8 +50,11 @@ class MainWindow(wx.Frame):
 
     Args:
         title: The title of the main window
+
+        prefetch_frames: The number of frames prefetched while stepping
+        through a folder, see prefetch.py
     """
-    def __init__(self, title):
+    def __init__(self, title, prefetch_frames=prefetch.LOOKAHEAD):
         super(MainWindow, self).__init__(None, title=title, size=(900, 600))
         self._init_menu_bar()
         self._init_window()
@@ -43,6 +62,12 @@ class MainWindow(wx.Frame):
         self.aggregate = False
         self.frame = None
         self.cluster = None
+        # The scan.DirectoryIndex of the open folder
+        self.index = None
+        # Reads the frames the user is likely to select next
+        self.prefetcher = prefetch.Prefetcher(prefetch_frames)
+
+        self.Bind(wx.EVT_CLOSE, self.on_close)
 
         self.Show()
 
@@ -55,11 +80,37 @@ class MainWindow(wx.Frame):
 
         menu_quit = file_menu.Append(wx.ID_EXIT)
         menu_open = file_menu.Append(wx.ID_OPEN)
+        menu_build_index = file_menu.Append(wx.ID_ANY, "&Build Index")
+        menu_build_mask = file_menu.Append(wx.ID_ANY, "Build Pixel &Mask...")
+        menu_load_mask = file_menu.Append(wx.ID_ANY, "&Load Pixel Mask...")
+        menu_clear_mask = file_menu.Append(wx.ID_ANY, "&Clear Pixel Mask")
+        menu_load_calibration = file_menu.Append(wx.ID_ANY, "Load &Energy Calibration...")
+        menu_clear_calibration = file_menu.Append(wx.ID_ANY, "Clear Energy Calib&ration")
 
         self.Bind(wx.EVT_MENU, self.on_quit, menu_quit)
         self.Bind(wx.EVT_MENU, self.on_open, menu_open)
+        self.Bind(wx.EVT_MENU, self.on_build_index, menu_build_index)
+        self.Bind(wx.EVT_MENU, self.on_build_mask, menu_build_mask)
+        self.Bind(wx.EVT_MENU, self.on_load_mask, menu_load_mask)
+        self.Bind(wx.EVT_MENU, self.on_clear_mask, menu_clear_mask)
+        self.Bind(wx.EVT_MENU, self.on_load_calibration, menu_load_calibration)
+        self.Bind(wx.EVT_MENU, self.on_clear_calibration, menu_clear_calibration)
 
         menu_bar.Append(file_menu, "&File")
+
+        timing_menu = wx.Menu()
+        self.menu_record_timings = timing_menu.AppendCheckItem(wx.ID_ANY, "&Record Timings")
+        self.menu_record_timings.Check(timing.is_enabled())
+        menu_timing_report = timing_menu.Append(wx.ID_ANY, "Timing Re&port...")
+        menu_export_timings = timing_menu.Append(wx.ID_ANY, "&Export Timings...")
+        menu_reset_timings = timing_menu.Append(wx.ID_ANY, "Re&set Timings")
+
+        self.Bind(wx.EVT_MENU, self.on_record_timings, self.menu_record_timings)
+        self.Bind(wx.EVT_MENU, self.on_timing_report, menu_timing_report)
+        self.Bind(wx.EVT_MENU, self.on_export_timings, menu_export_timings)
+        self.Bind(wx.EVT_MENU, self.on_reset_timings, menu_reset_timings)
+
+        menu_bar.Append(timing_menu, "&Timing")
         self.SetMenuBar(menu_bar)
 
     def _init_window(self):
@@ -106,6 +157,54 @@ class MainWindow(wx.Frame):
 
         self.Close()
 
+    def on_close(self, evt):
+        """
+        Saves the manifest of the open folder and stops prefetching before the
+        window closes.
+        """
+        self.save_index()
+        self.prefetcher.stop()
+        evt.Skip()
+
+    def save_index(self):
+        """
+        Saves the directory index of the open folder as a manifest (see
+        scan.py), so that it needn't be walked again when it is reopened.
+        Dataset indexes (see dataset.py) are saved as they are built.
+        """
+        if isinstance(self.index, scan.DirectoryIndex):
+            try:
+                self.index.save()
+            except (IOError, OSError) as e:
+                display_error_message("Saving Manifest", "Couldn't save the folder manifest: %s" % e)
+
+    def on_record_timings(self, evt):
+        """
+        Starts or stops recording timings of the hot paths, see pypix/timing.py
+        """
+        timing.enable(self.menu_record_timings.IsChecked())
+
+    def on_timing_report(self, evt):
+        """
+        Displays the timings recorded so far.
+        """
+        ScrolledMessageDialog(self, timing.format_report(), "Timing Report").Show()
+
+    def on_export_timings(self, evt):
+        """
+        Saves the timings recorded so far to a JSON file.
+        """
+        dialog = wx.FileDialog(self, message="Select save location",
+                style=wx.FD_SAVE, defaultFile="timings.json")
+        if dialog.ShowModal() == wx.ID_OK:
+            timing.write_json(dialog.GetPath())
+
+    def on_reset_timings(self, evt):
+        """
+        Discards the timings recorded so far.
+        """
+        timing.reset()
+
     def on_open(self, evt):
         """
         Open a top level folder.
@@ -113,12 +212,108 @@ class MainWindow(wx.Frame):
         Displays a dialog allowing the user to select a top level directory.
         The directory is then opened in the frame browser column, displaying
         frames with the extension specified in the extensions text field.
+
+        If a dataset index of the directory has been built (see dataset.py)
+        the file tree is read from it, otherwise the directory is scanned.
         """
         dialog =  wx.DirDialog(self, message="Select folder to open")
         if dialog.ShowModal() == wx.ID_OK:
-            self.file_select_panel.file_tree.set_top_node(folder.FolderNode(dialog.GetPath()))
-            self.file_select_panel.file_tree.extension = self.file_select_panel.ext_field.GetValue()
+            extension = self.file_select_panel.ext_field.GetValue()
+            index = dataset.Dataset.find(dialog.GetPath(), extension)
+            if index is None:
+                index = scan.DirectoryIndex.open(dialog.GetPath(), extension)
+            self.open_folder(dialog.GetPath(), extension, index)
+
+    def open_folder(self, path, extension, index):
+        """
+        Opens the folder at path in the frame browser, listing it from index.
+        """
+        self.save_index()
+        self.prefetcher.clear()
+        self.index = index
+        self.file_select_panel.file_tree.set_top_node(folder.FolderNode(path, index))
+        self.file_select_panel.file_tree.extension = extension
 
+    def on_build_index(self, evt):
+        """
+        Builds (or brings up to date) the dataset index of the open folder,
+        see dataset.py, and reopens the folder from it so that the file tree,
+        aggregation and plotting use the index rather than the raw frames.
+        """
+        file_tree = self.file_select_panel.file_tree
+        if not hasattr(file_tree, "top_node"):
+            display_error_message("Build Index", "Open a folder before building its index.")
+            return
+        path = file_tree.top_node.path
+        extension = file_tree.extension
+        index = dataset.Dataset(dataset.Dataset.default_path(path, extension), path, extension)
+        progress_dialog = wx.ProgressDialog("Build Index", "Indexing frames...", parent=self)
+        def progress(done, total):
+            progress_dialog.Update(100 * done // total, "Indexed %d/%d frames" % (done, total))
+        try:
+            index.update(progress=progress)
+        finally:
+            progress_dialog.Destroy()
+        self.open_folder(path, extension, index)
+
+    @profiling.log_event("on_build_mask")
+    def on_build_mask(self, evt):
+        """
+        Finds the hot pixels of the frames in the selected folder (see
+        folder.FolderNode.calculate_mask), saves them to a mask file chosen by
+        the user and loads the mask, so that they are removed from every
+        frame read afterwards.
+        """
+        file_tree = self.file_select_panel.file_tree
+        selection = file_tree.GetSelection()
+        file_node = file_tree.GetPyData(selection) if selection.IsOk() else None
+        if not isinstance(file_node, folder.FolderNode):
+            display_error_message("Build Pixel Mask", "Please select a folder to build the mask from.")
+            return
+        mask = file_node.calculate_mask(file_tree.extension)
+        dialog = wx.FileDialog(self, message="Save pixel mask (%d pixels)" % len(mask),
+                               wildcard="Mask files (*.mask)|*.mask",
+                               style=wx.FD_SAVE | wx.FD_OVERWRITE_PROMPT)
+        if dialog.ShowModal() == wx.ID_OK:
+            mask.save(dialog.GetPath())
+            pypix.pixel_mask.set_pixels(mask)
+
+    def on_load_mask(self, evt):
+        """
+        Loads a pixel mask file, whose pixels are removed from every frame
+        read afterwards.
+        """
+        dialog = wx.FileDialog(self, message="Select pixel mask",
+                               wildcard="Mask files (*.mask)|*.mask|All files|*")
+        if dialog.ShowModal() == wx.ID_OK:
+            pypix.pixel_mask.load(dialog.GetPath())
+
+    def on_clear_mask(self, evt):
+        """
+        Stops masking pixels.
+        """
+        pypix.pixel_mask.clear()
+
+    def on_load_calibration(self, evt):
+        """
+        Loads a directory of energy calibration matrices (see
+        pypix/calibration.py), which sets the energy of the hits of every
+        frame read afterwards.
+        """
+        dialog = wx.DirDialog(self, message="Select energy calibration folder")
+        if dialog.ShowModal() == wx.ID_OK:
+            try:
+                pypix.energy_calibration.load(dialog.GetPath())
+            except (IOError, ValueError) as e:
+                display_error_message("Energy Calibration", str(e))
+
+    def on_clear_calibration(self, evt):
+        """
+        Stops calibrating the energies of hits.
+        """
+        pypix.energy_calibration.clear()
+
+    @profiling.log_event("on_aggregate")
     def on_aggregate(self, evt):
         """
         Aggregates all the frames in a folder.
@@ -132,11 +327,25 @@ class MainWindow(wx.Frame):
         file heirachy, many UI actions enforce the user to aggregate a frame
         first if they require details of clusters in subfolders. An example of
         this would be plotting a folder.
+
+        Only the frames and clusters accepted by the filters entered in the
+        frame and cluster filter fields are aggregated, see
+        pypix/filters.py.
         """
+        try:
+            frame_filter = filters.Filter.parse(
+                    self.file_select_panel.frame_filter_field.GetValue(), pypix.Frame)
+            cluster_filter = filters.Filter.parse(
+                    self.file_select_panel.cluster_filter_field.GetValue(), pypix.Cluster)
+        except ValueError as e:
+            display_error_message("Aggregation Filter", str(e))
+            return
         main_window.file_select_panel.aggregate_button.Disable()
         file_tree = self.file_select_panel.file_tree
         file_node = file_tree.GetPyData(file_tree.GetSelection())
-        aggregate_frame = file_node.calculate_aggregate(file_tree.extension)
+        aggregate_frame = file_node.calculate_aggregate(file_tree.extension,
+                                                        frame_filter, cluster_filter)
+        self.save_index()
         if aggregate_frame.number_of_hits == 0:
             display_error_message("Aggregation", 
                     "No hit pixels were found during the aggregation of the selected folder.")
@@ -181,6 +390,11 @@ class FileSelectPanel(wx.Panel):
 
         self.file_tree = FileTreeCtrl(self)
         self.aggregate_button = wx.Button(self, label="Aggregate")
+        # Filters of the frames and clusters aggregated, eg. "Volume > 100"
+        self.frame_filter_field = wx.TextCtrl(self)
+        self.frame_filter_field.SetToolTipString("Frame filter, eg. No. of hits < 50")
+        self.cluster_filter_field = wx.TextCtrl(self)
+        self.cluster_filter_field.SetToolTipString("Cluster filter, eg. Volume > 100 and Radius < 5")
         ext_label = wx.StaticText(self, label="Ext:")
         self.ext_field = wx.ComboBox(self, value="*.lsc", choices=["*.lsc", "*.ascii", "*.txt"])
         open_button = wx.Button(self, wx.ID_OPEN, label="Open...")
@@ -192,6 +406,13 @@ class FileSelectPanel(wx.Panel):
         v_sizer = wx.BoxSizer(wx.VERTICAL)
         self.SetSizer(v_sizer)
         v_sizer.Add(self.file_tree, 1, wx.EXPAND)
+        filter_sizer = wx.FlexGridSizer(2, 2, 3, 3)
+        filter_sizer.AddGrowableCol(1)
+        filter_sizer.Add(wx.StaticText(self, label="Frames:"), 0, wx.TOP, 3)
+        filter_sizer.Add(self.frame_filter_field, 1, wx.EXPAND)
+        filter_sizer.Add(wx.StaticText(self, label="Clusters:"), 0, wx.TOP, 3)
+        filter_sizer.Add(self.cluster_filter_field, 1, wx.EXPAND)
+        v_sizer.Add(filter_sizer, 0, wx.EXPAND | wx.TOP, 5)
         v_sizer.Add(self.aggregate_button, 0, wx.ALIGN_RIGHT | wx.TOP, 5)
         v_sizer.AddSpacer(5)
         open_sizer = wx.BoxSizer(wx.HORIZONTAL)
@@ -224,6 +445,7 @@ class FileTreeCtrl(wx.TreeCtrl):
         self.SetItemHasChildren(root)
         self.SetPyData(root, self.top_node)
 
+    @profiling.log_event("on_expand_node")
     def on_expand_node(self, evt):
         """
         Called by wx when a frame tree item is expanded.
@@ -244,17 +466,21 @@ class FileTreeCtrl(wx.TreeCtrl):
                 self.SetPyData(child_tree_node, child_frame)
             parent_file_node.expanded = True
 
+    @profiling.log_event("on_select_node")
     def on_select_node(self, evt):
         """
         Called when the a new item is selected in the frame browser.
 
         Either activates a new frame or enables aggregation depending if the
-        new item is a frame or folder respectively.
+        new item is a frame or folder respectively. Frames are fetched through
+        the prefetcher, which then reads the frames likely to be selected
+        next.
         """
         item = evt.GetItem()
         data = self.GetPyData(item)
         if isinstance(data, folder.FrameNode):
-            main_window.activate_frame(data.frame)
+            parent = self.GetPyData(self.GetItemParent(item))
+            main_window.activate_frame(main_window.prefetcher.select(data, parent.sub_frames))
             main_window.file_select_panel.aggregate_button.Disable()
             main_window.aggregate = False
         if isinstance(data, folder.FolderNode):
@@ -315,7 +541,11 @@ class TraceRenderLarge(TraceRenderBase):
         self.axes = self.fig.add_axes([0,0,1,1])
         self._remove_axes_ticks()
         self.fig.canvas.mpl_connect("button_press_event", self.on_mouse)
+        # The per-pixel statistic rendered for aggregate frames (one of
+        # statistics.LAYERS), or "Counts" for the summed counts
+        self.layer = "Counts"
 
+    @timing.timed("TraceRenderLarge.render")
     def render(self, pixelgrid):
         """
         Renders the trace view.
@@ -323,13 +553,21 @@ class TraceRenderLarge(TraceRenderBase):
         pixelgrid is a 2d array of integers or floats of the form so that
         pixelgrid[y][x] corresponds to the value of (x, y). The values need not
         be normalised as this is done by the matplotlib `imshow()` function.
+
+        If pixelgrid is an aggregate frame with per-pixel statistics and a
+        statistic has been chosen as the layer, that statistic is rendered
+        instead of the counts, without reading the frames again.
         """
-        data = pixelgrid.render_energy()
+        if self.layer != "Counts" and getattr(pixelgrid, "pixel_statistics", None) is not None:
+            data = pixelgrid.pixel_statistics.layer(self.layer)
+        else:
+            data = pixelgrid.render_energy()
         # Set origin to lower to match the display seen in Pixelman
         self.axes.imshow(data, origin="lower", interpolation="nearest", cmap="hot", aspect="auto")
         self.canvas.draw()
         self._cleanup_old_images()
 
+    @profiling.log_event("on_mouse")
     def on_mouse(self, event):
         """
         Called when the mouse is clicked on the rendered frame.
@@ -367,22 +605,23 @@ class TraceRenderZoom(TraceRenderBase):
         self._remove_axes_ticks()
         self.fig.canvas.mpl_connect("motion_notify_event", self.on_motion)
 
-    def render(self, pixelgrid):
+    @timing.timed("TraceRenderZoom.render")
+    def render(self, cluster):
         """
         Renders the trace view.
 
-        pixelgrid is a 2d array of integers or floats of the form so that
-        pixelgrid[y][x] corresponds to the value of (x, y). The values need not
-        be normalised as this is done in the call to matplotlib `imshow()` function.
-
-        pixelgrid should the size of one  whole frame but only contain the
-        pixels that are wished to be zoomed (ie. the cluster). This method will
-        then render the grid clipped to the bounding box of pixels.
+        cluster should be a pypix.Cluster. Its cached energy_patch, ie. the
+        energy grid clipped to the bounding box of the cluster, is rendered so
+        no per-pixel work is done here. The values need not be normalised as
+        this is done in the call to matplotlib `imshow()` function.
         """
-        data = pixelgrid.render_energy_zoomed()
+        # Keep hold of the patch and its position in the frame so that
+        # on_motion can read pixel values straight from it
+        self.patch = cluster.energy_patch
+        self.patch_origin = cluster.patch_origin
         # Clip the lowest value of the normalisation processes to 1 to ensure
         # that low value pixels don't apear black
-        self.axes.imshow(data, origin="lower", interpolation="nearest", cmap="hot",
+        self.axes.imshow(self.patch, origin="lower", interpolation="nearest", cmap="hot",
                 norm=matplotlib.colors.Normalize(vmin=1,clip=True))
         self.canvas.draw()
         self._cleanup_old_images()
@@ -395,12 +634,13 @@ class TraceRenderZoom(TraceRenderBase):
         position and energy.
         """
         # Parameter "event", not "evt", as this is a matplotlib event, not wx
-        if main_window.cluster and event.xdata and event.ydata:
-            x, y = [int(round(n)) for n in (event.xdata, event.ydata)]
-            x += main_window.cluster.min_x
-            y += main_window.cluster.min_y
-            main_window.view_tab.pixel_info.SetLabel("Pixel (%03d %03d): %d" 
-                    % (x, y, main_window.cluster[(x,y)].value))
+        if main_window.cluster and event.xdata is not None and event.ydata is not None:
+            column, row = [int(round(n)) for n in (event.xdata, event.ydata)]
+            height, width = self.patch.shape
+            if 0 <= column < width and 0 <= row < height:
+                origin_x, origin_y = self.patch_origin
+                main_window.view_tab.pixel_info.SetLabel("Pixel (%03d %03d): %d"
+                        % (column + origin_x, row + origin_y, self.patch[row, column]))
 
 class GraphRender(RenderPanel):
     """
@@ -411,6 +651,7 @@ class GraphRender(RenderPanel):
         super(GraphRender, self).__init__(parent, size=size)
         self.axes = None
 
+    @timing.timed("GraphRender.render")
     def render(self, x_axis, y_axis, class_property):
         """
         Plots and renders a graph.
@@ -436,45 +677,34 @@ class GraphRender(RenderPanel):
         if self.axes:
             self.axes.clear()
         self.axes = self.fig.add_subplot(111)
+        clusters = main_window.frame.clusters
+        colours = dict(enumerate(pypix.class_registry.colours))
+        # Split the clusters by class code once, rather than once per class
+        groups = pypix.group_codes(pypix.class_codes(clusters, class_property))
+        # Retrieve x function from pypix.attribute_table and calculate it for
+        # every cluster once
+        x_function = pypix.attribute_table[x_axis][0]
+        x_values = plotting.attribute_column(x_function, clusters, x_axis)
+        self.axes.set_xlabel(x_axis)
         if y_axis == "Histogram":
-            self.axes.set_xlabel(x_axis)
             self.axes.set_ylabel("Frequency")
-            # Retrieve x function from pypix.attribute_table
-            x_function = pypix.attribute_table[x_axis][0]
-            # For each cluster class
-            for class_ in CLASSES:
-                # Loop over the clusters of the frame, calculating the value of
-                # x_function for each cluster of the class we are currently inspecting
-                x_values = [x_function(cluster) for cluster in main_window.frame.clusters
-                        if getattr(cluster, class_property) == class_]
-                # If we have calculated any values for the current class
-                if x_values:
-                    # Plot them on the histogram with the style defined in CLASSES
-                    self.axes.hist(x_values, bins=100, histtype='stepfilled', color=CLASSES[class_][0])
+            plotting.plot_histogram(self.axes, x_values, groups, colours)
         else:
-            self.axes.set_xlabel(x_axis)
             self.axes.set_ylabel(y_axis)
-            # Retrieve the relevant functions from pypix.attribute_table
-            x_function = pypix.attribute_table[x_axis][0]
             y_function = pypix.attribute_table[y_axis][0]
-            plot_clusters = main_window.frame.clusters[:] # Copy list, as we modify it
+            y_values = plotting.attribute_column(y_function, clusters, y_axis)
             # If we have a cluster selected, plot it now with a special style.
             if main_window.cluster:
-                if main_window.cluster in plot_clusters:
-                    plot_clusters.remove(main_window.cluster) #Don't plot twice
-                    self.axes.plot(x_function(main_window.cluster),
-                                    y_function(main_window.cluster), "cx")
+                selected = [i for i, cluster in enumerate(clusters)
+                            if cluster is main_window.cluster]
+                if selected:
+                    # Don't plot twice
+                    for class_ in groups:
+                        groups[class_] = groups[class_][groups[class_] != selected[0]]
+                    self.axes.plot(x_values[selected[0]], y_values[selected[0]], "cx")
                 # Move above function call to this indentation level to plot selected
                 # cluster on all frames, even those it doesn't usually belong to.
-
-            # For each cluster class calculate x/y values and plot them with
-            # the style defined in CLASSES
-            for class_ in CLASSES:
-                x_values = [x_function(cluster) for cluster in plot_clusters
-                                if getattr(cluster, class_property) == class_]
-                y_values = [y_function(cluster) for cluster in plot_clusters
-                                if getattr(cluster, class_property) == class_]
-                self.axes.plot(x_values, y_values, CLASSES[class_][0] + ".")
+            plotting.plot_scatter(self.axes, x_values, y_values, groups, colours)
         self.canvas.draw()
 
 
@@ -489,17 +719,34 @@ class ViewPanel(wx.ScrolledWindow):
         self.SetSizer(v_sizer)
 
         self.pixel_info = wx.StaticText(self, label="Pixel (000,000): ")
+        layer_label = wx.StaticText(self, label="Aggregate layer ")
+        self.layer_menu = wx.ComboBox(self, value="Counts", choices=["Counts"] + statistics.LAYERS,
+                                      style=wx.CB_READONLY)
+        self.Bind(wx.EVT_COMBOBOX, self.on_layer, self.layer_menu)
+        layer_sizer = wx.BoxSizer(wx.HORIZONTAL)
+        layer_sizer.Add(layer_label, 0, wx.TOP, 5)
+        layer_sizer.Add(self.layer_menu)
         cluster_table_label = wx.StaticText(self, label="Cluster Info")
         self.cluster_table = AttributeTable(self, pypix.Cluster)
         frame_table_label = wx.StaticText(self, label="Frame Info")
         self.frame_table = AttributeTable(self, pypix.Frame)
 
         v_sizer.Add(self.pixel_info, 0, wx.ALIGN_CENTRE | wx.ALL, 5)
+        v_sizer.Add(layer_sizer, 0, wx.ALIGN_CENTRE | wx.ALL, 5)
         v_sizer.Add(cluster_table_label, 0, wx.ALIGN_CENTRE | wx.ALL, 5)
         v_sizer.Add(self.cluster_table, 1, wx.ALIGN_CENTRE | wx.BOTTOM, 5)
         v_sizer.Add(frame_table_label, 0, wx.ALIGN_CENTRE | wx.ALL, 5)
         v_sizer.Add(self.frame_table, 1, wx.ALIGN_CENTRE)
 
+    def on_layer(self, evt):
+        """
+        Renders the chosen per-pixel statistic (or the counts) of the
+        aggregate frame in the trace view.
+        """
+        main_window.display_trace.layer = self.layer_menu.GetValue()
+        if main_window.frame:
+            main_window.display_trace.render(main_window.frame)
+
 
 class PlotPanel(wx.ScrolledWindow):
     """
@@ -545,6 +792,7 @@ class PlotPanel(wx.ScrolledWindow):
         v_sizer.Add(plot_button, 0, wx.ALIGN_CENTRE | wx.TOP, 10)
 
 
+    @profiling.log_event("on_plot")
     def on_plot(self, evt):
         """
         Tells the GraphRender panel to render the graph with the required
@@ -590,7 +838,7 @@ class TrainPanel(wx.ScrolledWindow):
 
         manual_class_label = wx.StaticText(self, label="Manual Class")
         self.manual_class_menu = wx.ComboBox(self, value="Unclassified",
-                choices=["Unclassified", "Alpha", "Beta", "Gamma"],
+                choices=pypix.class_registry.names,
                 style = wx.CB_READONLY, size=(120,-1))
         self.Bind(wx.EVT_COMBOBOX, self.on_manual_set, self.manual_class_menu)
         manual_class_sizer = wx.BoxSizer(wx.HORIZONTAL)
@@ -709,6 +957,12 @@ class AttributeTable(wx.ListCtrl):
     """
     Displays a table with information on objects, with info calculated from
     pypix.attribute_table
+
+    Cheap attributes are shown as soon as an object is set, and the others
+    (judged by the cost hint of each attribute and the number of hits of the
+    object) are calculated in a background thread and filled in as they are
+    ready. Values are cached by the object (see pypix.attribute_value), so
+    showing an object again is immediate.
     """
     def __init__(self, parent, obj_type):
         """
@@ -737,32 +991,116 @@ class AttributeTable(wx.ListCtrl):
         # Setup row labels
         for i, attribute_row in enumerate(self.attribute_list):
             self.InsertStringItem(i, attribute_row[0])
+        # Incremented whenever an object is set, so that values calculated in
+        # the background for an earlier object are discarded
+        self.generation = 0
+        # Jobs of (generation, object, [(row, attribute name)]) for the
+        # background thread
+        self._jobs = Queue.Queue()
+        thread = threading.Thread(target=self._calculate_in_background)
+        thread.daemon = True
+        thread.start()
 
     def set_attributes(self, obj):
         """
         Loads info on `obj` into the table
         """
-        for i, attribute_row in enumerate(self.attribute_list):
-            value = attribute_row[1][0](obj)
-            if isinstance(value, float): # Format floats to 2 decimal places
-                value = "%.2f" % value
-            if isinstance(value, tuple): # Format each item of a tuple independently
-                new_value = "("
-                for component in value:
-                    if isinstance(component,float):
-                        new_value += "%.2f, " % i 
-                    else:
-                        new_value += str(i) + ", "
-                value = new_value[:-2]  + ")"
-            # Add the value to the table
-            self.SetStringItem(i,1,str(value))
-
-
-# Initialise wx
-app = wx.App()
-
-# Initialise the main app window
-main_window = MainWindow(title="Crayfish")
-
-# Begin the wx loop
-app.MainLoop()
+        self.generation += 1
+        # The values that needn't be calculated
+        known = set(obj.attribute_cache or ()) | set(getattr(obj, "indexed_attributes", None) or ())
+        background = []
+        for i, (name, (function, class_, plottable, trainable, cost)) in enumerate(self.attribute_list):
+            if (name in known or cost == pypix.COST_CONSTANT or
+                    (cost == pypix.COST_LINEAR and len(obj) <= BACKGROUND_HITS)):
+                self.SetStringItem(i, 1, format_value(pypix.attribute_value(obj, name, cache=True)))
+            else:
+                self.SetStringItem(i, 1, "...")
+                background.append((i, name))
+        if background:
+            self._jobs.put((self.generation, obj, background))
+
+    def _calculate_in_background(self):
+        """
+        Calculates the attributes of the jobs queued by set_attributes, until
+        the application exits, skipping those of objects no longer shown.
+        """
+        while True:
+            generation, obj, rows = self._jobs.get()
+            for i, name in rows:
+                if generation != self.generation:
+                    break
+                try:
+                    value = format_value(pypix.attribute_value(obj, name, cache=True))
+                except Exception as e:
+                    value = "Error: %s" % e
+                wx.CallAfter(self._set_background_value, generation, i, value)
+
+    def _set_background_value(self, generation, i, value):
+        """
+        Shows a value calculated in the background, if its object is still
+        the one shown.
+        """
+        if generation == self.generation:
+            self.SetStringItem(i, 1, value)
+
+def format_value(value):
+    """
+    Returns an attribute value formatted for display, with floats to 2
+    decimal places.
+    """
+    if isinstance(value, float):
+        return "%.2f" % value
+    if isinstance(value, tuple): # Format each item of a tuple independently
+        return "(%s)" % ", ".join(format_value(component) for component in value)
+    return str(value)
+
+
+# Parse command line options
+parser = argparse.ArgumentParser(description="Visualise and analyse Medipix frames.")
+parser.add_argument("--timings", metavar="FILE",
+        help="Record timings of the hot paths, and on exit print a report and "
+             "write it to FILE as JSON")
+parser.add_argument("--profile", metavar="FILE",
+        help="Profile the session, writing the profile to FILE and the latency "
+             "of GUI events to FILE.events.json")
+parser.add_argument("--profiler", choices=profiling.PROFILERS, default="cprofile",
+        help="The profiler used by --profile (default: cprofile)")
+parser.add_argument("--mask", metavar="FILE",
+        help="Remove the hot pixels listed in the pixel mask FILE from every frame")
+parser.add_argument("--calibration", metavar="DIRECTORY",
+        help="Calibrate the energy of hits with the calibration matrices in DIRECTORY")
+parser.add_argument("--prefetch", metavar="N", type=int, default=prefetch.LOOKAHEAD,
+        help="Prefetch the next N frames while stepping through a folder "
+             "(default: %d, 0 to disable)" % prefetch.LOOKAHEAD)
+args = parser.parse_args()
+if args.mask:
+    pypix.pixel_mask.load(args.mask)
+if args.calibration:
+    pypix.energy_calibration.load(args.calibration)
+if args.timings:
+    timing.enable()
+if args.profile:
+    profiling.start_profiling(args.profile, args.profiler)
+
+# Load the user's cluster classes
+if os.path.exists(CLASSES_CONFIG):
+    pypix.class_registry.load(CLASSES_CONFIG)
+
+# Write the profile and timings even if the session crashes, as those are
+# the sessions most worth looking at
+try:
+    # Initialise wx
+    app = wx.App()
+
+    # Initialise the main app window
+    main_window = MainWindow(title="Crayfish", prefetch_frames=args.prefetch)
+
+    # Begin the wx loop
+    app.MainLoop()
+finally:
+    if args.profile:
+        profiling.stop_profiling()
+
+    if args.timings:
+        print(timing.format_report())
+        timing.write_json(args.timings)
@@ -0,0 +1,506 @@
+"""
+Indexes a directory tree of frames in a single SQLite file, so that large
+archives can be browsed, queried, aggregated and plotted without reading and
+clustering every raw frame again.
+
+The index holds:
+
+    folders: Every folder below the root, with its modification time
+
+    frames: The path, size, modification time and dimensions of every frame
+    file, along with each frame attribute of pypix.attribute_table (its number of hits,
+    volume, number of clusters...). The modification time of the file is used
+    as the frame's timestamp.
+
+    clusters: A row per cluster holding each plottable cluster attribute of
+    pypix.attribute_table, the cluster's UUID and its hits
+
+Paths are stored relative to the root of the tree. The index is a cache of
+the frames, so if the schema or the indexed attributes have changed since it
+was built it is emptied, and rebuilt by the next update. An index is built (or
+brought up to date, reindexing only the frames that have changed) with
+Dataset.update, either from the GUI or from the command line::
+
+    python crayfish/dataset.py /path/to/frames --pattern "*.lsc"
+
+Frames are indexed with pypix.pixel_mask and pypix.energy_calibration
+applied, and every frame is reindexed if either has changed since the index
+was updated.
+
+A Dataset may be used in place of a scan.DirectoryIndex by folder.FolderNode,
+in which case the file tree is listed and folders are aggregated from the
+index, and filters (see pypix/filters.py) over indexed attributes are
+evaluated by SQLite.
+"""
+import argparse
+import json
+import hashlib
+import os
+import sqlite3
+import sys
+from multiprocessing import Pool
+
+import numpy
+
+import pypix
+from pypix import filters, statistics, timing
+import folder
+import scan
+
+# Where index files are saved by default
+INDEX_DIR = os.path.join(os.path.expanduser("~"), ".crayfish", "indexes")
+SCHEMA_VERSION = 3
+
+# The dtype of the stored hits, a flattened array of (x, y, count) triples
+HITS_TYPE = numpy.int32
+
+def indexed_attributes(class_):
+    """
+    Returns a list of (name, column) of the attributes of class_ (pypix.Frame
+    or pypix.Cluster) stored in the index. Frames store every attribute that
+    applies to them, and clusters their plottable attributes. The column is
+    the name of the attribute's function.
+    """
+    return [(name, function.__name__)
+            for name, (function, attribute_class, plottable, trainable, cost)
+            in pypix.attribute_table.items()
+            if issubclass(class_, attribute_class) and (plottable or class_ is pypix.Frame)]
+
+def _initialise_worker(mask_pixels, calibration_path):
+    """
+    Loads the pixel mask and energy calibration of the parent process in a
+    worker process.
+    """
+    pypix.pixel_mask.set_pixels(mask_pixels)
+    if calibration_path is not None:
+        pypix.energy_calibration.load(calibration_path)
+
+def _index_frame(job):
+    """
+    Reads and clusters a frame file, returning the rows to be stored for it.
+    Called in worker processes by Dataset.update, so it must be picklable.
+
+    Args:
+        job: A tuple (filepath, file_format)
+
+    Returns a tuple ((width, height), frame attribute values, clusters), where
+    clusters is a list of (attribute values, UUID, hits) for each cluster. The
+    attribute values are in the order returned by indexed_attributes.
+    """
+    filepath, file_format = job
+    frame = pypix.Frame.from_file(filepath, file_format)
+    frame.calculate_clusters()
+    clusters = []
+    for cluster in frame.clusters:
+        values = [float(pypix.attribute_table[name][0](cluster))
+                  for name, column in indexed_attributes(pypix.Cluster)]
+        xs, ys, counts = cluster.hit_arrays()
+        hits = numpy.column_stack((xs, ys, counts)).astype(HITS_TYPE)
+        clusters.append((values, cluster.UUID, hits.tostring()))
+    values = [float(pypix.attribute_table[name][0](frame))
+              for name, column in indexed_attributes(pypix.Frame)]
+    return (frame.width, frame.height), values, clusters
+
+class Dataset(object):
+    """
+    An SQLite index of the frames below root that match extension_pattern.
+
+    Args:
+        path: The filepath of the index file
+
+        root: The directory tree indexed. If None, the root the index was
+        built with is used.
+
+        extension_pattern: The pattern matched by frame files, eg. "*.lsc".
+        If None, the pattern the index was built with is used.
+    """
+    def __init__(self, path, root=None, extension_pattern=None):
+        self.path = path
+        directory = os.path.dirname(os.path.abspath(path))
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        self.connection = sqlite3.connect(path)
+        self.connection.row_factory = sqlite3.Row
+        self._create_tables()
+        if root is None:
+            root = self._get_meta("root")
+            if root is None:
+                raise ValueError("The index %s has not been built, so root must be given" % path)
+        if extension_pattern is None:
+            extension_pattern = self._get_meta("extension_pattern") or "*.lsc"
+        self.root = os.path.abspath(root)
+        self.extension_pattern = extension_pattern
+
+    @staticmethod
+    def default_path(root, extension_pattern):
+        """
+        Returns the default index filepath for root and extension_pattern.
+        """
+        key = "%s\n%s" % (os.path.abspath(root), extension_pattern)
+        if not isinstance(key, bytes):
+            key = key.encode("utf-8")
+        return os.path.join(INDEX_DIR, hashlib.sha1(key).hexdigest() + ".sqlite")
+
+    @classmethod
+    def find(cls, root, extension_pattern):
+        """
+        Returns the dataset at the default path for root and extension_pattern
+        if it has been built, otherwise None.
+        """
+        path = cls.default_path(root, extension_pattern)
+        if not os.path.exists(path):
+            return None
+        return cls(path, root, extension_pattern)
+
+    def _create_tables(self):
+        frame_columns = "".join(", %s REAL" % column for name, column
+                                in indexed_attributes(pypix.Frame))
+        cluster_columns = "".join(", %s REAL" % column for name, column
+                                  in indexed_attributes(pypix.Cluster))
+        # Identifies the layout of the index, which is rebuilt if it changes
+        layout = json.dumps([SCHEMA_VERSION, indexed_attributes(pypix.Frame),
+                             indexed_attributes(pypix.Cluster)])
+        with self.connection:
+            self.connection.execute("CREATE TABLE IF NOT EXISTS meta "
+                    "(key TEXT PRIMARY KEY, value TEXT)")
+            if self._get_meta("layout") != layout:
+                for table in ["folders", "frames", "clusters"]:
+                    self.connection.execute("DROP TABLE IF EXISTS %s" % table)
+                self._set_meta("layout", layout)
+            self.connection.execute("CREATE TABLE IF NOT EXISTS folders "
+                    "(path TEXT PRIMARY KEY, parent TEXT, mtime REAL)")
+            self.connection.execute("CREATE TABLE IF NOT EXISTS frames "
+                    "(id INTEGER PRIMARY KEY, path TEXT UNIQUE, folder TEXT, "
+                    "size INTEGER, mtime REAL, width INTEGER, height INTEGER%s)" % frame_columns)
+            self.connection.execute("CREATE TABLE IF NOT EXISTS clusters "
+                    "(id INTEGER PRIMARY KEY, frame INTEGER, uuid TEXT, hits BLOB%s)"
+                    % cluster_columns)
+            self.connection.execute("CREATE INDEX IF NOT EXISTS frames_folder ON frames (folder)")
+            self.connection.execute("CREATE INDEX IF NOT EXISTS frames_mtime ON frames (mtime)")
+            self.connection.execute("CREATE INDEX IF NOT EXISTS clusters_frame ON clusters (frame)")
+            self.connection.execute("CREATE INDEX IF NOT EXISTS folders_parent ON folders (parent)")
+
+    def _get_meta(self, key):
+        row = self.connection.execute("SELECT value FROM meta WHERE key = ?", (key,)).fetchone()
+        return row[0] if row else None
+
+    def _set_meta(self, key, value):
+        self.connection.execute("INSERT OR REPLACE INTO meta VALUES (?, ?)", (key, str(value)))
+
+    def relative_path(self, path):
+        """
+        Returns path relative to the root, as stored in the index. The root
+        itself is stored as "".
+        """
+        path = os.path.relpath(os.path.abspath(path), self.root)
+        return "" if path == os.curdir else path
+
+    def close(self):
+        self.connection.close()
+
+    @timing.timed("Dataset.update")
+    def update(self, processes=1, progress=None):
+        """
+        Brings the index up to date with the directory tree, reading and
+        clustering only the frames that are new or whose size or modification
+        time has changed, and removing those that no longer exist.
+
+        Args:
+            processes: The number of processes used to read and cluster
+            frames
+
+            progress: A function called as progress(done, total) after each
+            frame is indexed
+
+        Returns the number of frames (re)indexed.
+        """
+        directory_index = scan.DirectoryIndex(self.root, self.extension_pattern)
+        directory_index.scan()
+        file_format = folder.ext_pattern_to_filetype(self.extension_pattern)
+        known = dict((row["path"], (row["size"], row["mtime"])) for row in
+                     self.connection.execute("SELECT path, size, mtime FROM frames"))
+        if (self._get_meta("mask") != pypix.pixel_mask.digest() or
+                self._get_meta("calibration") != str(pypix.energy_calibration.digest())):
+            # Every frame was indexed with a different mask or calibration
+            known = dict((path, None) for path in known)
+        seen = set()
+        stale = []
+        with self.connection:
+            self.connection.execute("DELETE FROM folders")
+            for folder_path, listing in directory_index.folders.items():
+                relative = self.relative_path(folder_path)
+                parent = os.path.dirname(relative) if relative else None
+                self.connection.execute("INSERT INTO folders VALUES (?, ?, ?)",
+                                        (relative, parent, listing["mtime"]))
+                for name, size, mtime in listing["files"]:
+                    path = os.path.join(relative, name)
+                    seen.add(path)
+                    if known.get(path) != (size, mtime):
+                        stale.append((path, relative, size, mtime))
+            for path in set(known) - seen:
+                self._delete_frame(path)
+        jobs = [(os.path.join(self.root, path), file_format)
+                for path, relative, size, mtime in stale]
+        pool = None
+        if processes > 1:
+            pool = Pool(processes, _initialise_worker,
+                        (pypix.pixel_mask.pixels, pypix.energy_calibration.path))
+        try:
+            results = pool.imap(_index_frame, jobs) if pool else (_index_frame(job) for job in jobs)
+            for done, ((path, relative, size, mtime), result) in enumerate(zip(stale, results)):
+                with self.connection:
+                    self._delete_frame(path)
+                    self._insert_frame(path, relative, size, mtime, result)
+                if progress:
+                    progress(done + 1, len(jobs))
+        finally:
+            if pool:
+                pool.close()
+                pool.join()
+        with self.connection:
+            self._set_meta("root", self.root)
+            self._set_meta("extension_pattern", self.extension_pattern)
+            self._set_meta("mask", pypix.pixel_mask.digest())
+            self._set_meta("calibration", pypix.energy_calibration.digest())
+        timing.count("frames indexed", len(jobs))
+        return len(jobs)
+
+    def _delete_frame(self, path):
+        row = self.connection.execute("SELECT id FROM frames WHERE path = ?", (path,)).fetchone()
+        if row:
+            self.connection.execute("DELETE FROM clusters WHERE frame = ?", (row[0],))
+            self.connection.execute("DELETE FROM frames WHERE id = ?", (row[0],))
+
+    def _insert_frame(self, path, relative, size, mtime, result):
+        (width, height), frame_values, clusters = result
+        frame_columns = [column for name, column in indexed_attributes(pypix.Frame)]
+        cursor = self.connection.execute("INSERT INTO frames (path, folder, size, mtime, "
+                "width, height%s) VALUES (?, ?, ?, ?, ?, ?%s)" % (
+                "".join(", " + column for column in frame_columns), ", ?" * len(frame_columns)),
+                [path, relative, size, mtime, width, height] + frame_values)
+        frame_id = cursor.lastrowid
+        cluster_columns = [column for name, column in indexed_attributes(pypix.Cluster)]
+        statement = "INSERT INTO clusters (frame, uuid, hits%s) VALUES (?, ?, ?%s)" % (
+                "".join(", " + column for column in cluster_columns), ", ?" * len(cluster_columns))
+        self.connection.executemany(statement,
+                [[frame_id, uuid, sqlite3.Binary(hits)] + values
+                 for values, uuid, hits in clusters])
+
+    def folder(self, path):
+        """
+        Returns the listing of the folder at path in the same form as
+        scan.DirectoryIndex.folder, so that a Dataset may be used as the index
+        of a folder.FolderNode.
+        """
+        relative = self.relative_path(path)
+        folder_row = self.connection.execute("SELECT mtime FROM folders WHERE path = ?",
+                                             (relative,)).fetchone()
+        folders = [os.path.basename(row["path"]) for row in self.connection.execute(
+                "SELECT path FROM folders WHERE parent = ? ORDER BY path", (relative,))]
+        files = [[os.path.basename(row["path"]), row["size"], row["mtime"]]
+                 for row in self.connection.execute("SELECT path, size, mtime FROM frames "
+                         "WHERE folder = ? ORDER BY path", (relative,))]
+        return {"mtime": folder_row["mtime"] if folder_row else None,
+                "folders": folders, "files": files}
+
+    def _folder_condition(self, path, table="frames"):
+        """
+        Returns an SQL condition and its parameters selecting the frames in
+        the folder at path and its sub folders, or all frames if path is None.
+        """
+        if path is None:
+            return "1", ()
+        relative = self.relative_path(path)
+        if not relative:
+            return "1", ()
+        return ("(%s.folder = ? OR %s.folder LIKE ? ESCAPE '\\')" % (table, table),
+                (relative, relative.replace("\\", "\\\\").replace("%", "\\%")
+                           .replace("_", "\\_") + os.sep + "%"))
+
+    def frames(self, path=None, start=None, end=None, min_hits=None, max_hits=None,
+               min_clusters=None, max_clusters=None):
+        """
+        Returns the rows of the frames table (as sqlite3.Row objects, with
+        paths relative to the root) that match every condition given.
+
+        Args:
+            path: Only frames in this folder and its sub folders
+
+            start, end: Only frames with timestamps (file modification times)
+            in the range [start, end)
+
+            min_hits, max_hits: Only frames whose number of hits is in the
+            range [min_hits, max_hits]
+
+            min_clusters, max_clusters: Only frames whose number of clusters
+            is in the range [min_clusters, max_clusters]
+        """
+        condition, parameters = self._folder_condition(path)
+        conditions = [condition]
+        parameters = list(parameters)
+        for column, operator, value in [("mtime", ">=", start), ("mtime", "<", end),
+                                        ("number_of_hits", ">=", min_hits),
+                                        ("number_of_hits", "<=", max_hits),
+                                        ("number_of_clusters", ">=", min_clusters),
+                                        ("number_of_clusters", "<=", max_clusters)]:
+            if value is not None:
+                conditions.append("%s %s ?" % (column, operator))
+                parameters.append(value)
+        return self.connection.execute("SELECT * FROM frames WHERE %s ORDER BY path"
+                                       % " AND ".join(conditions), parameters).fetchall()
+
+    def cluster_column(self, name, path=None):
+        """
+        Returns a numpy array of the indexed attribute name (a key of
+        pypix.attribute_table) for every cluster of the frames in the folder
+        at path and its sub folders, or of every frame if path is None.
+        """
+        column = dict(indexed_attributes(pypix.Cluster))[name]
+        condition, parameters = self._folder_condition(path)
+        rows = self.connection.execute("SELECT clusters.%s FROM clusters JOIN frames "
+                "ON clusters.frame = frames.id WHERE %s ORDER BY clusters.id"
+                % (column, condition), parameters)
+        return numpy.array([row[0] for row in rows], dtype=float)
+
+    @staticmethod
+    def _filter_conditions(filter_, table, class_):
+        """
+        Splits the predicates of filter_ (see pypix/filters.py) into those
+        that can be evaluated by SQLite on the indexed attributes of class_,
+        held in table, and those that can't.
+
+        Returns a tuple (conditions, parameters, remaining), where conditions
+        is a list of SQL conditions, parameters their parameters and remaining
+        a pypix.filters.Filter of the other predicates.
+        """
+        columns = dict(indexed_attributes(class_))
+        conditions = []
+        parameters = []
+        remaining = []
+        for predicate in (filter_.predicates if filter_ else []):
+            if predicate.name in columns:
+                conditions.append("%s.%s %s ?" % (table, columns[predicate.name], predicate.operator))
+                parameters.append(predicate.value)
+            else:
+                remaining.append(predicate)
+        return conditions, parameters, filters.Filter(remaining)
+
+    @timing.timed("Dataset.aggregate")
+    def aggregate(self, path=None, frame_filter=None, cluster_filter=None):
+        """
+        Returns the aggregate frame of the frames in the folder at path and
+        its sub folders (or of every frame if path is None), as
+        folder.FolderNode.calculate_aggregate, built from the indexed
+        clusters rather than by reading and clustering every frame.
+
+        The indexed attributes of each cluster are stored in its
+        indexed_attributes, so they needn't be recalculated for plotting, and
+        the per-pixel statistics of the frames are gathered from the hits of
+        their clusters.
+
+        Args:
+            frame_filter, cluster_filter: pypix.filters.Filters of the frames
+            and clusters to aggregate, see calculate_aggregate. Frame
+            predicates, and cluster predicates over indexed attributes, are
+            evaluated by SQLite so rejected clusters are never read.
+        """
+        columns = indexed_attributes(pypix.Cluster)
+        condition, parameters = self._folder_condition(path)
+        conditions = [condition]
+        parameters = list(parameters)
+        frame_conditions, frame_parameters, frame_remaining = \
+                self._filter_conditions(frame_filter, "frames", pypix.Frame)
+        if frame_remaining:
+            raise ValueError("Can't filter frames on the index by: %s" % frame_remaining)
+        cluster_conditions, cluster_parameters, cluster_remaining = \
+                self._filter_conditions(cluster_filter, "clusters", pypix.Cluster)
+        conditions += frame_conditions
+        parameters += frame_parameters
+        # The aggregate is as large as the largest of its frames
+        width, height = self.connection.execute("SELECT MAX(width), MAX(height) FROM frames "
+                "WHERE %s" % " AND ".join(conditions), parameters).fetchone()
+        aggregate_frame = pypix.Frame(max(width or 0, pypix.CHIP_SIZE),
+                                      max(height or 0, pypix.CHIP_SIZE))
+        width, height = aggregate_frame.width, aggregate_frame.height
+        frames = self.connection.execute("SELECT COUNT(*) FROM frames WHERE %s"
+                                         % " AND ".join(conditions), parameters).fetchone()[0]
+        conditions += cluster_conditions
+        parameters += cluster_parameters
+        rows = self.connection.execute("SELECT clusters.*, frames.width AS frame_width, "
+                "frames.height AS frame_height FROM clusters JOIN frames "
+                "ON clusters.frame = frames.id WHERE %s ORDER BY frames.path, clusters.id"
+                % " AND ".join(conditions), parameters)
+        # The flat indices (y*width + x) and counts of the hits of the
+        # aggregated clusters, which are summed once they have all been read
+        indices = []
+        counts = []
+        accumulator = statistics.Accumulator(width, height)
+        # The hits of the clusters of the frame being read, as the rows are
+        # ordered by frame
+        frame_id, frame_size, frame_hits = None, None, []
+        for row in rows:
+            hits = numpy.fromstring(bytes(row["hits"]), dtype=HITS_TYPE).reshape(-1, 3)
+            cluster = pypix.Cluster(row["frame_width"], row["frame_height"])
+            cluster.set_hits(hits[:, 0], hits[:, 1], hits[:, 2])
+            cluster.indexed_attributes = dict((name, row[column]) for name, column in columns)
+            if cluster_remaining and not cluster_remaining(cluster):
+                continue
+            aggregate_frame.clusters.append(cluster)
+            indices.append(hits[:, 1] * width + hits[:, 0])
+            counts.append(hits[:, 2])
+            if row["frame"] != frame_id:
+                self._accumulate_frame(accumulator, frame_size, frame_hits)
+                frame_id, frame_hits = row["frame"], []
+                frame_size = (row["frame_width"], row["frame_height"])
+            frame_hits.append(hits)
+        self._accumulate_frame(accumulator, frame_size, frame_hits)
+        # Frames none of whose clusters were aggregated
+        accumulator.add_empty(frames - accumulator.frames)
+        totals = numpy.zeros(width * height, dtype=float)
+        if indices:
+            totals = numpy.bincount(numpy.concatenate(indices), weights=numpy.concatenate(counts),
+                                    minlength=width * height)
+        for index in numpy.flatnonzero(totals).tolist():
+            aggregate_frame[(index % width, index // width)] = pypix.Hit(int(totals[index]))
+        aggregate_frame.pixel_statistics = accumulator.result()
+        return aggregate_frame
+
+    @staticmethod
+    def _accumulate_frame(accumulator, size, hits):
+        """
+        Adds the statistics of a frame of size (width, height), given a list
+        of the hit arrays of its clusters, to accumulator.
+        """
+        if hits:
+            hits = numpy.concatenate(hits)
+            accumulator.add_hits(size[0], size[1], hits[:, 0], hits[:, 1], hits[:, 2])
+
+def main():
+    parser = argparse.ArgumentParser(description="Build or update the index of a directory tree of frames.")
+    parser.add_argument("root", help="The directory tree to index")
+    parser.add_argument("--pattern", default="*.lsc",
+                        help="The extension pattern of frame files (default: *.lsc)")
+    parser.add_argument("--output", help="The index file (default: the index Crayfish "
+                                         "opens for root and pattern)")
+    parser.add_argument("--processes", type=int, default=1,
+                        help="Number of processes used to read frames (default: 1)")
+    parser.add_argument("--mask", metavar="FILE", help="A pixel mask file to apply to the frames")
+    parser.add_argument("--calibration", metavar="DIRECTORY",
+                        help="An energy calibration to apply to the frames")
+    args = parser.parse_args()
+    if args.mask:
+        pypix.pixel_mask.load(args.mask)
+    if args.calibration:
+        pypix.energy_calibration.load(args.calibration)
+    path = args.output or Dataset.default_path(args.root, args.pattern)
+    dataset = Dataset(path, args.root, args.pattern)
+    def progress(done, total):
+        sys.stderr.write("\rIndexed %d/%d frames" % (done, total))
+    indexed = dataset.update(args.processes, progress)
+    if indexed:
+        sys.stderr.write("\n")
+    sys.stderr.write("%d frames in %s\n" % (len(dataset.frames()), path))
+    dataset.close()
+
+if __name__ == "__main__":
+    main()
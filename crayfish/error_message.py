@@ -1,18 +1,28 @@
 """
 As display_error_message is called by many different files, it is defined in its
 own separate file to make importing easier.
+
+wx is only imported when a message is displayed, so that modules using
+display_error_message may also be used by the command line tools (eg.
+batch.py and dataset.py) on machines without wxPython.
 """
-import wx
+import sys
 
 def display_error_message(title, message):
     """
-    Displays a modal error message dialog to the user.
+    Displays a modal error message dialog to the user, or writes the message
+    to stderr if wxPython isn't installed.
 
     Args:
         title: The dialog title
 
         message: The dialog message
     """
+    try:
+        import wx
+    except ImportError:
+        sys.stderr.write("%s: %s\n" % (title, message))
+        return
     msg = wx.MessageDialog(None, message, title, wx.OK | wx.ICON_WARNING)
     msg.ShowModal()
     msg.Destroy()
@@ -1,10 +1,18 @@
 """
 Contains function relating to the lazy evaluation of the file tree.
+
+Zip and tar archives in the tree are presented as folders, whose contents are
+read from the archive without extracting it (see archive.py).
 """
 import os
-import fnmatch
+
+import numpy
 
 import pypix
+from pypix import timing
+from pypix.statistics import PixelStatistics
+import archive
+import scan
 from error_message import display_error_message
 
 # Maps a file extension to the filetype
@@ -19,67 +27,342 @@ def ext_pattern_to_filetype(extension_pattern):
             return filetype_table[extension]
     return None
 
+class Aggregate(object):
+    """
+    The aggregate of a folder: the summed counts of the hits of its frames,
+    held compactly as arrays of the flat index (y * width + x) and count of
+    each hit pixel, the per-pixel statistics of the frames (see
+    pypix/statistics.py) and the list of its clusters.
+
+    Aggregates are memoised on each FolderNode, so they are kept small and
+    are merged with numpy rather than pixel by pixel.
+    """
+    __slots__ = ("width", "height", "pixels", "counts", "statistics", "clusters")
+
+    def __init__(self, width=pypix.CHIP_SIZE, height=pypix.CHIP_SIZE, pixels=(), counts=(),
+                 statistics=None, clusters=None):
+        self.width = width
+        self.height = height
+        self.pixels = numpy.asarray(pixels, dtype=numpy.int64)
+        self.counts = numpy.asarray(counts, dtype=numpy.int64)
+        self.statistics = statistics if statistics is not None else PixelStatistics(width, height)
+        self.clusters = clusters if clusters is not None else []
+
+    @classmethod
+    def merge(cls, parts):
+        """
+        Returns the aggregate of the aggregates parts, which is as large as
+        the largest of them, as the frames of a folder may come from sensors
+        of different sizes (eg. single chips and quads).
+        """
+        width = max([pypix.CHIP_SIZE] + [part.width for part in parts])
+        height = max([pypix.CHIP_SIZE] + [part.height for part in parts])
+        pixels = [part.pixels % part.width + (part.pixels // part.width) * width
+                  if part.width != width else part.pixels for part in parts]
+        clusters = []
+        for part in parts:
+            clusters += part.clusters
+        statistics = PixelStatistics.merge([part.statistics for part in parts], width, height)
+        if not pixels or not sum(len(part_pixels) for part_pixels in pixels):
+            return cls(width, height, statistics=statistics, clusters=clusters)
+        totals = numpy.bincount(numpy.concatenate(pixels),
+                                weights=numpy.concatenate([part.counts for part in parts]),
+                                minlength=width * height)
+        hit = numpy.flatnonzero(totals)
+        return cls(width, height, hit, totals[hit], statistics, clusters)
+
+    @classmethod
+    def from_hits(cls, width, height, xs, ys, counts, clusters):
+        """
+        Returns the aggregate of the hits of a frame, given as arrays of their
+        co-ordinates and counts, and clusters.
+        """
+        return cls(width, height, numpy.asarray(ys, dtype=numpy.int64) * width + xs, counts,
+                   PixelStatistics.from_hits(width, height, xs, ys, counts), clusters)
+
+    def to_mask(self, max_frequency=pypix.mask.MAX_FREQUENCY, max_mean_count=None):
+        """
+        Returns the pypix.Mask of the hot pixels of the aggregate, see
+        pypix.Mask.from_statistics.
+        """
+        statistics = self.statistics
+        return pypix.Mask.from_statistics(statistics.frames, statistics.pixels % statistics.width,
+                                          statistics.pixels // statistics.width,
+                                          statistics.occupancy,
+                                          statistics.means * statistics.frames,
+                                          max_frequency, max_mean_count)
+
+    def to_frame(self):
+        """
+        Returns the aggregate as a pypix.Frame.
+        """
+        frame = pypix.Frame(self.width, self.height)
+        for pixel, count in zip(self.pixels.tolist(), self.counts.tolist()):
+            frame[(pixel % self.width, pixel // self.width)] = pypix.Hit(int(count))
+        frame.clusters = list(self.clusters)
+        frame.pixel_statistics = self.statistics
+        return frame
+
 class FolderNode():
     """
     A folder node contains a number of FolderNodes (subfolders) and FrameNodes
     (frame files).
+
+    Args:
+        path: The path of the folder
+
+        index: The scan.DirectoryIndex (or dataset.Dataset, or
+        archive.ArchiveIndex for a folder in an archive) the folder is listed
+        from, which is shared with its sub folders. If None, an index rooted
+        at the folder is created when its children are first requested.
     """
-    def __init__(self, path):
+    def __init__(self, path, index=None):
         self.path = os.path.abspath(path)
+        self.index = index
         self.sub_folders = []
         self.sub_frames = []
         self.expanded = False
         self.aggregate_frame = None
+        # The listing the children were made from, see get_children
+        self._listing = None
+        # The last aggregation of the folder, see _aggregate, and the
+        # aggregate that aggregate_frame was made from
+        self._memo = None
+        self._frame_aggregate = None
 
+    def _get_index(self, extension_pattern):
+        """
+        Returns the directory index for extension_pattern, creating a new one
+        if the folder has no index or it was made for a different pattern.
+        """
+        if self.index is None or self.index.extension_pattern != extension_pattern:
+            if isinstance(self.index, archive.ArchiveIndex):
+                self.index = archive.ArchiveIndex(self.index.root, extension_pattern)
+            else:
+                self.index = scan.DirectoryIndex(self.path, extension_pattern)
+        return self.index
+
+    @timing.timed("FolderNode.get_children")
     def get_children(self, extension_pattern):
         """
-        Queries the file system for child folders and child frames.
+        Queries the directory index for child folders and child frames. The
+        children are only remade if the folder's listing has changed, and
+        existing sub folders are kept (along with their memoised aggregates).
 
         Returns a 2-element tuple. The first element of the tuple contains a
         list of FolderNodes (subfolders) and the seconf element contains a list
-        of FrameNodes (frames files).
-        """
-        if not (self.sub_folders or self.sub_frames):
-            for item in os.listdir(self.path):
-                item_path = os.path.join(self.path, item)
-                # If it is a folder add it to the tree
-                if os.path.isdir(item_path):
-                    self.sub_folders.append(FolderNode(item_path))
-                # If it is a frame with the correct extension pattern add it to the tree
-                elif fnmatch.fnmatch(item, extension_pattern):
-                    new_frame = FrameNode(item_path, extension_pattern)
-                    if new_frame.loaded_correctly: # If it loaded correctly
-                        self.sub_frames.append(new_frame)
+        of FrameNodes (frames files). Archives are listed as sub folders,
+        with an archive.ArchiveIndex of their own.
+        """
+        index = self._get_index(extension_pattern)
+        listing = index.folder(self.path)
+        if listing != self._listing:
+            existing = dict((sub_folder.path, sub_folder) for sub_folder in self.sub_folders
+                            if sub_folder.index is index)
+            existing_archives = dict((sub_folder.path, sub_folder) for sub_folder in self.sub_folders
+                                     if isinstance(sub_folder.index, archive.ArchiveIndex) and
+                                        sub_folder.index is not index)
+            self.sub_folders = []
+            self.sub_frames = []
+            for name in listing["folders"]:
+                path = os.path.join(self.path, name)
+                self.sub_folders.append(existing.get(path) or FolderNode(path, index))
+            for name, size, mtime in listing.get("archives", []):
+                path = os.path.join(self.path, name)
+                self.sub_folders.append(existing_archives.get(path) or
+                                        FolderNode(path, archive.ArchiveIndex(path, extension_pattern)))
+            archive_index = index if isinstance(index, archive.ArchiveIndex) else None
+            for name, size, mtime in listing["files"]:
+                self.sub_frames.append(FrameNode(os.path.join(self.path, name),
+                                                 extension_pattern, size, mtime, archive_index))
+            self._listing = listing
         return self.sub_folders, self.sub_frames
 
-    def calculate_aggregate(self, extension_pattern):
+    @timing.timed("FolderNode.calculate_aggregate")
+    def calculate_aggregate(self, extension_pattern, frame_filter=None, cluster_filter=None):
         """
         Calculates the aggregate frame from a depth-first inspection of the file
         tree.
 
+        The whole subtree is indexed first (see scan.DirectoryIndex.scan), so
+        that the folders are listed concurrently rather than one at a time.
+        Folders are revalidated against their modification times, and the
+        aggregate of each folder is memoised, so only the folders that have
+        changed since they were last aggregated (with the same filters) are
+        aggregated again; the rest are merged from their memoised aggregates.
+        Within a changed folder only the frames whose size or modification
+        time has changed are read again.
+
+        If the folder's index is a dataset.Dataset the aggregate is built from
+        the indexed clusters instead. The frames of a folder in an archive
+        (and its sub folders) are read in one pass over the archive.
+
+        Args:
+            extension_pattern: The extension pattern of frame files
+
+            frame_filter: A pypix.filters.Filter. Frames it rejects are left
+            out of the aggregate, and aren't clustered unless the filter
+            requires it.
+
+            cluster_filter: A pypix.filters.Filter. Only the clusters it
+            accepts, and their pixels, are added to the aggregate.
+
         Returns the aggregate frame
         """
-        aggregate_frame = pypix.Frame(256, 256)
+        index = self._get_index(extension_pattern)
+        if isinstance(index, scan.DirectoryIndex):
+            index.invalidate(self.path)
+            index.scan(self.path)
+        elif not isinstance(index, archive.ArchiveIndex):
+            # A dataset.Dataset, which aggregates the indexed clusters
+            return index.aggregate(self.path, frame_filter, cluster_filter)
+        aggregate = self._aggregate(extension_pattern, frame_filter, cluster_filter)
+        # The frame is kept while the aggregate is unchanged, so that eg.
+        # classes assigned to its clusters are kept
+        if aggregate is not self._frame_aggregate:
+            self.aggregate_frame = aggregate.to_frame()
+            self._frame_aggregate = aggregate
+        return self.aggregate_frame
+
+    @timing.timed("FolderNode.calculate_mask")
+    def calculate_mask(self, extension_pattern, max_frequency=pypix.mask.MAX_FREQUENCY,
+                       max_mean_count=None):
+        """
+        Finds the hot pixels of the frames in the folder and its sub folders
+        from the hit frequency and summed count of each pixel, which are
+        gathered by the same (memoised) traversal as calculate_aggregate.
+
+        As frames are read with pypix.pixel_mask applied, its pixels are
+        included in the mask returned, so a mask can be refined by building
+        it again once it has been loaded.
+
+        Args:
+            extension_pattern: The extension pattern of frame files
+
+            max_frequency, max_mean_count: The thresholds of hot pixels, see
+            pypix.Mask.from_statistics
+
+        Returns the pypix.Mask
+        """
+        node = self
+        if not isinstance(self._get_index(extension_pattern),
+                          (scan.DirectoryIndex, archive.ArchiveIndex)):
+            # The statistics are gathered from the raw frames rather than the
+            # clusters of a dataset.Dataset
+            node = FolderNode(self.path)
+        index = node._get_index(extension_pattern)
+        if isinstance(index, scan.DirectoryIndex):
+            index.invalidate(node.path)
+            index.scan(node.path)
+        mask = node._aggregate(extension_pattern, None, None).to_mask(max_frequency, max_mean_count)
+        return pypix.Mask(mask.pixels | pypix.pixel_mask.pixels)
+
+    def _aggregate(self, extension_pattern, frame_filter, cluster_filter):
+        """
+        Returns the Aggregate of the folder, see calculate_aggregate.
+
+        The result is memoised along with the folder's listing, the
+        aggregates of its sub folders and the aggregate of each of its
+        frames. It is reused if none of them have changed, and if only sub
+        folders have changed the aggregate of the folder's own frames is
+        reused, so only a merge is needed. Otherwise only the frames whose
+        (size, modification time) isn't memoised are read again. Aggregates
+        made before the pixel mask or energy calibration changed aren't
+        reused (see pypix.load_version).
+        """
+        key = (extension_pattern, str(frame_filter or ""), str(cluster_filter or ""),
+               pypix.load_version())
+        if isinstance(self.index, archive.ArchiveIndex):
+            return self._aggregate_archive(key, frame_filter, cluster_filter)
         self.get_children(extension_pattern)
-        # For each sub_folder call its aggregate method and add its
-        # clusters/pixels to the aggregate frame
-        for folder_path in self.sub_folders:
-            folder_frame = folder_path.calculate_aggregate(extension_pattern)
-            aggregate_frame.clusters += folder_frame.clusters
-            for pixel in folder_frame.hit_pixels:
-                aggregate_frame[pixel] = pypix.Hit(aggregate_frame[pixel].value
-                                                + folder_frame[pixel].value)
-        # For each sub frame calculate its clusters if not already calculated
-        # and add these clusters (and the frame's pixels) to the aggregate frame
+        folder_aggregates = [sub_folder._aggregate(extension_pattern, frame_filter, cluster_filter)
+                             for sub_folder in self.sub_folders]
+        memo_parts = {}
+        if self._memo is not None:
+            memo_key, memo_listing, memo_folder_aggregates, memo_frame_parts, \
+                    memo_frames_aggregate, aggregate = self._memo
+            if key == memo_key:
+                if (self._listing is memo_listing and
+                        len(folder_aggregates) == len(memo_folder_aggregates) and
+                        all(new is old for new, old in zip(folder_aggregates, memo_folder_aggregates))):
+                    timing.count("aggregates reused")
+                    return aggregate
+                memo_parts = dict(memo_frame_parts)
+        # The aggregate of each frame (None if the frame filter rejected it),
+        # keyed by the frame's path, size and modification time
+        frame_parts = []
         for frame_file in self.sub_frames:
-            frame = frame_file.frame
-            if not frame.clusters:
-                frame.calculate_clusters()
-            aggregate_frame.clusters += frame.clusters
-            for pixel in frame.hit_pixels:
-                aggregate_frame[pixel] = pypix.Hit(aggregate_frame[pixel].value
-                                                + frame[pixel].value)
-        return aggregate_frame
+            frame_key = (frame_file.path, frame_file.size, frame_file.mtime)
+            if frame_key in memo_parts:
+                part = memo_parts[frame_key]
+            else:
+                # Don't keep the frames of an aggregation in memory, only
+                # their (compact) clusters
+                part = self._aggregate_frame(frame_file.read(cache=False), frame_filter,
+                                             cluster_filter)
+            frame_parts.append((frame_key, part))
+        if memo_parts and [frame_key for frame_key, part in frame_parts] == \
+                [frame_key for frame_key, part in memo_frame_parts]:
+            frames_aggregate = memo_frames_aggregate
+        else:
+            frames_aggregate = Aggregate.merge([part for frame_key, part in frame_parts
+                                                if part is not None])
+        aggregate = Aggregate.merge(folder_aggregates + [frames_aggregate])
+        self._memo = (key, self._listing, folder_aggregates, frame_parts, frames_aggregate,
+                      aggregate)
+        return aggregate
+
+    def _aggregate_archive(self, key, frame_filter, cluster_filter):
+        """
+        Returns the Aggregate of the folder of an archive and its sub folders,
+        whose frames are read in a single pass over the archive (see
+        archive.ArchiveIndex.frames). The result is memoised until the
+        archive changes.
+        """
+        archive_file = self.index.archive
+        key += (archive_file.size, archive_file.mtime)
+        if self._memo is not None and self._memo[0] == key:
+            timing.count("aggregates reused")
+            return self._memo[-1]
+        frames = self.index.frames(self.path, ext_pattern_to_filetype(self.index.extension_pattern))
+        aggregate = self._aggregate_frames(frames, frame_filter, cluster_filter)
+        self._memo = (key, None, None, None, None, aggregate)
+        return aggregate
+
+    def _aggregate_frames(self, frames, frame_filter, cluster_filter):
+        """
+        Returns the Aggregate of frames, eg. the frames in the folder, not
+        including its sub folders.
+        """
+        parts = [self._aggregate_frame(frame, frame_filter, cluster_filter) for frame in frames]
+        return Aggregate.merge([part for part in parts if part is not None])
+
+    @staticmethod
+    def _aggregate_frame(frame, frame_filter, cluster_filter):
+        """
+        Returns the Aggregate of a single frame, or None if frame_filter
+        rejects it.
+        """
+        # Filter the frame before clustering it, as its cheap attributes are
+        # evaluated first
+        if frame_filter and not frame_filter(frame):
+            timing.count("frames rejected")
+            return None
+        # Calculate the frame's clusters if not already calculated, and add
+        # these clusters (and the frame's pixels) to the aggregate
+        if not frame.clusters:
+            frame.calculate_clusters()
+        if cluster_filter:
+            clusters = [cluster for cluster in frame.clusters if cluster_filter(cluster)]
+            timing.count("clusters rejected", len(frame.clusters) - len(clusters))
+            if clusters:
+                xs, ys, counts = [numpy.concatenate(columns) for columns in
+                                  zip(*[cluster.hit_arrays() for cluster in clusters])]
+                return Aggregate.from_hits(frame.width, frame.height, xs, ys, counts, clusters)
+            return Aggregate(frame.width, frame.height,
+                             statistics=PixelStatistics(frame.width, frame.height, 1))
+        xs, ys, counts = frame.hit_arrays()
+        return Aggregate.from_hits(frame.width, frame.height, xs, ys, counts, frame.clusters)
 
     @property
     def name(self):
@@ -91,17 +374,99 @@ class FolderNode():
 class FrameNode():
     """
     Contains a frame and is responsible for its loading.
+
+    The frame is only read from the file when it is first accessed, so that
+    listing a folder of many frames doesn't read each of them.
+
+    Args:
+        path: The path of the frame file
+
+        extension_pattern: The extension pattern the file was matched with,
+        used to guess its file type
+
+        size, mtime: The size and modification time of the file, if known
+        from the directory index
+
+        archive: The archive.ArchiveIndex of the archive the frame is in, or
+        None if it is a file
     """
-    def __init__(self, path, extension_pattern):
+    def __init__(self, path, extension_pattern, size=None, mtime=None, archive=None):
         self.path = path
+        self.extension_pattern = extension_pattern
+        self.size = size
+        self.mtime = mtime
+        self.archive = archive
         self.loaded_correctly = True
+        self._frame = None
+        # The pypix.load_version the frame was read with
+        self._load_version = None
+
+    @property
+    def frame(self):
+        """
+        The frame, which is read from the file on first access.
+        """
+        return self.read()
+
+    @property
+    def is_read(self):
+        """
+        True if the frame has been read and kept, with the current pixel mask
+        and energy calibration.
+        """
+        return self._frame is not None and self._load_version == pypix.load_version()
+
+    def read(self, cache=True):
+        """
+        Returns the frame, reading it from the file if it hasn't already been
+        read (or the pixel mask or energy calibration has changed since it
+        was).
+
+        Args:
+            cache: Whether to keep a newly read frame for later accesses
+        """
+        if self.is_read:
+            return self._frame
         try:
-            self.frame = pypix.Frame.from_file(os.path.abspath(path), ext_pattern_to_filetype(extension_pattern))
+            frame = self.read_file()
         except:
-            display_error_message("Error Reading File", "Couldn't read file: %s \nPlease ensure that it is a correctly formatted file. You may need to map the extension to the file type in the `filetype` dict in folder.py." % path)
-            raise
             self.loaded_correctly = False
+            display_error_message("Error Reading File", "Couldn't read file: %s \nPlease ensure that it is a correctly formatted file. You may need to map the extension to the file type in the `filetype` dict in folder.py." % self.path)
+            raise
+        if cache:
+            self.keep(frame, pypix.load_version())
+        return frame
+
+    def read_file(self):
+        """
+        Reads the frame from the file and returns it, without keeping it or
+        reporting errors, so that it may be called from other threads (see
+        prefetch.py).
+        """
+        file_format = ext_pattern_to_filetype(self.extension_pattern)
+        if self.archive is not None:
+            return self.archive.read_frame(self.path, file_format)
+        return pypix.Frame.from_file(os.path.abspath(self.path), file_format)
+
+    def keep(self, frame, load_version):
+        """
+        Keeps frame, read elsewhere (eg. by prefetch.Prefetcher) with
+        pypix.load_version() equal to load_version, as the node's frame.
+        """
+        self._frame = frame
+        self._load_version = load_version
+
+    def release(self):
+        """
+        Drops the kept frame, so that it is read again when it is next
+        accessed. Frames with manually classified clusters are kept, so that
+        their classes aren't lost.
+        """
+        if self._frame is not None and numpy.any(
+                pypix.class_codes(self._frame.clusters) != pypix.UNCLASSIFIED):
             return
+        self._frame = None
+        self._load_version = None
 
     @property
     def name(self):
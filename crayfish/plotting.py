@@ -0,0 +1,116 @@
+"""
+Contains functions for plotting cluster attributes on matplotlib axes.
+
+Aggregates may contain hundreds of thousands of clusters, so attributes are
+calculated once into numpy columns which are split by class code (see
+pypix.group_codes) rather than by comparing class names. Large scatter plots
+are drawn as a density image with a decimated scatter of each class over the
+top, and histograms are binned with numpy so matplotlib only has to draw the
+bars.
+"""
+import numpy
+import matplotlib.colors
+
+import pypix
+
+# Above this many points, scatter plots are drawn over a 2D density image
+DENSITY_THRESHOLD = 20000
+# The maximum number of points of each class that are drawn as markers
+MAX_SCATTER_POINTS = 5000
+# The number of bins used along each axis of histograms and density images
+BINS = 100
+
+def attribute_column(function, clusters, name=None):
+    """
+    Returns a numpy array of function(cluster) for each cluster in clusters.
+
+    Args:
+        function: An attribute function from pypix.attribute_table
+
+        clusters: A list of clusters
+
+        name: The name of the attribute in pypix.attribute_table. If given,
+        values held in a cluster's indexed_attributes (eg. clusters of an
+        aggregate read from a dataset index) are used rather than calling
+        function.
+    """
+    if name is None:
+        values = (function(cluster) for cluster in clusters)
+    else:
+        values = (pypix.attribute_value(cluster, name) for cluster in clusters)
+    return numpy.fromiter(values, dtype=float, count=len(clusters))
+
+def decimate(indices, max_points=MAX_SCATTER_POINTS):
+    """
+    Returns at most max_points of indices, chosen uniformly at random but
+    reproducibly so that replotting gives the same picture.
+    """
+    if len(indices) <= max_points:
+        return indices
+    chosen = numpy.random.RandomState(0).permutation(len(indices))[:max_points]
+    return indices[numpy.sort(chosen)]
+
+def plot_histogram(axes, values, groups, colours, bins=BINS):
+    """
+    Plots a histogram of values for each class on axes. Every class shares the
+    same bin edges so that the bars are comparable.
+
+    Args:
+        axes: The matplotlib axes to plot on
+
+        values: A numpy array of the values to be binned
+
+        groups: A dictionary mapping class code to an array of indices into
+        values, as returned by pypix.group_codes
+
+        colours: A dictionary mapping class code to matplotlib colour.
+        Classes without a colour are not plotted.
+    """
+    finite = values[numpy.isfinite(values)]
+    if not len(finite):
+        return
+    edges = numpy.histogram(finite, bins=bins)[1]
+    for class_, indices in groups.items():
+        if class_ not in colours or not len(indices):
+            continue
+        frequencies = numpy.histogram(values[indices], bins=edges)[0]
+        # Plot the precomputed frequencies as weights of one point per bin,
+        # so matplotlib draws the usual stepfilled histogram without
+        # rebinning the raw data.
+        axes.hist(edges[:-1], bins=edges, weights=frequencies,
+                  histtype="stepfilled", color=colours[class_])
+
+def plot_scatter(axes, x_values, y_values, groups, colours, bins=BINS):
+    """
+    Plots y_values against x_values for each class on axes.
+
+    If there are more than DENSITY_THRESHOLD points the density of all points
+    is drawn as a greyscale image, and at most MAX_SCATTER_POINTS points of
+    each class are drawn on top of it. Otherwise every point is drawn.
+
+    Args:
+        axes: The matplotlib axes to plot on
+
+        x_values, y_values: numpy arrays of the coordinates of each point
+
+        groups: A dictionary mapping class code to an array of indices into
+        the value arrays, as returned by pypix.group_codes
+
+        colours: A dictionary mapping class code to matplotlib colour.
+        Classes without a colour are not plotted.
+    """
+    dense = len(x_values) > DENSITY_THRESHOLD
+    if dense:
+        density, x_edges, y_edges = numpy.histogram2d(x_values, y_values, bins=bins)
+        # Transpose as histogram2d indexes the density as [x][y]
+        axes.imshow(numpy.ma.masked_equal(density.T, 0), origin="lower",
+                    interpolation="nearest", aspect="auto", cmap="Greys",
+                    norm=matplotlib.colors.LogNorm(),
+                    extent=(x_edges[0], x_edges[-1], y_edges[0], y_edges[-1]))
+    for class_, indices in groups.items():
+        if class_ not in colours or not len(indices):
+            continue
+        if dense:
+            # The density image stands in for the points left out
+            indices = decimate(indices)
+        axes.plot(x_values[indices], y_values[indices], ".", color=colours[class_])
@@ -0,0 +1,213 @@
+"""
+Prefetches frames while the user steps through a folder in the frame browser.
+
+Selecting a frame reads and clusters it, which for busy frames takes long
+enough to make stepping through a run with the arrow keys feel sluggish. A
+Prefetcher predicts the next few frames of the folder that will be selected
+(continuing in the direction the user is stepping) and reads and clusters them
+in background threads while the current frame is being looked at, so that
+selecting them is instantaneous.
+
+Memory is bounded: at most max_frames prefetched frames are held, the oldest
+being dropped first, and a frame is handed over to its folder.FrameNode when
+it is selected. Only the frames of the last max_frames nodes selected are kept
+by their nodes, those of earlier nodes being released (see
+folder.FrameNode.release). Each selection replaces the queue of frames to prefetch,
+cancelling those queued for earlier selections that are no longer predicted,
+and frames read with a different pixel mask or energy calibration than the
+current one (see pypix.load_version) are discarded.
+
+The number of selections whose frame was ready (hits) or had to be read on
+demand (misses), and of the prefetches cancelled, are kept in stats, and
+counted as "prefetch hits", "prefetch misses" and "prefetch cancelled" when
+timing is enabled (see pypix/timing.py).
+"""
+import threading
+from collections import OrderedDict
+
+import pypix
+from pypix import timing
+
+# The number of frames after the selected frame that are prefetched
+LOOKAHEAD = 3
+
+# The maximum number of prefetched frames held
+MAX_FRAMES = 8
+
+class Prefetcher(object):
+    """
+    Prefetches the frames of folder.FrameNodes in background threads.
+
+    Args:
+        lookahead: The number of frames after the selected frame that are
+        prefetched, 0 to disable prefetching
+
+        max_frames: The maximum number of prefetched frames held
+
+        threads: The number of threads frames are read in
+    """
+    def __init__(self, lookahead=LOOKAHEAD, max_frames=MAX_FRAMES, threads=1):
+        self.lookahead = lookahead
+        self.max_frames = max_frames
+        self.stats = {"hits": 0, "misses": 0, "cancelled": 0}
+        # Guards the queue, frames and loading, and is notified whenever a
+        # frame is queued or finishes loading
+        self._condition = threading.Condition()
+        # Maps the path of each frame waiting to be prefetched to its node,
+        # in the order they will be read
+        self._queue = OrderedDict()
+        # Maps the path of each prefetched frame to a tuple (load version,
+        # frame), oldest first
+        self._frames = OrderedDict()
+        # The paths of the frames being read
+        self._loading = set()
+        # Maps the path of each node whose frame was handed over by get to
+        # the node, least recently selected first
+        self._kept = OrderedDict()
+        # The index of the last frame selected and the paths of the nodes it
+        # was selected from, to tell which way the user is stepping
+        self._last = None
+        self._stopped = False
+        self._threads = []
+        for i in range(threads if lookahead else 0):
+            thread = threading.Thread(target=self._work, name="Prefetcher-%d" % i)
+            # Don't keep the application open for an unfinished prefetch
+            thread.daemon = True
+            thread.start()
+            self._threads.append(thread)
+
+    def _count(self, counter, n=1):
+        self.stats[counter] += n
+        timing.count("prefetch " + counter, n)
+
+    def get(self, node):
+        """
+        Returns the clustered frame of node, a folder.FrameNode. A prefetched
+        frame is used if there is one (waiting for it if it is being read),
+        otherwise the frame is read now.
+        """
+        version = pypix.load_version()
+        with self._condition:
+            self._queue.pop(node.path, None)
+            while node.path in self._loading:
+                self._condition.wait()
+            prefetched = self._frames.pop(node.path, None)
+        if prefetched is not None and prefetched[0] == version:
+            node.keep(prefetched[1], version)
+        if node.is_read:
+            self._count("hits")
+        else:
+            self._count("misses")
+        frame = node.frame
+        frame.calculate_clusters()
+        self._keep(node)
+        return frame
+
+    def _keep(self, node):
+        """
+        Records that node keeps its frame, releasing the frames of the least
+        recently selected nodes beyond max_frames.
+        """
+        self._kept.pop(node.path, None)
+        self._kept[node.path] = node
+        while len(self._kept) > self.max_frames:
+            path, released = self._kept.popitem(last=False)
+            released.release()
+
+    def select(self, node, siblings):
+        """
+        Returns the clustered frame of node (see get), which has been
+        selected from siblings, the list of the FrameNodes of its folder,
+        and prefetches the frames predicted to be selected next.
+
+        Nodes are matched by path, as the FrameNodes of a folder are remade
+        when it is listed again. If node isn't one of siblings nothing is
+        prefetched.
+        """
+        frame = self.get(node)
+        paths = [sibling.path for sibling in siblings]
+        if node.path not in paths:
+            self._last = None
+            return frame
+        index = paths.index(node.path)
+        step = 1
+        if self._last is not None and self._last[1] == paths and self._last[0] > index:
+            step = -1
+        self._last = (index, paths)
+        self.prefetch([siblings[i]
+                       for i in range(index + step, index + step * (self.lookahead + 1), step)
+                       if 0 <= i < len(siblings)])
+        return frame
+
+    def prefetch(self, nodes):
+        """
+        Replaces the queue of frames to prefetch with those of nodes, in
+        order, cancelling any queued prefetch that isn't one of them. Frames
+        that are already read or prefetched are skipped.
+        """
+        if not self._threads:
+            return
+        version = pypix.load_version()
+        with self._condition:
+            queue = OrderedDict()
+            for node in nodes:
+                prefetched = self._frames.get(node.path)
+                if (node.is_read or node.path in self._loading or
+                        (prefetched is not None and prefetched[0] == version)):
+                    continue
+                queue[node.path] = node
+            cancelled = len([path for path in self._queue if path not in queue])
+            self._queue = queue
+            self._condition.notify_all()
+        if cancelled:
+            self._count("cancelled", cancelled)
+
+    def clear(self):
+        """
+        Cancels every queued prefetch and discards the prefetched frames, eg.
+        when another folder is opened.
+        """
+        with self._condition:
+            self._queue.clear()
+            self._frames.clear()
+        self._last = None
+
+    def stop(self):
+        """
+        Stops the prefetching threads once they have finished the frames they
+        are reading.
+        """
+        with self._condition:
+            self._stopped = True
+            self._queue.clear()
+            self._condition.notify_all()
+        for thread in self._threads:
+            thread.join()
+        self._threads = []
+
+    def _work(self):
+        """
+        Reads and clusters queued frames until the prefetcher is stopped.
+        """
+        while True:
+            with self._condition:
+                while not self._queue and not self._stopped:
+                    self._condition.wait()
+                if self._stopped:
+                    return
+                path, node = self._queue.popitem(last=False)
+                self._loading.add(path)
+            version = pypix.load_version()
+            try:
+                frame = node.read_file()
+                frame.calculate_clusters()
+            except Exception:
+                # The error is reported if the frame is selected and read again
+                frame = None
+            with self._condition:
+                self._loading.discard(path)
+                if frame is not None:
+                    self._frames[path] = (version, frame)
+                    while len(self._frames) > self.max_frames:
+                        self._frames.popitem(last=False)
+                self._condition.notify_all()
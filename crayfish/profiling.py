@@ -0,0 +1,111 @@
+"""
+Contains functions for profiling a Crayfish session, so that reports of
+slowness can be backed up with evidence.
+
+A session is profiled by calling start_profiling before the work to be
+profiled and stop_profiling afterwards. This writes:
+
+    <filepath>: The profile. For the default cProfile profiler this may be
+    read with the pstats module or a viewer such as SnakeViz.
+
+    <filepath>.events.json: The latency of every call of a function decorated
+    with log_event (eg. GUI event handlers), along with the timing report (see
+    pypix/timing.py) of the session.
+"""
+import cProfile
+import functools
+import json
+import sys
+import time
+
+from pypix import timing
+
+# The available profilers. "sampling" uses pyinstrument, if it is installed.
+PROFILERS = ["cprofile", "sampling"]
+
+_profiler = None
+_profiler_kind = None
+_filepath = None
+# The list of logged events, or None if a session is not being profiled
+_events = None
+
+def start_profiling(filepath, kind="cprofile"):
+    """
+    Starts profiling the session. The results are written to filepath when
+    stop_profiling is called. Timing (see pypix/timing.py) is also enabled.
+
+    Args:
+        filepath: The filepath of the profile file
+
+        kind: One of PROFILERS. If "sampling" is requested but pyinstrument
+        is not installed, cProfile is used instead.
+    """
+    global _profiler, _profiler_kind, _filepath, _events
+    if kind == "sampling":
+        try:
+            import pyinstrument
+            _profiler = pyinstrument.Profiler()
+        except ImportError:
+            sys.stderr.write("pyinstrument is not installed, using cProfile instead.\n")
+            kind = "cprofile"
+    if kind == "cprofile":
+        _profiler = cProfile.Profile()
+    _profiler_kind = kind
+    _filepath = filepath
+    _events = []
+    timing.enable()
+    if kind == "sampling":
+        _profiler.start()
+    else:
+        _profiler.enable()
+
+def stop_profiling():
+    """
+    Stops profiling, and writes the profile and event log files.
+    """
+    global _profiler, _events
+    if _profiler is None:
+        return
+    if _profiler_kind == "sampling":
+        _profiler.stop()
+        with open(_filepath, "w") as f:
+            f.write(_profiler.output_text())
+    else:
+        _profiler.disable()
+        _profiler.dump_stats(_filepath)
+    with open(_filepath + ".events.json", "w") as f:
+        json.dump({"events": _events, "timings": timing.report()}, f, indent=2)
+    _profiler = None
+    _events = None
+
+def profile_call(filepath, function, *args, **kwargs):
+    """
+    Calls function(*args, **kwargs) whilst profiling it to filepath, returning
+    its return value.
+    """
+    start_profiling(filepath)
+    try:
+        return function(*args, **kwargs)
+    finally:
+        stop_profiling()
+
+def log_event(name):
+    """
+    A function decorator that logs the start time and duration of each call of
+    the function as an event called name, whilst a session is being profiled.
+    Intended for GUI event handlers, so that the latency of slow interactions
+    can be reported.
+    """
+    def decorator(function):
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            if _events is None:
+                return function(*args, **kwargs)
+            start = time.time()
+            try:
+                return function(*args, **kwargs)
+            finally:
+                _events.append({"event": name, "start": start,
+                                "duration": time.time() - start})
+        return wrapper
+    return decorator
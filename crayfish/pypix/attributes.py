@@ -4,7 +4,7 @@
 #
 # Then apply the attribute function decorator::
 #
-#     @attribute(object_type, name, plottable, trainable)
+#     @attribute(object_type, name, plottable, trainable, cost)
 #
 # Where:
 #     object_type is the type of object that the attribute is applicable to,
@@ -19,6 +19,12 @@
 #     machine learning algorithms (may be omitted, defualts to the value of
 #     plottable)
 #
+#     cost is a hint of how expensive the attribute is to calculate, one of
+#     COST_CONSTANT, COST_LINEAR or COST_EXPENSIVE (may be omitted, defaults to
+#     COST_LINEAR). Cheap attributes are evaluated first when filtering, and
+#     shown straight away in the info tables of the GUI while the others are
+#     calculated in the background.
+#
 #
 # The attribute functions may be defined in any order. The order in which they are
 # defined here is the order in which they will appear in the GUI
@@ -28,33 +34,34 @@
 """
 import hashlib
 
+import numpy
+
 from pypix import *
 # ============== Attributes begin here and maintain order ===============
 
-@attribute(PixelGrid, "No. of hits", True)
+@attribute(PixelGrid, "No. of hits", True, cost=COST_CONSTANT)
 def number_of_hits(self):
-    return len(self.hit_pixels)
+    return len(self)
 
-@attribute(PixelGrid, "Volume", True)
+@attribute(PixelGrid, "Volume", True, cost=COST_CONSTANT)
 def volume(self):
-    return sum(self.counts)
+    return self.sum_of_counts
 
-@attribute(PixelGrid, "Mean count", True)
+@attribute(PixelGrid, "Mean count", True, cost=COST_CONSTANT)
 def mean_count(self):
     if self.number_of_hits == 0: # Don't divide by zero
         return 0
     return float(self.volume)/self.number_of_hits
 
-@attribute(PixelGrid, "Count std. dev.", True)
+@attribute(PixelGrid, "Count std. dev.", True, cost=COST_CONSTANT)
 def standard_deviation(self):
     if self.number_of_hits == 0: #Don't divide by zero
         return 0
-    mean_square = (float(sum([count**2 for count in self.counts]))
-            /self.number_of_hits)
+    mean_square = float(self.sum_of_squares)/self.number_of_hits
     square_mean = self.mean_count**2
     return (mean_square - square_mean)**0.5
 
-@attribute(Frame, "No. of clusters")
+@attribute(Frame, "No. of clusters", cost=COST_EXPENSIVE)
 def number_of_clusters(self):
     if not self.clusters:
         self.calculate_clusters()
@@ -67,28 +74,107 @@ def geometric_centre(self):
 
 @attribute(Cluster, "C. of mass")
 def centre_of_mass(self):
-    weighted_hits = [tuple([self[hit].value * coord for coord in hit])
-            for hit in self.hit_pixels]
-    x_coords, y_coords = zip(*weighted_hits)
-    total_weight = float(self.volume)
-    return (sum(x_coords)/total_weight, sum(y_coords)/total_weight)
+    x, y = self.count_moments.centre
+    return (float(x), float(y))
 
 @attribute(Cluster, "Radius", True)
 def radius(self):
     # Call centre of mass once to save computing multiple times
     cofm_x, cofm_y = self.centre_of_mass
-    distances_squared = []
-    for pixel in self.hit_pixels:
-        x_diff = pixel[0] - cofm_x
-        y_diff = pixel[1] - cofm_y
-        distances_squared.append(x_diff**2 + y_diff**2)
-    return max(distances_squared)**0.5
-
-@attribute(Cluster, "Most neighbours", True)
+    xs, ys, counts = self.hit_arrays()
+    return kernels.max_square_distance(xs, ys, cofm_x, cofm_y)**0.5
+
+# The shape attributes below are derived from the moments of the hits, which
+# are calculated once for every cluster of a frame (see moments.py)
+
+@attribute(Cluster, "Major axis", True)
+def major_axis(self):
+    """
+    The length of the major axis of the ellipse with the same second moments
+    as the hits.
+    """
+    return float(self.moments.major_axis)
+
+@attribute(Cluster, "Minor axis", True)
+def minor_axis(self):
+    """
+    The length of the minor axis of the ellipse with the same second moments
+    as the hits.
+    """
+    return float(self.moments.minor_axis)
+
+@attribute(Cluster, "Orientation", True, False)
+def orientation(self):
+    """
+    The angle of the major axis from the x axis, in degrees.
+    """
+    return float(self.moments.orientation)
+
+@attribute(Cluster, "Eccentricity", True)
+def eccentricity(self):
+    """
+    0 for a round cluster, approaching 1 for an elongated one.
+    """
+    return float(self.moments.eccentricity)
+
+@attribute(Cluster, "Linearity", True)
+def linearity(self):
+    """
+    0 for a round cluster and 1 for a straight track.
+    """
+    return float(self.moments.linearity)
+
+@attribute(Cluster, "Track length", True)
+def track_length(self):
+    """
+    The length of the cluster along its major axis in pixels, N for a
+    straight track of N pixels.
+    """
+    return float(self.moments.length)
+
+@attribute(Cluster, "Density", True)
+def density(self):
+    """
+    The fraction of the pixels of the track length x width rectangle of the
+    cluster that are hit.
+    """
+    return float(self.moments.density)
+
+@attribute(Cluster, "Most neighbours", True, cost=COST_EXPENSIVE)
 def most_neighbours(self):
     return self.get_max_neighbours()[0]
 
-@attribute(Cluster, "UUID")
+@attribute(Cluster, "Time of arrival", True, False)
+def time_of_arrival(self):
+    """
+    The time of arrival of the first hit, or 0 if the hits aren't
+    time-resolved.
+    """
+    if self.toas is None or not len(self.toas):
+        return 0
+    return float(numpy.nanmin(self.toas))
+
+@attribute(Cluster, "Duration", True, False)
+def duration(self):
+    """
+    The time between the first and last hits to arrive, or 0 if the hits
+    aren't time-resolved.
+    """
+    if self.toas is None or not len(self.toas):
+        return 0
+    return float(numpy.nanmax(self.toas) - numpy.nanmin(self.toas))
+
+@attribute(Cluster, "Energy", True, False)
+def energy(self):
+    """
+    The total calibrated energy of the hits in keV, or 0 if the hits aren't
+    calibrated (see calibration.py).
+    """
+    if self.energies is None or not len(self.energies):
+        return 0
+    return float(numpy.nansum(self.energies))
+
+@attribute(Cluster, "UUID", cost=COST_EXPENSIVE)
 def UUID(self):
     """
     Return the cluster UUID
@@ -0,0 +1,155 @@
+"""
+Per-pixel energy calibration of Timepix ToT (time over threshold) counts.
+
+The ToT of a pixel is related to the energy E (in keV) deposited in it by the
+surrogate function::
+
+    ToT = a*E + b - c/(E - t)
+
+whose parameters a, b, c and t are calibrated for every pixel. A calibration
+is a directory holding the four matrices of the parameters, one per file
+named a, b, c and t (or calib<name>, as written by Pixet) with the extension
+.txt, a text matrix with a row per y co-ordinate, or .npy, a numpy array.
+
+Text matrices are converted to .npy files in CACHE_DIR the first time they are
+loaded, and every matrix is memory-mapped, so loading a calibration is cheap
+and the matrices are shared by the frames it is applied to. The energies of
+all of the hits of a frame are calculated at once as it is read (see
+pypix.Frame.from_file) and stored alongside their counts as Hit.energy.
+"""
+import hashlib
+import os
+
+import numpy
+
+# The directory text matrices are converted to .npy files in
+CACHE_DIR = os.path.join(os.path.expanduser("~"), ".crayfish", "calibration")
+
+# The parameters of the surrogate function
+PARAMETERS = ["a", "b", "c", "t"]
+
+# The dtype of calibrated energies
+ENERGY_TYPE = numpy.float64
+
+def _matrix_path(directory, name):
+    """
+    Returns the path of the matrix of parameter name in directory.
+    """
+    for filename in [name + ".npy", name + ".txt", "calib" + name + ".npy", "calib" + name + ".txt"]:
+        path = os.path.join(directory, filename)
+        if os.path.exists(path):
+            return path
+    raise IOError("No calibration matrix for parameter %s in %s" % (name, directory))
+
+def _load_matrix(path, cache_dir):
+    """
+    Returns the matrix at path memory-mapped, converting a text matrix to a
+    .npy file in cache_dir first if it hasn't been already.
+    """
+    if not path.endswith(".txt"):
+        return numpy.load(path, mmap_mode="r")
+    stat = os.stat(path)
+    key = "%s\n%d\n%d" % (os.path.abspath(path), stat.st_size, stat.st_mtime)
+    cache_path = os.path.join(cache_dir, hashlib.sha1(key).hexdigest() + ".npy")
+    if not os.path.exists(cache_path):
+        if not os.path.isdir(cache_dir):
+            os.makedirs(cache_dir)
+        numpy.save(cache_path, numpy.loadtxt(path, dtype=ENERGY_TYPE, ndmin=2))
+    return numpy.load(cache_path, mmap_mode="r")
+
+def surrogate(energies, a, b, c, t):
+    """
+    Returns the ToT of hits depositing energies, given the calibration
+    parameters of their pixels.
+    """
+    return a * energies + b - c / (energies - t)
+
+class Calibration(object):
+    """
+    The calibration matrices of a detector, which are loaded with load. A
+    calibration that hasn't been loaded is false and leaves hits
+    uncalibrated.
+    """
+    def __init__(self):
+        self.version = 0
+        self.clear()
+
+    def clear(self):
+        """
+        Unloads the calibration.
+        """
+        self.path = None
+        self.matrices = None
+        self._digest = None
+        self.version += 1
+
+    def load(self, path, cache_dir=CACHE_DIR):
+        """
+        Loads the calibration in the directory at path (see the module
+        docstring). The calibration is modified in place so that existing
+        references to it (eg. pypix.energy_calibration) see it, and its
+        version is incremented.
+
+        Args:
+            path: The calibration directory
+
+            cache_dir: The directory text matrices are converted to .npy
+            files in
+        """
+        paths = [_matrix_path(path, name) for name in PARAMETERS]
+        matrices = [_load_matrix(matrix_path, cache_dir) for matrix_path in paths]
+        if len(set(matrix.shape for matrix in matrices)) != 1:
+            raise ValueError("The calibration matrices in %s differ in size" % path)
+        self.path = os.path.abspath(path)
+        self.matrices = matrices
+        key = "".join("%s\n%d\n" % (matrix_path, os.stat(matrix_path).st_mtime)
+                      for matrix_path in paths)
+        self._digest = hashlib.sha1(key).hexdigest()
+        self.version += 1
+
+    def digest(self):
+        """
+        Returns a SHA1 digest identifying the loaded calibration, or None if
+        none is loaded.
+        """
+        return self._digest
+
+    def energies(self, xs, ys, tots):
+        """
+        Returns a numpy array of the energies (in keV) of hits, given as
+        arrays of their co-ordinates and ToT counts, by inverting the
+        surrogate function for all of them at once. Hits outside of the
+        calibrated pixels, or on pixels whose calibration can't be inverted,
+        have energy NaN.
+        """
+        xs, ys = numpy.asarray(xs, dtype=int), numpy.asarray(ys, dtype=int)
+        tots = numpy.asarray(tots, dtype=ENERGY_TYPE)
+        energies = numpy.empty(len(tots), dtype=ENERGY_TYPE)
+        energies.fill(numpy.nan)
+        height, width = self.matrices[0].shape
+        inside = (xs >= 0) & (xs < width) & (ys >= 0) & (ys < height)
+        a, b, c, t = [numpy.asarray(matrix[ys[inside], xs[inside]], dtype=ENERGY_TYPE)
+                      for matrix in self.matrices]
+        tots = tots[inside]
+        # The larger root of the quadratic a*E^2 + (b - a*t - ToT)*E + (ToT*t - b*t - c) = 0
+        with numpy.errstate(divide="ignore", invalid="ignore"):
+            energies[inside] = (a * t + tots - b + numpy.sqrt((b + a * t - tots)**2 + 4 * a * c)) / (2 * a)
+        return energies
+
+    def apply(self, frame):
+        """
+        Sets the energy of every hit of frame (a pypix.Frame), returning the
+        array of energies.
+        """
+        xs, ys, counts = frame.hit_arrays()
+        energies = self.energies(xs, ys, counts)
+        for hit, energy in zip(frame.values(), energies.tolist()):
+            hit.energy = energy
+        return energies
+
+    def __nonzero__(self):
+        return self.matrices is not None
+
+# The calibration applied to frames as they are read, which is empty unless a
+# calibration has been loaded
+energy_calibration = Calibration()
@@ -0,0 +1,138 @@
+"""
+The class registry maps the names of particle classes that clusters may be
+assigned to (eg. "Alpha") to small integer codes, along with the colour used to
+draw them.
+
+Clusters store their classes as codes, so that the classes of many clusters can
+be gathered into a numpy array (see class_codes in pypix.py) and then filtered,
+counted and grouped with vectorised operations rather than string comparisons.
+
+The classes may be loaded from a JSON config file of the form::
+
+    {"classes": [{"name": "Alpha", "colour": "r"},
+                 {"name": "Beta", "colour": "y"}]}
+
+"""
+import json
+
+import numpy
+
+# Code 0 is always reserved for clusters that have not been classified
+UNCLASSIFIED = 0
+
+# The classes available when no config file is loaded, as (name, colour)
+DEFAULT_CLASSES = [("Alpha", "r"), ("Beta", "y"), ("Gamma", "b")]
+
+# Colours given to classes that are registered without one, eg. classes read
+# from a training file that are not in the config
+FALLBACK_COLOURS = ["g", "m", "c", "0.5"]
+
+# The numpy integer type used for arrays of class codes
+CODE_TYPE = numpy.int16
+
+class ClassRegistry(object):
+    """
+    An ordered registry of cluster classes. Each class has a name, a colour
+    and an integer code, which is its position in the registry.
+
+    Args:
+        classes: A list of (name, colour) tuples to register, in addition to
+        "Unclassified" which is always registered with code UNCLASSIFIED
+    """
+    def __init__(self, classes=DEFAULT_CLASSES):
+        self.set_classes(classes)
+
+    def set_classes(self, classes):
+        """
+        Replaces the registered classes with classes, a list of (name, colour)
+        tuples. The registry is modified in place so that existing references
+        to it see the new classes.
+        """
+        self.names = ["Unclassified"]
+        self.colours = ["k"]
+        self._codes = {"Unclassified": UNCLASSIFIED}
+        for name, colour in classes:
+            if name == "Unclassified":
+                if colour is not None:
+                    self.colours[UNCLASSIFIED] = colour
+            else:
+                self.add(name, colour)
+
+    def load(self, path):
+        """
+        Replaces the registered classes with those in the JSON config file at
+        path (see the module docstring for its format).
+        """
+        with open(path) as f:
+            config = json.load(f)
+        self.set_classes([(item["name"], item.get("colour"))
+                          for item in config["classes"]])
+
+    def add(self, name, colour=None):
+        """
+        Registers a new class, returning its code. If colour is None a
+        colour is picked from FALLBACK_COLOURS.
+        """
+        if name in self._codes:
+            raise ValueError("Class already registered: " + name)
+        if colour is None:
+            colour = FALLBACK_COLOURS[len(self.names) % len(FALLBACK_COLOURS)]
+        self._codes[name] = len(self.names)
+        self.names.append(name)
+        self.colours.append(colour)
+        return self._codes[name]
+
+    def code(self, name):
+        """
+        Returns the code of the class called name, registering it first if it
+        is not yet known (for example when it is read from a training file).
+        """
+        if name not in self._codes:
+            return self.add(name)
+        return self._codes[name]
+
+    def name(self, code):
+        """
+        Returns the name of the class with code.
+        """
+        return self.names[code]
+
+    def colour(self, code):
+        """
+        Returns the colour of the class with code.
+        """
+        return self.colours[code]
+
+    def counts(self, codes):
+        """
+        Returns a numpy array of the number of times each class appears in the
+        array codes, indexed by class code.
+        """
+        return numpy.bincount(numpy.asarray(codes, dtype=int),
+                              minlength=len(self.names))
+
+    def __len__(self):
+        return len(self.names)
+
+    def __iter__(self):
+        return iter(self.names)
+
+    def __contains__(self, name):
+        return name in self._codes
+
+
+def group_codes(codes):
+    """
+    Partitions the indices of the array codes by code, using a single stable
+    sort.
+
+    Returns a dictionary mapping each code present to a numpy array of the
+    indices at which it appears, in ascending order.
+    """
+    codes = numpy.asarray(codes)
+    order = numpy.argsort(codes, kind="mergesort")
+    present, starts = numpy.unique(codes[order], return_index=True)
+    return dict(zip(present.tolist(), numpy.split(order, starts[1:])))
+
+# The registry used by clusters
+class_registry = ClassRegistry()
@@ -0,0 +1,407 @@
+"""
+Reads and clusters the event streams of time-resolved (ToA/ToT) detectors,
+such as Timepix3 in data-driven mode, which report each hit as it happens
+rather than integrating hits into frames.
+
+Events are held in columns (see Events): numpy arrays of the x and y
+co-ordinates, time of arrival (ToA) and time over threshold (ToT) of every
+hit. The ToT is used as the hit's count, so the clusters and frames made from
+events have the usual attributes, plus the time attributes of
+pypix/attributes.py.
+
+A stream is read in chunks of events (see read_events), which may be sliced
+into frames of a fixed exposure time (see time_windows) or clustered
+spatio-temporally (see stream_clusters): hits are in the same cluster if they
+are neighbours (or the same pixel) and arrive within time_gap of each other.
+Every step works on whole chunks with numpy rather than on single hits, so
+that streams can be processed at detector rates of millions of hits per
+second.
+
+The supported file formats are:
+
+    t3pa: The tab separated text format written by Pixet, with a header line
+    and the columns Index, Matrix Index, ToA, ToT, FToA and Overflow. The
+    matrix index is y * width + x, and the time of arrival in nanoseconds is
+    25 * ToA - 25/16 * FToA.
+
+    events: Text with a line of "x y toa tot" per hit, the toa in
+    nanoseconds. Lines starting with "//" are comments.
+"""
+import numpy
+
+from pypix import Frame, Hit, Cluster, CHIP_SIZE, COORD_TYPE, COUNT_TYPE, TOA_TYPE
+from morphology import NEIGHBOUR_OFFSETS
+import timing
+
+# The number of bytes of a file read per chunk of events
+CHUNK_BYTES = 16 * 1024 * 1024
+
+# The neighbour offsets that are searched when pairing hits. Neighbourliness
+# is symmetric, so only half of the offsets are needed. The pixel itself (for
+# repeated hits) comes first.
+_PAIR_OFFSETS = [(0, 0)] + [(dx, dy) for dx, dy in NEIGHBOUR_OFFSETS
+                            if (dy, dx) > (0, 0)]
+
+# Timepix3 time units, in nanoseconds
+TOA_CLOCK = 25.0
+FTOA_CLOCK = 25.0 / 16
+
+class Events(object):
+    """
+    A chunk of time-resolved hits, stored as columns.
+
+    Args:
+        xs, ys: Sequences of the co-ordinates of each hit
+
+        toas: A sequence of the time of arrival of each hit
+
+        tots: A sequence of the time over threshold (count) of each hit
+    """
+    __slots__ = ("xs", "ys", "toas", "tots")
+
+    def __init__(self, xs=(), ys=(), toas=(), tots=()):
+        self.xs = numpy.asarray(xs, dtype=COORD_TYPE)
+        self.ys = numpy.asarray(ys, dtype=COORD_TYPE)
+        self.toas = numpy.asarray(toas, dtype=TOA_TYPE)
+        self.tots = numpy.asarray(tots, dtype=COUNT_TYPE)
+
+    def __len__(self):
+        return len(self.xs)
+
+    def __getitem__(self, index):
+        """
+        Returns the events selected by index, a slice, boolean mask or array
+        of indices.
+        """
+        return Events(self.xs[index], self.ys[index], self.toas[index], self.tots[index])
+
+    @staticmethod
+    def concatenate(chunks):
+        """
+        Returns the events of every Events of chunks, in order.
+        """
+        chunks = [chunk for chunk in chunks if len(chunk)]
+        if not chunks:
+            return Events()
+        return Events(*[numpy.concatenate([getattr(chunk, column) for chunk in chunks])
+                        for column in Events.__slots__])
+
+    def sorted(self):
+        """
+        Returns the events in order of time of arrival.
+        """
+        return self[numpy.argsort(self.toas, kind="mergesort")]
+
+    def to_frame(self, width=CHIP_SIZE, height=CHIP_SIZE):
+        """
+        Returns a Frame of the events, with the ToT as the count of each hit.
+        A pixel hit more than once has the sum of the ToTs and the earliest
+        time of arrival.
+        """
+        keys = self.ys.astype(numpy.int64) * width + self.xs
+        order = numpy.lexsort((self.toas, keys))
+        keys = keys[order]
+        starts = numpy.flatnonzero(numpy.concatenate(([True], keys[1:] != keys[:-1])))
+        frame = Frame(width, height)
+        if not len(keys):
+            return frame
+        tots = numpy.add.reduceat(self.tots[order].astype(numpy.int64), starts)
+        toas = self.toas[order][starts]
+        for key, tot, toa in zip(keys[starts].tolist(), tots.tolist(), toas.tolist()):
+            frame[(key % width, key // width)] = Hit(tot, toa=toa)
+        return frame
+
+def _read_chunks(filepath, chunk_bytes):
+    """
+    Yields the text of filepath in chunks of about chunk_bytes, each ending
+    at the end of a line.
+    """
+    with open(filepath) as f:
+        while True:
+            text = f.read(chunk_bytes)
+            if not text:
+                return
+            yield text + f.readline()
+
+def _parse_columns(text, columns):
+    """
+    Returns a 2D array of the whitespace separated numbers of text, with
+    columns columns.
+    """
+    if "//" in text:
+        text = "\n".join(line for line in text.splitlines() if not line.startswith("//"))
+    values = numpy.fromstring(text, dtype=numpy.float64, sep=" ")
+    if len(values) % columns:
+        raise ValueError("Expected %d columns of numbers" % columns)
+    return values.reshape(-1, columns)
+
+def read_events(filepath, file_format="t3pa", width=CHIP_SIZE, chunk_bytes=CHUNK_BYTES):
+    """
+    Yields the events of the file at filepath in chunks.
+
+    Args:
+        file_format: Either "t3pa" or "events", see the module docstring
+
+        width: The width of the detector, used to convert the matrix index of
+        a t3pa file to co-ordinates
+
+        chunk_bytes: The approximate number of bytes of the file read per
+        chunk
+    """
+    if file_format not in ("t3pa", "events"):
+        raise Exception("File format not supported: " + file_format)
+    for number, text in enumerate(_read_chunks(filepath, chunk_bytes)):
+        with timing.Timer("events.read_events"):
+            if file_format == "t3pa":
+                if number == 0:
+                    # Skip the header line
+                    text = text.split("\n", 1)[1] if "\n" in text else ""
+                values = _parse_columns(text, 6)
+                matrix_index = values[:, 1].astype(numpy.int64)
+                events = Events(matrix_index % width, matrix_index // width,
+                                TOA_CLOCK * values[:, 2] - FTOA_CLOCK * values[:, 4],
+                                values[:, 3])
+            else:
+                values = _parse_columns(text, 4)
+                events = Events(values[:, 0], values[:, 1], values[:, 2], values[:, 3])
+        timing.count("events read", len(events))
+        yield events
+
+def write_events(events, filepath, file_format="t3pa", width=CHIP_SIZE):
+    """
+    Writes events to filepath in a format that read_events can read.
+
+    Args:
+        file_format: Either "t3pa" or "events"
+
+        width: The width of the detector, see read_events
+    """
+    with open(filepath, "w") as f:
+        if file_format == "t3pa":
+            f.write("Index\tMatrix Index\tToA\tToT\tFToA\tOverflow\n")
+            # Split the times into whole ToA clock ticks and the fine ToA
+            toa = numpy.ceil(events.toas / TOA_CLOCK)
+            ftoa = numpy.round((toa * TOA_CLOCK - events.toas) / FTOA_CLOCK)
+            matrix_index = events.ys.astype(numpy.int64) * width + events.xs
+            for row in zip(range(len(events)), matrix_index.tolist(), toa.astype(numpy.int64).tolist(),
+                           events.tots.tolist(), ftoa.astype(numpy.int64).tolist()):
+                f.write("%d\t%d\t%d\t%d\t%d\t0\n" % row)
+        elif file_format == "events":
+            for row in zip(events.xs.tolist(), events.ys.tolist(), events.toas.tolist(),
+                           events.tots.tolist()):
+                f.write("%d %d %r %d\n" % row)
+        else:
+            raise Exception("File format not supported: " + file_format)
+
+def _split(events, keys):
+    """
+    Yields a tuple (key, Events) for each run of equal keys, a sorted array
+    with a key per event.
+    """
+    if not len(keys):
+        return
+    boundaries = numpy.flatnonzero(keys[1:] != keys[:-1]) + 1
+    starts = [0] + boundaries.tolist()
+    ends = boundaries.tolist() + [len(keys)]
+    for start, end in zip(starts, ends):
+        yield keys[start], events[start:end]
+
+def time_windows(chunks, window, start=None):
+    """
+    Slices a stream of events into windows of a fixed length of time, eg.
+    to make frames of exposure time window with Events.to_frame.
+
+    Args:
+        chunks: An iterable of Events in order of time of arrival, although
+        the events within each chunk may be in any order
+
+        window: The length of each window
+
+        start: The start time of the first window, defaults to the time of
+        arrival of the first event
+
+    Yields a tuple (window start time, Events) for each window that contains
+    events.
+    """
+    pending = Events()
+    for chunk in chunks:
+        events = Events.concatenate([pending, chunk]).sorted()
+        if not len(events):
+            continue
+        if start is None:
+            start = events.toas[0]
+        windows = numpy.floor((events.toas - start) / window).astype(numpy.int64)
+        # The window of the latest event may continue into the next chunk
+        complete = numpy.searchsorted(windows, windows[-1])
+        for number, window_events in _split(events[:complete], windows[:complete]):
+            yield start + number * window, window_events
+        pending = events[complete:]
+    if len(pending):
+        windows = numpy.floor((pending.toas - start) / window).astype(numpy.int64)
+        for number, window_events in _split(pending, windows):
+            yield start + number * window, window_events
+
+def _connected_components(size, first, second):
+    """
+    Returns an array of the label of each of size nodes of a graph with edges
+    between first[i] and second[i], where the nodes of each connected
+    component share the label of its lowest node.
+
+    Labels are merged over all edges at once (hooking each edge's higher
+    label onto its lower label, then pointer jumping), so that the loop is
+    over rounds of merging rather than over edges.
+    """
+    labels = numpy.arange(size)
+    while True:
+        first_labels, second_labels = labels[first], labels[second]
+        differ = first_labels != second_labels
+        if not differ.any():
+            return labels
+        low = numpy.minimum(first_labels[differ], second_labels[differ])
+        high = numpy.maximum(first_labels[differ], second_labels[differ])
+        # Where a label is hooked onto several others the last assignment
+        # wins, so assign in order of decreasing lower label to hook onto
+        # the lowest
+        order = numpy.argsort(low, kind="mergesort")[::-1]
+        labels[high[order]] = low[order]
+        while True:
+            jumped = labels[labels]
+            if (jumped == labels).all():
+                break
+            labels = jumped
+
+@timing.timed("events.label_events")
+def label_events(events, time_gap):
+    """
+    Labels the spatio-temporal clusters of events: hits are in the same
+    cluster if they are on neighbouring pixels (or the same pixel) and their
+    times of arrival differ by at most time_gap, or are connected by a chain
+    of such hits.
+
+    Returns an array of the label of each event. Labels count up from 0 in
+    order of the first event of each cluster.
+    """
+    if not len(events):
+        return numpy.zeros(0, dtype=numpy.int64)
+    # Pixel keys, offset so that neighbours of the edge pixels don't wrap
+    xs = events.xs.astype(numpy.int64) + 1
+    ys = events.ys.astype(numpy.int64) + 1
+    width = int(xs.max()) + 2
+    keys = ys * width + xs
+    toas = events.toas - events.toas.min()
+    # Work on the events sorted by pixel and then time, so that the searches
+    # below are for sorted values, which is much quicker
+    order = numpy.lexsort((toas, keys))
+    keys, toas = keys[order], toas[order]
+    pixels, pixel_numbers = numpy.unique(keys, return_inverse=True)
+    # A single sorted key in which the events of each pixel are spacing
+    # apart, so that the events of a pixel within a range of time can be
+    # found with searchsorted
+    spacing = float(toas.max()) + 2 * time_gap + 1
+    sorted_keys = pixel_numbers * spacing + toas
+    # Repeated hits of a pixel are chained to the next hit of the pixel
+    repeats = numpy.flatnonzero((keys[1:] == keys[:-1]) & (toas[1:] - toas[:-1] <= time_gap))
+    first = [repeats]
+    second = [repeats + 1]
+    for dx, dy in _PAIR_OFFSETS[1:]:
+        neighbour_keys = keys + dy * width + dx
+        neighbours = numpy.minimum(numpy.searchsorted(pixels, neighbour_keys), len(pixels) - 1)
+        hits = numpy.flatnonzero(pixels[neighbours] == neighbour_keys)
+        times = neighbours[hits] * spacing + toas[hits]
+        low = numpy.searchsorted(sorted_keys, times - time_gap, "left")
+        high = numpy.searchsorted(sorted_keys, times + time_gap, "right")
+        # Pair each hit with every event in its range
+        lengths = high - low
+        total = int(lengths.sum())
+        range_starts = numpy.repeat(low - (numpy.cumsum(lengths) - lengths), lengths)
+        first.append(numpy.repeat(hits, lengths))
+        second.append(range_starts + numpy.arange(total))
+    sorted_labels = _connected_components(len(events), numpy.concatenate(first),
+                                          numpy.concatenate(second))
+    labels = numpy.empty_like(sorted_labels)
+    labels[order] = sorted_labels
+    # Number the clusters in order of their first event
+    roots, first_events, labels = numpy.unique(labels, return_index=True, return_inverse=True)
+    ranks = numpy.empty_like(first_events)
+    ranks[numpy.argsort(first_events)] = numpy.arange(len(roots))
+    return ranks[labels]
+
+@timing.timed("events.clusters_from_events")
+def clusters_from_events(events, labels, width=CHIP_SIZE, height=CHIP_SIZE):
+    """
+    Returns a list of the Clusters of events labelled by label_events, with
+    the ToT as the count and the ToA of each hit. A pixel hit more than once
+    in a cluster has the sum of the ToTs and the earliest time of arrival.
+    """
+    if not len(events):
+        return []
+    keys = events.ys.astype(numpy.int64) * width + events.xs
+    order = numpy.lexsort((events.toas, keys, labels))
+    labels, keys = labels[order], keys[order]
+    # The first event of each distinct (cluster, pixel)
+    new_hit = numpy.concatenate(([True], (labels[1:] != labels[:-1]) | (keys[1:] != keys[:-1])))
+    hit_starts = numpy.flatnonzero(new_hit)
+    xs = events.xs[order][hit_starts]
+    ys = events.ys[order][hit_starts]
+    toas = events.toas[order][hit_starts]
+    tots = numpy.add.reduceat(events.tots[order].astype(numpy.int64), hit_starts)
+    hit_labels = labels[hit_starts]
+    boundaries = (numpy.flatnonzero(hit_labels[1:] != hit_labels[:-1]) + 1).tolist()
+    clusters = []
+    for start, end in zip([0] + boundaries, boundaries + [len(hit_labels)]):
+        cluster = Cluster(width, height)
+        cluster.set_hits(xs[start:end], ys[start:end], tots[start:end], toas[start:end])
+        clusters.append(cluster)
+    return clusters
+
+def stream_labels(chunks, time_gap):
+    """
+    Clusters a stream of events spatio-temporally (see label_events),
+    including clusters that span the boundaries between chunks, without
+    making a Cluster object per cluster.
+
+    Args:
+        chunks: An iterable of Events in order of time of arrival, although
+        the events within each chunk may be in any order
+
+        time_gap: The greatest difference between the times of arrival of
+        neighbouring hits of a cluster
+
+    Yields a tuple (Events, labels) for each chunk, of the events of the
+    clusters completed by the chunk, sorted by time of arrival, and their
+    labels as label_events.
+    """
+    pending = Events()
+    for chunk in chunks:
+        events = Events.concatenate([pending, chunk]).sorted()
+        if not len(events):
+            continue
+        labels = label_events(events, time_gap)
+        # Clusters with a hit within time_gap of the latest event may still
+        # grow in the next chunk, so are held back until then. The events are
+        # sorted, so the last time assigned to each label is its latest.
+        latest = numpy.zeros(labels.max() + 1, dtype=TOA_TYPE)
+        latest[labels] = events.toas
+        open_ = latest[labels] >= events.toas[-1] - time_gap
+        done = ~open_
+        # Renumber the completed clusters from 0, keeping their order
+        completed = numpy.unique(labels[done], return_inverse=True)[1]
+        timing.count("clusters found", completed.max() + 1 if len(completed) else 0)
+        yield events[done], completed
+        pending = events[open_]
+    if len(pending):
+        labels = label_events(pending, time_gap)
+        timing.count("clusters found", labels.max() + 1)
+        yield pending, labels
+
+def stream_clusters(chunks, time_gap, width=CHIP_SIZE, height=CHIP_SIZE):
+    """
+    As stream_labels, but yields a list of the Clusters (see
+    clusters_from_events) completed by each chunk, in order of their first
+    hit.
+
+    Args:
+        width, height: The dimensions of the detector
+    """
+    for events, labels in stream_labels(chunks, time_gap):
+        yield clusters_from_events(events, labels, width, height)
@@ -0,0 +1,127 @@
+"""
+Filters frames and clusters by predicates over the attributes of
+attribute_table, eg. to aggregate only the clusters with a volume above a
+threshold, or to skip noisy frames with too many hits.
+
+A filter is written as comparisons of an attribute with a number, joined by
+"and"::
+
+    Volume > 100 and No. of hits < 50
+
+Predicates are evaluated in order of the cost hints of their attributes (see
+pypix.attribute), so an object is rejected by its cheapest failing predicate
+without calculating any expensive attributes. Values held in an object's
+indexed_attributes (eg. clusters read from a dataset index) are used rather
+than being recalculated.
+"""
+import operator
+import re
+
+from pypix import attribute_table, attribute_value
+
+# Maps the comparison operators that may be used in a predicate to functions
+OPERATORS = {"<": operator.lt, "<=": operator.le, ">": operator.gt,
+             ">=": operator.ge, "==": operator.eq, "!=": operator.ne}
+
+# Attribute names contain spaces and full stops, so everything before the
+# operator is taken as the name
+_PREDICATE = re.compile(r"^\s*(.+?)\s*(<=|>=|==|!=|<|>)\s*(\S+)\s*$")
+_AND = re.compile(r"\s+and\s+", re.IGNORECASE)
+
+class Predicate(object):
+    """
+    A comparison of an attribute with a value, eg. Predicate("Volume", ">", 100).
+
+    Args:
+        name: A key of attribute_table
+
+        operator: One of the keys of OPERATORS
+
+        value: The number the attribute is compared with
+    """
+    def __init__(self, name, operator, value):
+        if name not in attribute_table:
+            raise ValueError("Unknown attribute: %s" % name)
+        if operator not in OPERATORS:
+            raise ValueError("Unknown operator: %s" % operator)
+        self.name = name
+        self.operator = operator
+        self.value = value
+        self._compare = OPERATORS[operator]
+
+    @property
+    def class_(self):
+        """
+        The class that the predicate's attribute may be calculated for.
+        """
+        return attribute_table[self.name][1]
+
+    @property
+    def cost(self):
+        """
+        The cost hint of the predicate's attribute.
+        """
+        return attribute_table[self.name][4]
+
+    def __call__(self, obj):
+        """
+        Returns True if obj satisfies the predicate.
+        """
+        return self._compare(attribute_value(obj, self.name), self.value)
+
+    def __str__(self):
+        return "%s %s %s" % (self.name, self.operator, self.value)
+
+class Filter(object):
+    """
+    A conjunction of predicates, which are evaluated cheapest first. An empty
+    filter accepts everything.
+
+    Args:
+        predicates: A list of Predicates
+    """
+    def __init__(self, predicates=()):
+        # sorted is stable, so predicates of equal cost keep their order
+        self.predicates = sorted(predicates, key=lambda predicate: predicate.cost)
+
+    @classmethod
+    def parse(cls, text, class_=None):
+        """
+        Returns the filter written in text, eg. "Volume > 100 and No. of hits
+        < 50". Raises a ValueError if text isn't a valid filter.
+
+        Args:
+            class_: If given, every attribute of the filter must apply to
+            instances of class_ (eg. Frame or Cluster)
+        """
+        predicates = []
+        if text.strip():
+            for term in _AND.split(text.strip()):
+                match = _PREDICATE.match(term)
+                if not match:
+                    raise ValueError("Couldn't understand the filter term: %s" % term)
+                name, operator, value = match.groups()
+                try:
+                    value = float(value)
+                except ValueError:
+                    raise ValueError("Not a number: %s" % value)
+                predicate = Predicate(name, operator, value)
+                if class_ is not None and not issubclass(class_, predicate.class_):
+                    raise ValueError("%s is not an attribute of a %s" % (name, class_.__name__))
+                predicates.append(predicate)
+        return cls(predicates)
+
+    def __call__(self, obj):
+        """
+        Returns True if obj satisfies every predicate of the filter.
+        """
+        for predicate in self.predicates:
+            if not predicate(obj):
+                return False
+        return True
+
+    def __len__(self):
+        return len(self.predicates)
+
+    def __str__(self):
+        return " and ".join(str(predicate) for predicate in self.predicates)
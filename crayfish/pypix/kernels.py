@@ -0,0 +1,300 @@
+"""
+The inner loops of clustering, neighbour counting, the radius of clusters and
+nearest neighbour classification, behind a stable interface with
+interchangeable implementations (backends):
+
+    numba: Loops compiled with Numba, if it is installed
+
+    numpy: Vectorised with numpy
+
+    python: Plain Python loops
+
+Every backend gives identical results (floating point sums are made in the
+same order), and a kernel that a backend doesn't implement falls back to the
+next backend in BACKENDS, eg. the numpy backend labels clusters with the
+Python flood fill as there is no vectorised equivalent.
+
+The first available backend is used unless the CRAYFISH_KERNELS environment
+variable names another (if it names one that isn't available, a warning is
+given and the first available is used instead), and the backend may be
+changed at runtime with use.
+Numba compiles each kernel the first time it is called, and caches the
+compiled code on disk for later sessions when the module is imported as
+pypix.kernels.
+"""
+import os
+import warnings
+
+import numpy
+
+try:
+    import numba
+except ImportError:
+    numba = None
+
+import morphology
+
+# The backends, in order of preference
+BACKENDS = ["numba", "numpy", "python"]
+
+# Numba's cache is named after this file but refers to the module by name, so
+# it is only used under the name the application imports it by; run from the
+# pypix folder (eg. by test_pypix.py) the module is imported as kernels
+CACHE = __name__ == "pypix.kernels"
+
+def available():
+    """
+    Returns the names of the backends that can be used, in order of
+    preference.
+    """
+    return [name for name in BACKENDS if _implementations[name] is not None]
+
+def use(backend=None):
+    """
+    Selects the backend whose kernels are used.
+
+    Args:
+        backend: The name of the backend, or None for the one named by the
+        CRAYFISH_KERNELS environment variable or, if that isn't set or names
+        a backend that isn't available (which gives a warning), the first
+        available
+
+    Raises a ValueError if the backend named isn't available.
+    """
+    global _backend, _kernels
+    if backend is None:
+        backend = os.environ.get("CRAYFISH_KERNELS") or available()[0]
+        if backend not in available():
+            warnings.warn("Kernel backend %s (set by CRAYFISH_KERNELS) isn't available, "
+                          "using %s" % (backend, available()[0]))
+            backend = available()[0]
+    if backend not in available():
+        raise ValueError("Kernel backend %s isn't available (available backends: %s)" %
+                         (backend, ", ".join(available())))
+    kernels = {}
+    # Fall back to the following backends for kernels the backend lacks
+    for name in reversed(BACKENDS[BACKENDS.index(backend):]):
+        kernels.update(_implementations[name] or {})
+    _backend, _kernels = backend, kernels
+
+def backend():
+    """
+    Returns the name of the backend in use.
+    """
+    return _backend
+
+# ============================== Interface ==============================
+
+def label(pixels):
+    """
+    Labels the 8-connected components of pixels.
+
+    Args:
+        pixels: A list of (x,y) tuples
+
+    Returns a list of the label of each pixel. Labels count up from 0 in order
+    of the first pixel of each component.
+    """
+    return _kernels["label"](pixels)
+
+def neighbour_counts(occupancy):
+    """
+    Returns an array (of dtype uint8) the same shape as the 2D boolean array
+    occupancy, where each element is the number of the 8 surrounding elements
+    that are occupied. Elements off the edge of the array count as unoccupied.
+    """
+    return _kernels["neighbour_counts"](occupancy)
+
+def max_square_distance(xs, ys, x, y):
+    """
+    Returns the greatest square distance of the pixels whose co-ordinates are
+    in the arrays xs and ys from the point (x,y). Raises a ValueError if there
+    are no pixels.
+    """
+    if not len(xs):
+        raise ValueError("No pixels to find the distance of")
+    return _kernels["max_square_distance"](xs, ys, x, y)
+
+def square_distances(points, others):
+    """
+    Returns an array of the square distance of each row of the 2D array
+    points from each row of the 2D array others, indexed as [point, other].
+    """
+    return _kernels["square_distances"](points, others)
+
+# ================================ Python ================================
+
+def _python_neighbour_counts(occupancy):
+    occupancy = numpy.asarray(occupancy, dtype=bool)
+    height, width = occupancy.shape
+    counts = [[0] * width for y in range(height)]
+    for y, row in enumerate(occupancy.tolist()):
+        for x, occupied in enumerate(row):
+            if not occupied:
+                continue
+            for dx, dy in morphology.NEIGHBOUR_OFFSETS:
+                if 0 <= y + dy < height and 0 <= x + dx < width:
+                    counts[y + dy][x + dx] += 1
+    return numpy.array(counts, dtype=numpy.uint8).reshape(height, width)
+
+def _python_max_square_distance(xs, ys, x, y):
+    return max([(pixel_x - x) * (pixel_x - x) + (pixel_y - y) * (pixel_y - y)
+                for pixel_x, pixel_y in zip(numpy.asarray(xs, dtype=float).tolist(),
+                                            numpy.asarray(ys, dtype=float).tolist())])
+
+def _python_square_distances(points, others):
+    points = numpy.asarray(points, dtype=float)
+    others = numpy.asarray(others, dtype=float)
+    distances = []
+    for point in points.tolist():
+        row = []
+        for other in others.tolist():
+            total = 0.0
+            for a, b in zip(point, other):
+                difference = b - a
+                total += difference * difference
+            row.append(total)
+        distances.append(row)
+    return numpy.array(distances, dtype=float).reshape(len(points), len(others))
+
+# ================================ numpy =================================
+
+def _numpy_max_square_distance(xs, ys, x, y):
+    xs = numpy.asarray(xs, dtype=float)
+    ys = numpy.asarray(ys, dtype=float)
+    return float(((xs - x)**2 + (ys - y)**2).max())
+
+def _numpy_square_distances(points, others):
+    points = numpy.asarray(points, dtype=float)
+    others = numpy.asarray(others, dtype=float)
+    distances = numpy.zeros((len(points), len(others)))
+    # Sum the squared differences one dimension at a time, in the same order
+    # as the other backends
+    for column in range(points.shape[1]):
+        distances += (others[:, column] - points[:, column, numpy.newaxis])**2
+    return distances
+
+# ================================ Numba =================================
+
+# The loops compiled by Numba, which are written for it rather than to be
+# run by the Python interpreter
+
+def _label_loops(xs, ys):
+    count = xs.shape[0]
+    labels = numpy.empty(count, numpy.int64)
+    labels[:] = -1
+    if count == 0:
+        return labels
+    min_x, max_x, min_y, max_y = xs[0], xs[0], ys[0], ys[0]
+    for i in range(count):
+        min_x, max_x = min(min_x, xs[i]), max(max_x, xs[i])
+        min_y, max_y = min(min_y, ys[i]), max(max_y, ys[i])
+    # The index of the pixel at each point of the pixels' bounding box plus
+    # a one pixel border, or -1
+    index = numpy.empty((max_y - min_y + 3, max_x - min_x + 3), numpy.int64)
+    index[:, :] = -1
+    for i in range(count):
+        index[ys[i] - min_y + 1, xs[i] - min_x + 1] = i
+    to_inspect = numpy.empty(count, numpy.int64)
+    next_label = 0
+    for i in range(count):
+        if labels[i] != -1:
+            continue
+        labels[i] = next_label
+        to_inspect[0] = i
+        pending = 1
+        while pending:
+            pending -= 1
+            j = to_inspect[pending]
+            x, y = xs[j] - min_x + 1, ys[j] - min_y + 1
+            for dy in range(-1, 2):
+                for dx in range(-1, 2):
+                    k = index[y + dy, x + dx]
+                    if k != -1 and labels[k] == -1:
+                        labels[k] = next_label
+                        to_inspect[pending] = k
+                        pending += 1
+        next_label += 1
+    return labels
+
+def _neighbour_counts_loops(occupancy):
+    height, width = occupancy.shape
+    counts = numpy.zeros((height, width), numpy.uint8)
+    for y in range(height):
+        for x in range(width):
+            if not occupancy[y, x]:
+                continue
+            for dy in range(-1, 2):
+                for dx in range(-1, 2):
+                    if ((dx != 0 or dy != 0) and 0 <= y + dy < height and
+                            0 <= x + dx < width):
+                        counts[y + dy, x + dx] += 1
+    return counts
+
+def _max_square_distance_loops(xs, ys, x, y):
+    greatest = 0.0
+    for i in range(xs.shape[0]):
+        dx, dy = xs[i] - x, ys[i] - y
+        square_distance = dx * dx + dy * dy
+        if i == 0 or square_distance > greatest:
+            greatest = square_distance
+    return greatest
+
+def _square_distances_loops(points, others):
+    distances = numpy.zeros((points.shape[0], others.shape[0]))
+    for i in range(points.shape[0]):
+        for j in range(others.shape[0]):
+            total = 0.0
+            for column in range(points.shape[1]):
+                difference = others[j, column] - points[i, column]
+                total += difference * difference
+            distances[i, j] = total
+    return distances
+
+def _numba_implementations():
+    """
+    Returns the kernels of the numba backend, which convert their arguments
+    to the types the loops are compiled for.
+    """
+    label_loops = numba.njit(cache=CACHE)(_label_loops)
+    neighbour_counts_loops = numba.njit(cache=CACHE)(_neighbour_counts_loops)
+    max_square_distance_loops = numba.njit(cache=CACHE)(_max_square_distance_loops)
+    square_distances_loops = numba.njit(cache=CACHE)(_square_distances_loops)
+
+    def numba_label(pixels):
+        coords = numpy.array(pixels, dtype=numpy.int64).reshape(-1, 2)
+        return label_loops(numpy.ascontiguousarray(coords[:, 0]),
+                           numpy.ascontiguousarray(coords[:, 1])).tolist()
+
+    def numba_neighbour_counts(occupancy):
+        return neighbour_counts_loops(numpy.ascontiguousarray(occupancy, dtype=numpy.bool_))
+
+    def numba_max_square_distance(xs, ys, x, y):
+        return float(max_square_distance_loops(numpy.asarray(xs, dtype=numpy.float64),
+                                               numpy.asarray(ys, dtype=numpy.float64),
+                                               float(x), float(y)))
+
+    def numba_square_distances(points, others):
+        return square_distances_loops(numpy.ascontiguousarray(points, dtype=numpy.float64),
+                                      numpy.ascontiguousarray(others, dtype=numpy.float64))
+
+    return {"label": numba_label,
+            "neighbour_counts": numba_neighbour_counts,
+            "max_square_distance": numba_max_square_distance,
+            "square_distances": numba_square_distances}
+
+# The kernels implemented by each backend, or None if it isn't available
+_implementations = {
+    "python": {"label": morphology.label,
+               "neighbour_counts": _python_neighbour_counts,
+               "max_square_distance": _python_max_square_distance,
+               "square_distances": _python_square_distances},
+    "numpy": {"neighbour_counts": morphology.neighbour_counts,
+              "max_square_distance": _numpy_max_square_distance,
+              "square_distances": _numpy_square_distances},
+    "numba": _numba_implementations() if numba is not None else None,
+}
+
+_backend = None
+_kernels = None
+use()
@@ -0,0 +1,144 @@
+"""
+Masks of hot and noisy pixels.
+
+Hot pixels fire in almost every frame, whether or not a particle passed
+through them, so they glue real tracks into large spurious clusters. A mask
+is found from the per-pixel statistics of many frames (see from_statistics
+and folder.FolderNode.calculate_mask), saved to a mask file and then removes
+its pixels from every frame as it is read (see pypix.Frame.from_file), before
+the frame is clustered.
+
+A mask file lists a masked pixel per line, in the same form as the pixels of
+an lsc file, and may contain "//" comment lines::
+
+    // Crayfish pixel mask
+    12,200
+    255,3
+
+"""
+import hashlib
+
+import numpy
+
+# A pixel hit in more than this fraction of frames is hot
+MAX_FREQUENCY = 0.5
+
+class Mask(object):
+    """
+    A set of masked (x,y) pixels.
+
+    Args:
+        pixels: The masked pixels
+    """
+    def __init__(self, pixels=()):
+        self.version = 0
+        self.set_pixels(pixels)
+
+    def set_pixels(self, pixels):
+        """
+        Replaces the masked pixels with pixels. The mask is modified in place
+        so that existing references to it (eg. pypix.pixel_mask) see the new
+        pixels, and its version is incremented so that anything calculated
+        with the old pixels can be recalculated.
+        """
+        self.pixels = frozenset((int(x), int(y)) for x, y in pixels)
+        self.version += 1
+
+    def clear(self):
+        """
+        Unmasks every pixel.
+        """
+        self.set_pixels(())
+
+    def load(self, path):
+        """
+        Replaces the masked pixels with those in the mask file at path (see
+        the module docstring for its format).
+        """
+        pixels = []
+        with open(path) as f:
+            for line in f:
+                line = line.strip()
+                if not line or line[:2] == "//":
+                    continue
+                x, y = line.split(",")
+                pixels.append((int(x), int(y)))
+        self.set_pixels(pixels)
+
+    def save(self, path):
+        """
+        Writes the mask to a mask file at path.
+        """
+        with open(path, "w") as f:
+            f.write("// Crayfish pixel mask\n")
+            for x, y in sorted(self.pixels):
+                f.write("%d,%d\n" % (x, y))
+
+    def digest(self):
+        """
+        Returns a SHA1 digest identifying the masked pixels.
+        """
+        return hashlib.sha1(",".join("%d:%d" % pixel for pixel in sorted(self.pixels))).hexdigest()
+
+    def apply(self, grid):
+        """
+        Removes the masked pixels from grid (eg. a pypix.Frame), returning the
+        number of pixels removed.
+
+        The masked pixels present are found by looking up whichever of the
+        mask and the grid's pixels is smaller in the other, so masking costs
+        little more than a lookup per masked pixel.
+        """
+        if len(self.pixels) < len(grid):
+            masked = [pixel for pixel in self.pixels if pixel in grid]
+        else:
+            masked = self.pixels.intersection(grid)
+        for pixel in masked:
+            del grid[pixel]
+        return len(masked)
+
+    @classmethod
+    def from_statistics(cls, frames, xs, ys, frequencies, counts, max_frequency=MAX_FREQUENCY,
+                        max_mean_count=None):
+        """
+        Returns the mask of the hot and noisy pixels found from the per-pixel
+        statistics of a number of frames.
+
+        Args:
+            frames: The number of frames the statistics were gathered from
+
+            xs, ys: Arrays of the co-ordinates of every pixel hit in the frames
+
+            frequencies: An array of the number of frames each pixel was hit in
+
+            counts: An array of the summed counts of each pixel
+
+            max_frequency: Pixels hit in more than this fraction of the frames
+            are masked
+
+            max_mean_count: If given, pixels whose mean count (per frame they
+            were hit in) is more than this are also masked
+        """
+        if not frames:
+            return cls()
+        frequencies = numpy.asarray(frequencies, dtype=float)
+        masked = frequencies > max_frequency * frames
+        if max_mean_count is not None:
+            hit = frequencies > 0
+            mean_counts = numpy.zeros(len(frequencies))
+            mean_counts[hit] = numpy.asarray(counts, dtype=float)[hit] / frequencies[hit]
+            masked |= mean_counts > max_mean_count
+        return cls(zip(numpy.asarray(xs)[masked].tolist(), numpy.asarray(ys)[masked].tolist()))
+
+    def __len__(self):
+        return len(self.pixels)
+
+    def __iter__(self):
+        return iter(self.pixels)
+
+    def __contains__(self, pixel):
+        return pixel in self.pixels
+
+# The mask applied to frames as they are read, which is empty unless a mask
+# has been loaded
+pixel_mask = Mask()
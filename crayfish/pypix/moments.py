@@ -0,0 +1,228 @@
+"""
+The raw moments of the hits of clusters, up to second order, from which the
+centre, second-moment ellipse and shape of a cluster are derived.
+
+The six raw moments (the sums of 1, x, y, x^2, xy and y^2 over the hits) are
+accumulated for every hit at once, both unweighted, which describe the shape
+of the cluster, and weighted by count, which describe where the charge was
+deposited (eg. the centre of mass). They are calculated in a single pass,
+either for one cluster (from_hits, see pypix.Cluster.moments) or for all of
+the clusters of a frame at once from the label of each hit (from_labels, see
+pypix.Frame.calculate_moments), and shared by every attribute derived from
+them.
+
+The derived quantities are those of the ellipse with the same second moments
+as the hits. Its axes are along the eigenvectors of the covariance of the
+hits, and a straight track of N pixels along either axis has length N.
+"""
+import numpy
+
+# The raw moments, and the powers of (x, y) summed by each
+SUMS = ["m00", "m10", "m01", "m20", "m11", "m02"]
+POWERS = [(0, 0), (1, 0), (0, 1), (2, 0), (1, 1), (0, 2)]
+
+def _powers(xs, ys):
+    """
+    Returns a 6 x len(xs) array of the powers of each hit's co-ordinates, in
+    the order of POWERS.
+    """
+    xs = numpy.asarray(xs, dtype=float)
+    ys = numpy.asarray(ys, dtype=float)
+    return numpy.vstack([numpy.ones(len(xs)), xs, ys, xs * xs, xs * ys, ys * ys])
+
+def from_hits(xs, ys, counts):
+    """
+    Returns a tuple (shape, mass) of the unweighted and count weighted
+    Moments of a cluster, given as arrays of the co-ordinates and counts of
+    its hits.
+    """
+    weights = numpy.vstack([numpy.ones(len(counts)), numpy.asarray(counts, dtype=float)])
+    sums = numpy.dot(_powers(xs, ys), weights.T)
+    return Moments(*sums[:, 0].tolist()), Moments(*sums[:, 1].tolist())
+
+def from_labels(labels, xs, ys, counts, clusters=None):
+    """
+    Returns a tuple (shape, mass) of the unweighted and count weighted
+    Moments of many clusters at once, whose elements are arrays holding the
+    moments of each cluster.
+
+    Args:
+        labels: An array of the index of the cluster of each hit
+
+        xs, ys, counts: Arrays of the co-ordinates and counts of the hits
+
+        clusters: The number of clusters, if some have no hits
+    """
+    labels = numpy.asarray(labels, dtype=int)
+    clusters = max(clusters or 0, labels.max() + 1 if len(labels) else 0)
+    counts = numpy.asarray(counts, dtype=float)
+    powers = _powers(xs, ys)
+    shape = [numpy.bincount(labels, power, clusters) for power in powers]
+    mass = [numpy.bincount(labels, power * counts, clusters) for power in powers]
+    return Moments(*shape), Moments(*mass)
+
+class Moments(object):
+    """
+    The raw moments of the hits of a cluster, or arrays of the moments of
+    many clusters, in which case the derived quantities are arrays too.
+
+    The derived quantities are all calculated together the first time one is
+    needed, and those of many clusters are calculated for all of them at once
+    before they are split, so looking them up for a single cluster is cheap.
+
+    Args:
+        m00, m10, m01, m20, m11, m02: The sum of x^i * y^j (times the count,
+        for count weighted moments) over the hits, for each mij
+    """
+    __slots__ = SUMS + ["_derived"]
+
+    def __init__(self, m00=0.0, m10=0.0, m01=0.0, m20=0.0, m11=0.0, m02=0.0):
+        self.m00 = m00
+        self.m10 = m10
+        self.m01 = m01
+        self.m20 = m20
+        self.m11 = m11
+        self.m02 = m02
+        # A dictionary of the derived quantities, see _derive
+        self._derived = None
+
+    def _derive(self):
+        """
+        Calculates the derived quantities, returning the dictionary of them.
+        """
+        if self._derived is not None:
+            return self._derived
+        with numpy.errstate(divide="ignore", invalid="ignore"):
+            x = numpy.true_divide(self.m10, self.m00)
+            y = numpy.true_divide(self.m01, self.m00)
+            # Rounding may leave the variance of a single row or column of
+            # hits slightly negative
+            var_x = numpy.maximum(numpy.true_divide(self.m20, self.m00) - x * x, 0)
+            cov_xy = numpy.true_divide(self.m11, self.m00) - x * y
+            var_y = numpy.maximum(numpy.true_divide(self.m02, self.m00) - y * y, 0)
+            mean = (var_x + var_y) / 2.0
+            spread = numpy.sqrt(((var_x - var_y) / 2.0)**2 + cov_xy**2)
+            major, minor = mean + spread, numpy.maximum(mean - spread, 0)
+            length = numpy.sqrt(12 * major + 1)
+            width = numpy.sqrt(12 * minor + 1)
+            self._derived = {
+                "x": x, "y": y, "var_x": var_x, "cov_xy": cov_xy, "var_y": var_y,
+                "major": major, "minor": minor,
+                "major_axis": 4 * numpy.sqrt(major),
+                "minor_axis": 4 * numpy.sqrt(minor),
+                "orientation": numpy.degrees(0.5 * numpy.arctan2(2 * cov_xy, var_x - var_y)),
+                "eccentricity": numpy.where(major > 0, numpy.sqrt(1 - minor / major), 0.0),
+                "linearity": numpy.where(major > 0, (major - minor) / (major + minor), 0.0),
+                "length": length,
+                "width": width,
+                "density": self.m00 / (length * width),
+            }
+        return self._derived
+
+    def split(self):
+        """
+        Returns a list of the Moments of each cluster of moments of many
+        clusters.
+        """
+        derived = self._derive()
+        names = sorted(derived)
+        columns = [getattr(self, name).tolist() for name in SUMS]
+        derived_columns = [numpy.asarray(derived[name]).tolist() for name in names]
+        parts = []
+        for sums, values in zip(zip(*columns), zip(*derived_columns)):
+            moments = Moments(*sums)
+            moments._derived = dict(zip(names, values))
+            parts.append(moments)
+        return parts
+
+    def __len__(self):
+        return len(self.m00)
+
+    @property
+    def centre(self):
+        """
+        The mean (x,y) of the hits.
+        """
+        derived = self._derive()
+        return derived["x"], derived["y"]
+
+    @property
+    def covariance(self):
+        """
+        A tuple (var_x, cov_xy, var_y) of the central second moments of the
+        hits, divided by m00.
+        """
+        derived = self._derive()
+        return derived["var_x"], derived["cov_xy"], derived["var_y"]
+
+    @property
+    def eigenvalues(self):
+        """
+        A tuple (major, minor) of the variances of the hits along the major
+        and minor axes of the ellipse.
+        """
+        derived = self._derive()
+        return derived["major"], derived["minor"]
+
+    @property
+    def major_axis(self):
+        """
+        The length of the major axis of the ellipse, 4 standard deviations.
+        """
+        return self._derive()["major_axis"]
+
+    @property
+    def minor_axis(self):
+        """
+        The length of the minor axis of the ellipse, 4 standard deviations.
+        """
+        return self._derive()["minor_axis"]
+
+    @property
+    def orientation(self):
+        """
+        The angle of the major axis of the ellipse from the x axis, in
+        degrees between -90 and 90.
+        """
+        return self._derive()["orientation"]
+
+    @property
+    def eccentricity(self):
+        """
+        The eccentricity of the ellipse, 0 for a circle and approaching 1 for
+        a line.
+        """
+        return self._derive()["eccentricity"]
+
+    @property
+    def linearity(self):
+        """
+        How much more the hits spread along the major axis than the minor
+        axis, (major - minor) / (major + minor) of the eigenvalues: 0 for a
+        round cluster and 1 for a straight line.
+        """
+        return self._derive()["linearity"]
+
+    @property
+    def length(self):
+        """
+        The length of the hits along the major axis, that of the uniform line
+        with the same variance, which is N for a straight track of N pixels.
+        """
+        return self._derive()["length"]
+
+    @property
+    def width(self):
+        """
+        The width of the hits across the major axis, as length.
+        """
+        return self._derive()["width"]
+
+    @property
+    def density(self):
+        """
+        The fraction of the length x width rectangle of the hits that is hit,
+        1 for a solid rectangle or straight track and less for sparse or
+        curved clusters.
+        """
+        return self._derive()["density"]
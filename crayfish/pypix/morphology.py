@@ -0,0 +1,153 @@
+"""
+Vectorised kernels that operate on whole 2D occupancy arrays at once, for use
+by PixelGrid methods and attributes that look at the neighbourhood of pixels.
+
+An occupancy array is a 2D boolean numpy array indexed as occupancy[y][x],
+which is True where there is a hit, eg. ``grid.render_energy() != 0``.
+
+Also contains the connected component labelling used to find clusters, which
+works on lists of hit pixels rather than dense arrays so that its cost is
+proportional to the number of hits rather than the size of the sensor. Large
+sensors (eg. quad Timepix assemblies and mosaics of chips) may be labelled in
+square tiles, optionally in parallel, with the labels of clusters that cross
+tile borders merged afterwards (see label_tiled).
+"""
+from multiprocessing import Pool
+
+import numpy
+
+# The (dx, dy) offsets of the 8 neighbours of a pixel
+NEIGHBOUR_OFFSETS = [(dx, dy) for dy in (-1, 0, 1) for dx in (-1, 0, 1)
+                     if (dx, dy) != (0, 0)]
+
+def neighbour_counts(occupancy):
+    """
+    Returns an array the same shape as occupancy where each element is the
+    number of the 8 surrounding elements that are occupied (not including the
+    element itself). Elements off the edge of the array count as unoccupied.
+
+    This is a 3x3 convolution with a kernel of ones and a zero centre,
+    implemented as the sum of 8 shifted views of a zero padded copy of the
+    array.
+    """
+    occupancy = numpy.asarray(occupancy, dtype=bool)
+    height, width = occupancy.shape
+    padded = numpy.zeros((height + 2, width + 2), dtype=numpy.uint8)
+    padded[1:-1, 1:-1] = occupancy
+    counts = numpy.zeros((height, width), dtype=numpy.uint8)
+    for dx, dy in NEIGHBOUR_OFFSETS:
+        counts += padded[1 + dy:1 + dy + height, 1 + dx:1 + dx + width]
+    return counts
+
+def label(pixels):
+    """
+    Labels the 8-connected components of pixels.
+
+    Args:
+        pixels: A list of (x,y) tuples
+
+    Returns a list of the label of each pixel. Labels count up from 0 in order
+    of the first pixel of each component.
+    """
+    index = dict((pixel, i) for i, pixel in enumerate(pixels))
+    labels = [-1] * len(pixels)
+    next_label = 0
+    for i, pixel in enumerate(pixels):
+        if labels[i] != -1:
+            continue
+        labels[i] = next_label
+        # An explicit stack rather than recursion, so that large components
+        # don't exceed Python's recursion limit
+        to_inspect = [pixel]
+        while to_inspect:
+            x, y = to_inspect.pop()
+            for dx, dy in NEIGHBOUR_OFFSETS:
+                j = index.get((x + dx, y + dy))
+                if j is not None and labels[j] == -1:
+                    labels[j] = next_label
+                    to_inspect.append(pixels[j])
+        next_label += 1
+    return labels
+
+def tiles(pixels, tile_size):
+    """
+    Returns a dictionary mapping the (column, row) of each square tile of
+    tile_size pixels that contains a pixel of pixels to the list of the
+    indices of its pixels. Tiles without pixels are left out.
+    """
+    tile_indices = {}
+    for i, (x, y) in enumerate(pixels):
+        tile_indices.setdefault((x // tile_size, y // tile_size), []).append(i)
+    return tile_indices
+
+def _find(parents, label):
+    """
+    Returns the root of label in the union-find forest parents, compressing
+    the path to it.
+    """
+    root = label
+    while parents[root] != root:
+        root = parents[root]
+    while parents[label] != root:
+        parents[label], label = root, parents[label]
+    return root
+
+def label_tiled(pixels, tile_size, processes=1):
+    """
+    Labels the 8-connected components of pixels as label, but labels each
+    tile of tile_size pixels separately and then merges the labels of
+    components that touch across tile borders.
+
+    Args:
+        pixels: A list of (x,y) tuples
+
+        tile_size: The width and height of a tile, eg. the size of a chip
+
+        processes: The number of processes the tiles are labelled in. Only
+        worthwhile for frames of many hits, as the pixels of each tile must
+        be sent to a worker process.
+
+    Returns a list of the label of each pixel, the same as label(pixels).
+    """
+    tile_indices = tiles(pixels, tile_size)
+    keys = sorted(tile_indices)
+    tile_pixels = [[pixels[i] for i in tile_indices[key]] for key in keys]
+    if processes > 1 and len(keys) > 1:
+        pool = Pool(processes)
+        try:
+            tile_labels = pool.map(label, tile_pixels)
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        tile_labels = [label(pixels_) for pixels_ in tile_pixels]
+    # Give each tile's labels an offset so that they are unique over the
+    # whole frame
+    labels = [0] * len(pixels)
+    offset = 0
+    for key, local_labels in zip(keys, tile_labels):
+        for i, local_label in zip(tile_indices[key], local_labels):
+            labels[i] = offset + local_label
+        offset += max(local_labels) + 1
+    # Merge the labels of neighbouring pixels on either side of a tile
+    # border. Only pixels on the edge of a tile can have a neighbour in
+    # another tile.
+    parents = list(range(offset))
+    index = dict((pixel, i) for i, pixel in enumerate(pixels))
+    for i, (x, y) in enumerate(pixels):
+        if 0 < x % tile_size < tile_size - 1 and 0 < y % tile_size < tile_size - 1:
+            continue
+        tile = (x // tile_size, y // tile_size)
+        for dx, dy in NEIGHBOUR_OFFSETS:
+            neighbour = (x + dx, y + dy)
+            j = index.get(neighbour)
+            if j is not None and (neighbour[0] // tile_size, neighbour[1] // tile_size) != tile:
+                root_i, root_j = _find(parents, labels[i]), _find(parents, labels[j])
+                if root_i != root_j:
+                    parents[max(root_i, root_j)] = min(root_i, root_j)
+    # Number the merged components in order of their first pixel, as label
+    final_labels = {}
+    for i in range(len(pixels)):
+        root = _find(parents, labels[i])
+        labels[i] = final_labels.setdefault(root, len(final_labels))
+    return labels
@@ -9,8 +9,37 @@ Definitions:
 
     Count: A count is an integer corresponding to the value of a hit
 
+    ToA: The time of arrival of a hit, for detectors read out in ToA/ToT mode,
+    in which case the count is the time over threshold (see pypix/events.py)
+
 """
 from collections import OrderedDict
+import re
+import weakref
+
+import numpy
+
+from classes import class_registry, group_codes, UNCLASSIFIED, CODE_TYPE
+from mask import Mask, pixel_mask
+from calibration import Calibration, energy_calibration, ENERGY_TYPE
+import kernels
+import moments
+import morphology
+import timing
+
+# The dtypes of the packed hit arrays of a Cluster
+COORD_TYPE = numpy.int16
+COUNT_TYPE = numpy.int32
+# The width and height of a single Timepix chip. Frames from assemblies of
+# several chips (eg. 512x512 quads) are a whole number of chips in size.
+CHIP_SIZE = 256
+# An lsc header line giving the width or height of the frame, eg. "// width: 512"
+_LSC_DIMENSION = re.compile(r"^//\s*(width|height)\s*[:=]\s*(\d+)", re.IGNORECASE)
+# The dtype of the times of arrival of time-resolved hits
+TOA_TYPE = numpy.float64
+# Below this many hits, a cluster's summary statistics are quicker to
+# calculate in Python than with numpy
+SMALL_CLUSTER = 64
 
 class Hit(object):
     """
@@ -18,41 +47,46 @@ class Hit(object):
 
     value: The value of the pixel
     cluster: The cluster that the pixel belongs to
+    toa: The time of arrival of the hit, or None if it isn't known
+    energy: The calibrated energy of the hit in keV, or None if it isn't
+    known (see calibration.py)
     """
-    def __init__(self, value, cluster=None):
+    # A frame holds a Hit per hit pixel, so use slots rather than an instance
+    # dictionary to keep them small
+    __slots__ = ("value", "cluster", "toa", "energy")
+
+    def __init__(self, value, cluster=None, toa=None, energy=None):
         self.value = value
-        self.cluster = None
+        self.cluster = cluster
+        self.toa = toa
+        self.energy = energy
 
     # For debug purposes
     def __str__(self):
         return str(self.value)
 
-class PixelGrid(dict):
+class PixelGrid(object):
     """
     A base class that frame and cluster derive from. It contains methods
-    applicable to any grid of pixels. Optional data argument may be a
-    dictionary mapping (x,y) tuples to Hit objects
+    applicable to any grid of pixels, which present a mapping of (x,y) tuples
+    to Hit objects.
+
+    Subclasses store the hits (a Frame in a dictionary, a Cluster in arrays)
+    and provide hit_pixels, counts, hit_arrays, sum_of_counts, sum_of_squares
+    and bounding_box.
     """
-    # PixelGrid dictionary effectively implements a  sparse array. As most of
-    # the values of the 256*256 frame matrix will be 0, this greatly reduces
-    # the memory footprint of the programming, but does require slightly more
-    # processing to access each item in the array. If there is an attempt to
-    # retrieve a pixel co-ord that is not in the dictionary, the method
-    # __missing__ is called, which returns 0 if the pixel coords lie within the
-    # grid, or otherwise raise a KeyError.
-    def __init__(self, width, height, data=[]):
-        super(PixelGrid, self).__init__(data)
-        self.width = width
-        self.height = height
+    # No instance dictionary, so that the subclasses may use slots
+    __slots__ = ()
 
-    def __missing__(self, key):
-        # If we do not have an explicit Hit value for key (x,y), check to see
-        # if it appears i=within the grid. If so, return a Hit object with
-        # value 0
-        if self.in_grid(key):
-            return Hit(0)
-        else:
-            raise KeyError("Point outside of PixelGrid")
+    def _invalidate_caches(self):
+        """
+        Called whenever a pixel is added or removed, to discard any cached
+        values derived from the pixels.
+        """
+        self._neighbour_counts = None
+        # Attribute values calculated by attribute_value with cache=True,
+        # mapping attribute name to value
+        self.attribute_cache = None
 
     def in_grid(self, pixel):
         """
@@ -65,39 +99,49 @@ class PixelGrid(dict):
         x, y = pixel
         return 0 <= x < self.width and 0 <= y < self.height
 
-    @property
-    def hit_pixels(self):
-        """
-        Returns a list of the locations of pixels showing hits
-        """
-        return self.keys()
-
-    @property
-    def counts(self):
-        """
-        Returns a list of hit counts
-        """
-        return [pixel.value for pixel in self.values()]
-
     @property
     def min_x(self):
-        return min([pixel[0] for pixel in self.hit_pixels])
+        return self.bounding_box[0]
     @property
     def max_x(self):
-        return max([pixel[0] for pixel in self.hit_pixels])
+        return self.bounding_box[2]
     @property
     def min_y(self):
-        return min([pixel[1] for pixel in self.hit_pixels])
+        return self.bounding_box[1]
     @property
     def max_y(self):
-        return max([pixel[1] for pixel in self.hit_pixels])
+        return self.bounding_box[3]
+
+    @property
+    def neighbour_counts(self):
+        """
+        Returns a 2-element tuple. The first item is the (x,y) location of
+        element [0][0] of the second item, which is a 2D array of the number of
+        hit neighbours of every pixel in the bounding box of the hits plus a
+        one pixel border.
+
+        This is calculated for every pixel at once and cached, see
+        kernels.neighbour_counts.
+        """
+        if self._neighbour_counts is None:
+            min_x, min_y, max_x, max_y = self.bounding_box
+            origin = (min_x - 1, min_y - 1)
+            occupancy = self.render_energy_zoomed(min_x - 1, min_y - 1,
+                                                  max_x + 1, max_y + 1) != 0
+            self._neighbour_counts = (origin, kernels.neighbour_counts(occupancy))
+        return self._neighbour_counts
 
     def number_of_neighbours(self, pixel):
+        if not self:
+            return 0
+        (origin_x, origin_y), counts = self.neighbour_counts
         x, y = pixel
-        x_values = [x + offset for offset in [-1,0,1]]
-        y_values = [y + offset for offset in [-1,0,1]]
-        return sum([1 for i in x_values for j in y_values
-                if self.in_grid((i,j)) and (i,j) != pixel and self[i,j].value])
+        height, width = counts.shape
+        # Pixels outside of the map are too far away from any hit to have
+        # neighbours
+        if 0 <= x - origin_x < width and 0 <= y - origin_y < height:
+            return int(counts[y - origin_y, x - origin_x])
+        return 0
 
     def get_max_neighbours(self):
         """
@@ -105,57 +149,206 @@ class PixelGrid(dict):
         one particular pixel has, and the second item is a list of the (x,y)
         locations of every pixel that has this many neighbours
         """
-        neighbours = {}
-        for pixel in self.hit_pixels:
-            num_neighbours = self.number_of_neighbours(pixel)
-            if num_neighbours in neighbours:
-                neighbours[num_neighbours].append(pixel)
-            else:
-                neighbours[num_neighbours] = [pixel]
-        max_neighbours = max(neighbours)
-        return max_neighbours, neighbours[max_neighbours]
-
-        # ==Alternative Algorithm Implementation==
-        # neighbours = [(pixel, self.number_of_neighbours(pixel))
-        #         for pixel in self.hit_pixels]
-        # max_neighbours = max(neighbours, key = lambda x: x[1])[1]
-        # return max_neighbours, [pixel[0] for pixel in neighbours
-        #         if pixel[1] == max_neighbours]
+        (origin_x, origin_y), counts = self.neighbour_counts
+        xs, ys, hit_counts = self.hit_arrays()
+        hit_neighbours = counts[ys - origin_y, xs - origin_x]
+        max_neighbours = hit_neighbours.max()
+        return (int(max_neighbours),
+                [(int(xs[i]), int(ys[i])) for i in numpy.flatnonzero(hit_neighbours == max_neighbours)])
 
     def render_energy(self):
         """
         Renders a grid with each value corresponding to the ernergy of the
         relevant pixel.
+
+        Returns a 2D numpy array indexed as grid[y][x].
         """
-        grid = [[0]*self.width for _ in range(self.height)]
-        for pixel in self.hit_pixels:
-            x, y = pixel
-            grid[y][x] = self[pixel].value
+        grid = numpy.zeros((self.height, self.width), dtype=int)
+        xs, ys, counts = self.hit_arrays()
+        grid[ys, xs] = counts
         return grid
 
     def render_energy_zoomed(self, min_x = None, min_y = None, max_x = None, max_y = None):
         """
         Renders a clipped grid with each value corresponding to the energy of
         the relevant pixel.
+
+        Returns a 2D numpy array indexed as grid[y - min_y][x - min_x].
         """
-        if not min_x: min_x = self.min_x
-        if not max_x: max_x = self.max_x
-        if not min_y: min_y = self.min_y
-        if not max_y: max_y = self.max_y
-        return [[self[x,y].value
-                for x in range(min_x, max_x+1)] for y in range(min_y, max_y+1)]
+        if None in (min_x, min_y, max_x, max_y):
+            box_min_x, box_min_y, box_max_x, box_max_y = self.bounding_box
+            if min_x is None: min_x = box_min_x
+            if max_x is None: max_x = box_max_x
+            if min_y is None: min_y = box_min_y
+            if max_y is None: max_y = box_max_y
+        grid = numpy.zeros((max_y - min_y + 1, max_x - min_x + 1), dtype=int)
+        xs, ys, counts = self.hit_arrays()
+        # Only place the hits that fall inside the requested bounding box
+        inside = (xs >= min_x) & (xs <= max_x) & (ys >= min_y) & (ys <= max_y)
+        grid[ys[inside] - min_y, xs[inside] - min_x] = counts[inside]
+        return grid
 
 
-class Frame(PixelGrid):
+class Frame(PixelGrid, dict):
     """
-    A frame object corresponds to the data in a frame file.
+    A frame object corresponds to the data in a frame file. Optional data
+    argument may be a dictionary mapping (x,y) tuples to Hit objects.
     """
-    def __init__(self,width=256, height=256, data=[]):
-        super(Frame, self).__init__(width, height, data)
+    # The frame dictionary effectively implements a  sparse array. As most of
+    # the values of the frame matrix (256*256 per chip) will be 0, this greatly reduces
+    # the memory footprint of the programming, but does require slightly more
+    # processing to access each item in the array. If there is an attempt to
+    # retrieve a pixel co-ord that is not in the dictionary, the method
+    # __missing__ is called, which returns 0 if the pixel coords lie within the
+    # grid, or otherwise raise a KeyError.
+    #
+    # The bounding box, sum of counts and sum of squared counts are maintained
+    # as pixels are added and removed, so that they (and the attributes
+    # derived from them) are O(1) to read. They are only kept up to date for
+    # changes made through the dictionary interface, so a Hit's value should
+    # not be modified in place once it is in the grid; assign a new Hit
+    # instead.
+    #
+    # As the dictionary only holds hits, memory is proportional to the number
+    # of hits however large the sensor; only rendering allocates a dense
+    # array of the whole frame.
+    def __init__(self,width=CHIP_SIZE, height=CHIP_SIZE, data=[]):
+        dict.__init__(self)
+        self.width = width
+        self.height = height
+        self._sum_of_counts = 0
+        self._sum_of_squares = 0
+        # (min_x, min_y, max_x, max_y), or None if the grid is empty
+        self._bounds = None
+        # Set when a pixel is removed, as the bounds can then only be found by
+        # rescanning the grid
+        self._bounds_stale = False
+        self._neighbour_counts = None
+        self.attribute_cache = None
         self.clusters = []
+        # The per-pixel statistics of the frames an aggregate frame was made
+        # from (see statistics.py), None for other frames
+        self.pixel_statistics = None
+        self.update(data)
+
+    def __setitem__(self, pixel, hit):
+        old_hit = self.get(pixel)
+        if old_hit is not None:
+            self._sum_of_counts -= old_hit.value
+            self._sum_of_squares -= old_hit.value**2
+        dict.__setitem__(self, pixel, hit)
+        self._invalidate_caches()
+        self._sum_of_counts += hit.value
+        self._sum_of_squares += hit.value**2
+        if not self._bounds_stale:
+            x, y = pixel
+            if self._bounds is None:
+                self._bounds = (x, y, x, y)
+            else:
+                min_x, min_y, max_x, max_y = self._bounds
+                self._bounds = (min(min_x, x), min(min_y, y),
+                                max(max_x, x), max(max_y, y))
+
+    def __delitem__(self, pixel):
+        hit = dict.__getitem__(self, pixel)
+        dict.__delitem__(self, pixel)
+        self._invalidate_caches()
+        self._sum_of_counts -= hit.value
+        self._sum_of_squares -= hit.value**2
+        self._bounds_stale = True
+
+    def update(self, data):
+        """
+        Adds every (x,y): Hit item of data to the grid.
+        """
+        for pixel, hit in dict(data).items():
+            self[pixel] = hit
+
+    def pop(self, pixel, *default):
+        if pixel not in self and default:
+            return default[0]
+        hit = dict.__getitem__(self, pixel)
+        del self[pixel]
+        return hit
+
+    def clear(self):
+        dict.clear(self)
+        self._invalidate_caches()
+        self._sum_of_counts = 0
+        self._sum_of_squares = 0
+        self._bounds = None
+        self._bounds_stale = False
+
+    def __missing__(self, key):
+        # If we do not have an explicit Hit value for key (x,y), check to see
+        # if it appears i=within the grid. If so, return a Hit object with
+        # value 0
+        if self.in_grid(key):
+            return Hit(0)
+        else:
+            raise KeyError("Point outside of PixelGrid")
+
+    @property
+    def hit_pixels(self):
+        """
+        Returns a list of the locations of pixels showing hits
+        """
+        return self.keys()
+
+    @property
+    def counts(self):
+        """
+        Returns a list of hit counts
+        """
+        return [pixel.value for pixel in self.values()]
+
+    @property
+    def sum_of_counts(self):
+        """
+        Returns the sum of the hit counts.
+        """
+        return self._sum_of_counts
+
+    @property
+    def sum_of_squares(self):
+        """
+        Returns the sum of the squares of the hit counts.
+        """
+        return self._sum_of_squares
+
+    @property
+    def bounding_box(self):
+        """
+        Returns the bounding box of the hit pixels as a 4-element tuple
+        (min_x, min_y, max_x, max_y). Raises a ValueError if there are no hit
+        pixels.
+        """
+        if self._bounds_stale:
+            self._bounds_stale = False
+            self._bounds = None
+            if self:
+                xs, ys = zip(*self.hit_pixels)
+                self._bounds = (min(xs), min(ys), max(xs), max(ys))
+        if self._bounds is None:
+            raise ValueError("PixelGrid has no hit pixels")
+        return self._bounds
+
+    def hit_arrays(self):
+        """
+        Returns a 3-element tuple of numpy arrays (xs, ys, counts) holding the
+        x co-ordinate, y co-ordinate and count of every hit pixel, in the same
+        order as hit_pixels.
+        """
+        if not self:
+            empty = numpy.zeros(0, dtype=int)
+            return empty, empty, empty
+        xs, ys = numpy.array(self.hit_pixels, dtype=int).T
+        return xs, ys, numpy.array(self.counts, dtype=int)
 
     @staticmethod
-    def from_file(filepath, file_format = "lsc"):
+    @timing.timed("Frame.from_file")
+    def from_file(filepath, file_format = "lsc", width=None, height=None, mask=None,
+                  calibration=None):
         """
         Returns a new frame with data read from a file
 
@@ -163,73 +356,159 @@ class Frame(PixelGrid):
             filepath: the filepath of the file
             file_format: the format of the file
                 Either "lsc" or "ascii_matrix"
+            width, height, mask, calibration: see from_lines
+        """
+        if file_format not in ("lsc", "ascii_matrix"):
+            raise Exception("File format not supported: " + file_format)
+        with open(filepath) as f:
+            return Frame.from_lines(f, file_format, width, height, mask, calibration, filepath)
+
+    @staticmethod
+    def from_lines(lines, file_format="lsc", width=None, height=None, mask=None,
+                   calibration=None, name="<lines>"):
+        """
+        Returns a new frame with data parsed from the lines of a frame file,
+        eg. an open file or the lines of a member of an archive (see
+        archive.py in Crayfish).
+
+        Args:
+            lines: an iterable of the lines of the file
+            file_format: the format of the file
+                Either "lsc" or "ascii_matrix"
+            width, height: the dimensions of the frame. If None, they are
+                read from the "// width: ..." and "// height: ..." header
+                lines of an lsc file, or the size of the matrix of an
+                ascii_matrix file. Otherwise the hits are assumed to come from
+                an assembly of whole chips (see chip_dimension).
+            mask: a mask.Mask of hot pixels, which are removed from the frame
+                before it is used. Defaults to pixel_mask, which is empty
+                unless a mask has been loaded.
+            calibration: a calibration.Calibration used to set the energy of
+                every hit. Defaults to energy_calibration, which leaves the
+                hits uncalibrated unless a calibration has been loaded.
+            name: the name of the file, for error messages
         """
         if file_format == "lsc":
             frame = Frame()
-            with open(filepath) as f:
-                try:
-                    for line in f:
-                        if line[:2] == "//":
-                            continue
-                        pixel, count = line.strip().split()
-                        pixel = tuple([int(coord) for coord in pixel.split(",")])
-                        frame[pixel] = Hit(int(count))
-                except:
-                    raise  Exception("Could not read \"" + filepath  + "\" as an lsc file"
-                           + "\n Please check the formatting.")
+            header = {}
+            try:
+                for line in lines:
+                    if line[:2] == "//":
+                        match = _LSC_DIMENSION.match(line)
+                        if match:
+                            header[match.group(1).lower()] = int(match.group(2))
+                        continue
+                    pixel, count = line.strip().split()
+                    pixel = tuple([int(coord) for coord in pixel.split(",")])
+                    frame[pixel] = Hit(int(count))
+            except:
+                raise  Exception("Could not read \"" + name  + "\" as an lsc file"
+                       + "\n Please check the formatting.")
+            if width is None:
+                width = header.get("width") or chip_dimension(frame.max_x + 1 if frame else 0)
+            if height is None:
+                height = header.get("height") or chip_dimension(frame.max_y + 1 if frame else 0)
         elif file_format == "ascii_matrix":
             frame = Frame()
-            with open(filepath) as f:
-                try:
-                    for y, line in enumerate(f):
-                        for x, count in enumerate(line.strip().split(" ")):
-                            if int(count):
-                                frame[(int(x), int(y))] = Hit(int(count))
-                except:
-                    raise Exception("Could not read \"" + filepath + "\" as an ascii_matrix file"
-                            + "\n Please check the formatting.")
+            rows = columns = 0
+            try:
+                for y, line in enumerate(lines):
+                    counts = line.strip().split(" ")
+                    for x, count in enumerate(counts):
+                        if int(count):
+                            frame[(int(x), int(y))] = Hit(int(count))
+                    rows = y + 1
+                    columns = max(columns, len(counts))
+            except:
+                raise Exception("Could not read \"" + name + "\" as an ascii_matrix file"
+                        + "\n Please check the formatting.")
+            if width is None:
+                width = columns
+            if height is None:
+                height = rows
         else:
             raise Exception("File format not supported: " + file_format)
+        frame.width, frame.height = width, height
+        if frame and not (frame.in_grid(frame.bounding_box[:2]) and
+                          frame.in_grid(frame.bounding_box[2:])):
+            raise Exception("\"%s\" has hits outside of its %dx%d frame" % (name, width, height))
+        if mask is None:
+            mask = pixel_mask
+        if mask:
+            timing.count("pixels masked", mask.apply(frame))
+        if calibration is None:
+            calibration = energy_calibration
+        if calibration:
+            calibration.apply(frame)
+        timing.count("frames read")
+        timing.count("hits read", len(frame))
         return frame
 
-    def calculate_clusters(self):
+    @timing.timed("Frame.calculate_clusters")
+    def calculate_clusters(self, tile_size=None, processes=1):
         """
         Called to calculated clusters. This is an expensive operation that is
         cached, ie. calling this function will not recalculate clusters if they
         have already been calculated.
 
+        Clusters may span chip boundaries. By default they are found with a
+        single flood fill over the whole frame (see kernels.label).
+
+        Args:
+            tile_size: If given, the frame is labelled in square tiles of
+            tile_size pixels (eg. CHIP_SIZE) and clusters crossing the tile
+            borders are merged, see morphology.label_tiled. The clusters are
+            the same either way.
+
+            processes: The number of processes to label the tiles in
+
         Returns the list of clusters.
         """
         if not self.clusters:
             self.clusters = []
-            for pixel in self.hit_pixels:
-                if not self[pixel].cluster: # If pixel not already clustered
-                    new_cluster = Cluster(256, 256)
-                    self.clusters.append(new_cluster)
-                    new_cluster.add(pixel, self[pixel])
-                    self._add_neighbouring_pixels(pixel, new_cluster)
+            pixels = [pixel for pixel, hit in self.items() if hit.value != 0]
+            if tile_size is not None:
+                labels = morphology.label_tiled(pixels, tile_size, processes)
+            else:
+                labels = kernels.label(pixels)
+            self._build_clusters(pixels, labels)
+            timing.count("clusters found", len(self.clusters))
         return self.clusters
 
-    def _add_neighbouring_pixels(self, pixel, cluster):
+    def _build_clusters(self, pixels, labels):
         """
-        Adds all pixels neighbours of `pixel` to `cluster` if they are not already
-        clustered.
+        Builds the clusters of the frame from the label of each of pixels.
         """
-        x, y = pixel
-        x_values = [x + offset for offset in [-1,0,1]]
-        y_values = [y + offset for offset in [-1,0,1]]
-        new_pixels =  [(i, j) for i in x_values for j in y_values
-                if self.in_grid((i,j)) and self[(i,j)].value != 0
-            and not self[(i,j)].cluster]  # and  (i,j) != pixel 
-                                        # (Don't need to check as the current
-                                        # pixel will be already clustered)
-        # These for loops are done sequentially to prevent a hit from being added twice.
-        for new_pixel in new_pixels:
-            cluster.add(new_pixel, self[new_pixel])
-        for new_pixel in new_pixels:
-            # Recursively add the neighbours of the new pixel
-            self._add_neighbouring_pixels(new_pixel, cluster)
+        members = [[] for i in range(max(labels) + 1 if labels else 0)]
+        for pixel, label in zip(pixels, labels):
+            members[label].append(pixel)
+        for cluster_pixels in members:
+            new_cluster = Cluster(self.width, self.height, self)
+            xs, ys = zip(*cluster_pixels)
+            hits = [dict.__getitem__(self, pixel) for pixel in cluster_pixels]
+            for hit in hits:
+                hit.cluster = new_cluster
+            new_cluster.set_hits(xs, ys, [hit.value for hit in hits], _hit_channel(hits, "toa"),
+                                 _hit_channel(hits, "energy"))
+            self.clusters.append(new_cluster)
 
+    def calculate_moments(self):
+        """
+        Calculates the moments of every cluster of the frame that doesn't
+        have them cached, in one pass over all of their hits labelled by
+        cluster (see moments.from_labels) rather than a pass per cluster.
+        """
+        pending = [cluster for cluster in self.clusters if cluster._moments is None]
+        if not pending:
+            return
+        labels = numpy.repeat(numpy.arange(len(pending)), [len(cluster) for cluster in pending])
+        shape, mass = moments.from_labels(labels,
+                                          numpy.concatenate([cluster._xs for cluster in pending]),
+                                          numpy.concatenate([cluster._ys for cluster in pending]),
+                                          numpy.concatenate([cluster._counts for cluster in pending]),
+                                          len(pending))
+        for cluster, shape_moments, mass_moments in zip(pending, shape.split(), mass.split()):
+            cluster._moments = (shape_moments, mass_moments)
 
     def get_closest_cluster(self, point):
         """
@@ -250,8 +529,20 @@ class Frame(PixelGrid):
         """
         Outputs a training row for each manually classified cluster.
         """
-        return "\n".join([cluster.get_training_row() for cluster in self.clusters
-                        if cluster.manual_class != "Unclassified"])
+        classified = numpy.flatnonzero(
+                class_codes(self.clusters, "manual_class") != UNCLASSIFIED)
+        return "\n".join([self.clusters[i].get_training_row() for i in classified])
+
+    def class_counts(self, class_property="manual_class"):
+        """
+        Returns a dictionary mapping each registered class name to the number
+        of clusters of the frame in that class.
+
+        Args:
+            class_property: Either "manual_class" or "algorithm_class"
+        """
+        counts = class_registry.counts(class_codes(self.clusters, class_property))
+        return dict(zip(class_registry.names, counts.tolist()))
 
     def load_training_data(self, data):
         """
@@ -270,20 +561,356 @@ class Cluster(PixelGrid):
     A cluster object corresponds to one cluster. Its properties width and
     height are the same as its containing frame. To find the width and height
     of the cluster use cluster_width and cluster_height.
+
+    Aggregates may hold millions of hits, so rather than a dictionary of Hit
+    objects a cluster stores its hits as packed arrays of co-ordinates and
+    counts (see set_hits and hit_arrays), plus times of arrival for
+    time-resolved hits (see toas) and energies for calibrated hits (see
+    energies), along with a weak reference to the frame it was found in. It
+    presents the same mapping of (x,y) tuples to Hit objects as a frame, but
+    the Hits are created on access; to change a hit, assign a new Hit. Hits
+    are looked up by binary search of their sorted (flat) pixel indices, so
+    lookups don't need a dense grid of the cluster.
+
+    Args:
+        width, height: The dimensions of the frame
+
+        frame: The frame the cluster belongs to, if any
     """
-    def __init__(self, width, height):
-        super(Cluster, self).__init__(width, height)
-        self.manual_class = "Unclassified"
-        self.algorithm_class = "Unclassified"
+    __slots__ = ("width", "height", "_xs", "_ys", "_counts", "_toas", "_energies", "_frame",
+                 "_bounds", "_sums", "_moments", "_neighbour_counts", "_energy_patch",
+                 "_patch_origin", "_lookup", "manual_class_code", "algorithm_class_code",
+                 "indexed_attributes", "attribute_cache")
+
+    def __init__(self, width, height, frame=None):
+        self.width = width
+        self.height = height
+        self.frame = frame
+        empty = numpy.zeros(0, dtype=COORD_TYPE)
+        self.set_hits(empty, empty, numpy.zeros(0, dtype=COUNT_TYPE))
+        # Classes are stored as codes of pypix.class_registry, see
+        # manual_class and algorithm_class for the class names
+        self.manual_class_code = UNCLASSIFIED
+        self.algorithm_class_code = UNCLASSIFIED
+        self._patch_origin = None
+
+    @property
+    def frame(self):
+        """
+        The frame the cluster was found in, or None if it isn't known or no
+        longer exists. Only a weak reference is held, so that clusters kept
+        (eg. in an aggregate) don't keep their whole frames alive.
+        """
+        return self._frame() if self._frame is not None else None
+
+    @frame.setter
+    def frame(self, frame):
+        self._frame = weakref.ref(frame) if frame is not None else None
+
+    def set_hits(self, xs, ys, counts, toas=None, energies=None):
+        """
+        Replaces the hits of the cluster.
+
+        Args:
+            xs, ys, counts: Sequences of the x co-ordinate, y co-ordinate and
+            count of each hit
+
+            toas: A sequence of the time of arrival of each hit, or None if
+            the hits aren't time-resolved
+
+            energies: A sequence of the calibrated energy of each hit, or None
+            if the hits aren't calibrated
+        """
+        self._xs = numpy.asarray(xs, dtype=COORD_TYPE)
+        self._ys = numpy.asarray(ys, dtype=COORD_TYPE)
+        self._counts = numpy.asarray(counts, dtype=COUNT_TYPE)
+        self._toas = numpy.asarray(toas, dtype=TOA_TYPE) if toas is not None else None
+        self._energies = (numpy.asarray(energies, dtype=ENERGY_TYPE)
+                          if energies is not None else None)
+        self._invalidate_caches()
+
+    def _invalidate_caches(self):
+        super(Cluster, self)._invalidate_caches()
+        self._bounds = None
+        self._sums = None
+        self._moments = None
+        self._energy_patch = None
+        self._lookup = None
+        # Attribute values read from a dataset index (see dataset.py) rather
+        # than calculated, mapping attribute name to value
+        self.indexed_attributes = None
+
+    def _index(self, pixel):
+        """
+        Returns the index of pixel in the hit arrays, or None if it isn't a
+        hit, found by binary search of the hits' flat pixel indices
+        (y*width + x), which are sorted and cached on the first lookup.
+        """
+        x, y = pixel
+        if not (0 <= x < self.width and 0 <= y < self.height) or not len(self._xs):
+            return None
+        if self._lookup is None:
+            keys = self._ys.astype(numpy.int64) * self.width + self._xs
+            order = numpy.argsort(keys, kind="mergesort")
+            self._lookup = (keys[order], order)
+        keys, order = self._lookup
+        key = y * self.width + x
+        i = int(keys.searchsorted(key))
+        if i < len(keys) and keys[i] == key:
+            return int(order[i])
+        return None
+
+    def _value(self, pixel):
+        """
+        Returns the count at pixel, or 0 if it isn't a hit.
+        """
+        index = self._index(pixel)
+        return int(self._counts[index]) if index is not None else 0
+
+    def __len__(self):
+        return len(self._xs)
+
+    def __iter__(self):
+        return iter(self.hit_pixels)
+
+    def __contains__(self, pixel):
+        return self._value(pixel) != 0
+
+    def _hit(self, pixel, value):
+        """
+        Returns a Hit of value at pixel, with its time of arrival and energy
+        if they are known.
+        """
+        if self._toas is None and self._energies is None:
+            return Hit(value, self)
+        index = self._index(pixel)
+        return Hit(value, self, *[float(channel[index])
+                                  if channel is not None and index is not None else None
+                                  for channel in (self._toas, self._energies)])
+
+    def __getitem__(self, pixel):
+        if not self.in_grid(pixel):
+            raise KeyError("Point outside of PixelGrid")
+        value = self._value(pixel)
+        if not value:
+            return Hit(0)
+        return self._hit(pixel, value)
+
+    def get(self, pixel, default=None):
+        value = self._value(pixel)
+        return self._hit(pixel, value) if value else default
+
+    def __setitem__(self, pixel, hit):
+        # The time of arrival and energy channels, with the values of hit
+        channels = [(self._toas, hit.toa), (self._energies, hit.energy)]
+        index = self._index(pixel)
+        if index is None:
+            x, y = pixel
+            self.set_hits(numpy.append(self._xs, x), numpy.append(self._ys, y),
+                          numpy.append(self._counts, hit.value),
+                          *[numpy.append(channel, value if value is not None else numpy.nan)
+                            if channel is not None else None for channel, value in channels])
+        else:
+            counts = self._counts.copy()
+            counts[index] = hit.value
+            replaced = []
+            for channel, value in channels:
+                if channel is not None:
+                    channel = channel.copy()
+                    channel[index] = value if value is not None else numpy.nan
+                replaced.append(channel)
+            self.set_hits(self._xs, self._ys, counts, *replaced)
+
+    def __delitem__(self, pixel):
+        index = self._index(pixel)
+        if index is None:
+            raise KeyError(pixel)
+        self.set_hits(numpy.delete(self._xs, index), numpy.delete(self._ys, index),
+                      numpy.delete(self._counts, index),
+                      *[numpy.delete(channel, index) if channel is not None else None
+                        for channel in (self._toas, self._energies)])
+
+    def keys(self):
+        return self.hit_pixels
+
+    def values(self):
+        if self._toas is None and self._energies is None:
+            return [Hit(count, self) for count in self.counts]
+        toas, energies = [channel.tolist() if channel is not None else [None] * len(self)
+                          for channel in (self._toas, self._energies)]
+        return [Hit(count, self, toa, energy)
+                for count, toa, energy in zip(self.counts, toas, energies)]
+
+    def items(self):
+        return zip(self.hit_pixels, self.values())
 
     def add(self, pixel, hit):
         """
         Adds hit to the cluster at pixel, and sets the cluster property of the hit to
         this cluster.
+
+        This copies the hit arrays, so to build a cluster from many hits use
+        set_hits.
         """
         hit.cluster = self
         self[pixel] = hit
 
+    @property
+    def hit_pixels(self):
+        """
+        Returns a list of the locations of pixels showing hits
+        """
+        return zip(self._xs.tolist(), self._ys.tolist())
+
+    @property
+    def counts(self):
+        """
+        Returns a list of hit counts
+        """
+        return self._counts.tolist()
+
+    def hit_arrays(self):
+        """
+        Returns a 3-element tuple of numpy arrays (xs, ys, counts) holding the
+        x co-ordinate, y co-ordinate and count of every hit pixel, in the same
+        order as hit_pixels.
+        """
+        return self._xs.astype(int), self._ys.astype(int), self._counts.astype(int)
+
+    @property
+    def toas(self):
+        """
+        Returns a numpy array of the time of arrival of every hit, in the same
+        order as hit_pixels, or None if the hits aren't time-resolved.
+        """
+        return self._toas
+
+    @property
+    def energies(self):
+        """
+        Returns a numpy array of the calibrated energy of every hit, in the
+        same order as hit_pixels, or None if the hits aren't calibrated.
+        """
+        return self._energies
+
+    @property
+    def sum_of_counts(self):
+        """
+        Returns the sum of the hit counts.
+        """
+        if self._sums is None:
+            if len(self._counts) < SMALL_CLUSTER:
+                counts = self._counts.tolist()
+                self._sums = (sum(counts), sum([count*count for count in counts]))
+            else:
+                counts = self._counts.astype(numpy.int64)
+                self._sums = (int(counts.sum()), int((counts**2).sum()))
+        return self._sums[0]
+
+    @property
+    def sum_of_squares(self):
+        """
+        Returns the sum of the squares of the hit counts.
+        """
+        self.sum_of_counts
+        return self._sums[1]
+
+    def _calculate_moments(self):
+        """
+        Calculates and caches the moments of the hits, along with those of
+        the other clusters of the frame the cluster was found in (see
+        Frame.calculate_moments).
+        """
+        frame = self.frame
+        if frame is not None and frame.clusters:
+            frame.calculate_moments()
+        # The cluster may not be one of its frame's clusters
+        if self._moments is None:
+            self._moments = moments.from_hits(self._xs, self._ys, self._counts)
+
+    @property
+    def moments(self):
+        """
+        The unweighted moments.Moments of the hits, which describe the shape
+        of the cluster.
+        """
+        if self._moments is None:
+            self._calculate_moments()
+        return self._moments[0]
+
+    @property
+    def count_moments(self):
+        """
+        The moments.Moments of the hits weighted by their counts, which
+        describe where the charge was deposited.
+        """
+        if self._moments is None:
+            self._calculate_moments()
+        return self._moments[1]
+
+    @property
+    def bounding_box(self):
+        """
+        Returns the bounding box of the hit pixels as a 4-element tuple
+        (min_x, min_y, max_x, max_y). Raises a ValueError if there are no hit
+        pixels.
+        """
+        if self._bounds is None:
+            if not len(self._xs):
+                raise ValueError("PixelGrid has no hit pixels")
+            if len(self._xs) < SMALL_CLUSTER:
+                xs, ys = self._xs.tolist(), self._ys.tolist()
+                self._bounds = (min(xs), min(ys), max(xs), max(ys))
+            else:
+                self._bounds = (int(self._xs.min()), int(self._ys.min()),
+                                int(self._xs.max()), int(self._ys.max()))
+        return self._bounds
+
+    @property
+    def energy_patch(self):
+        """
+        The energy grid of the cluster clipped to its bounding box, as returned
+        by render_energy_zoomed. This is calculated once and cached, so
+        repeated renders and pixel lookups of the same cluster are free.
+        """
+        if self._energy_patch is None:
+            min_x, min_y, max_x, max_y = self.bounding_box
+            self._patch_origin = (min_x, min_y)
+            self._energy_patch = self.render_energy_zoomed(min_x, min_y, max_x, max_y)
+        return self._energy_patch
+
+    @property
+    def patch_origin(self):
+        """
+        The (x,y) frame co-ordinates of element [0][0] of energy_patch.
+        """
+        if self._energy_patch is None:
+            self.energy_patch
+        return self._patch_origin
+
+    @property
+    def manual_class(self):
+        """
+        The name of the class manually assigned to the cluster.
+        """
+        return class_registry.name(self.manual_class_code)
+
+    @manual_class.setter
+    def manual_class(self, name):
+        self.manual_class_code = class_registry.code(name)
+
+    @property
+    def algorithm_class(self):
+        """
+        The name of the class assigned to the cluster by a classification
+        algorithm.
+        """
+        return class_registry.name(self.algorithm_class_code)
+
+    @algorithm_class.setter
+    def algorithm_class(self, name):
+        self.algorithm_class_code = class_registry.code(name)
+
     @property
     def cluster_width(self):
         """
@@ -304,12 +931,13 @@ class Cluster(PixelGrid):
         Returns an ascii grid representation of the cluster, with rows
         separated by new line characters and columns separated by tabs.
         """
-        grid = [[0] * self.cluster_width for _ in range(self.cluster_height)]
-        for pixel in self.hit_pixels:
-            x, y = pixel
-            grid[y - self.min_y][x - self.min_x] = self[pixel].value
+        # Only reuse the energy_patch if the cluster has been rendered, so
+        # that clusters of an aggregate don't each keep a dense grid
+        patch = self._energy_patch
+        if patch is None:
+            patch = self.render_energy_zoomed(*self.bounding_box)
         # CERN@School/Pixelman convention to have lower origin, so flip matrix vertically.
-        grid.reverse()
+        grid = patch[::-1].tolist()
         return "\n".join(["\t".join([str(value) for value in row]) for row in grid])
 
     def get_training_row(self):
@@ -323,6 +951,46 @@ class Cluster(PixelGrid):
         return ",".join(record)
 
 
+def class_codes(clusters, class_property="manual_class"):
+    """
+    Returns a numpy array of the class code of each cluster in clusters.
+
+    Args:
+        clusters: A list of clusters
+
+        class_property: Either "manual_class" or "algorithm_class"
+    """
+    code_property = class_property + "_code"
+    return numpy.fromiter((getattr(cluster, code_property) for cluster in clusters),
+                          dtype=CODE_TYPE, count=len(clusters))
+
+def _hit_channel(hits, name):
+    """
+    Returns a list of the values of the attribute name (either "toa" or
+    "energy") of hits, or None if the hits don't have them (judged by the
+    first hit).
+    """
+    if getattr(hits[0], name) is None:
+        return None
+    values = [getattr(hit, name) for hit in hits]
+    return [value if value is not None else numpy.nan for value in values]
+
+def load_version():
+    """
+    Returns a value that changes whenever the processing applied to frames
+    as they are read (the pixel mask and energy calibration) changes, so that
+    anything calculated from frames read earlier can be recalculated.
+    """
+    return (pixel_mask.version, energy_calibration.version)
+
+def chip_dimension(size):
+    """
+    Returns the width (or height) of the smallest assembly of whole chips
+    that is at least size pixels wide, ie. size rounded up to a multiple of
+    CHIP_SIZE, and at least one chip.
+    """
+    return max(1, -(-size // CHIP_SIZE)) * CHIP_SIZE
+
 def are_neighbours(pixel1,pixel2):
     """
     Return True if if each of the x/y coords of pixel1 and pixel2 differ by two
@@ -337,16 +1005,28 @@ def are_neighbours(pixel1,pixel2):
 # attributes are defined in attributes.py
 attribute_table = OrderedDict()
 
-def attribute(class_, name, plottable=False, trainable=None):
+# Cost hints of attributes, used to evaluate cheap attributes first
+# Constant time, eg. read from the cached summary statistics
+COST_CONSTANT = 0
+# Linear in the number of hits
+COST_LINEAR = 1
+# Much more expensive than a pass over the hits, eg. clustering or hashing
+COST_EXPENSIVE = 2
+
+def attribute(class_, name, plottable=False, trainable=None, cost=COST_LINEAR):
     """
     A function decorator that adds a function to the attribute table along with
     its applicable Python object class that it can be called on. It also adds
-    to the attribute table whether it is plottable or trainable.
+    to the attribute table whether it is plottable or trainable, and a hint of
+    its cost.
 
     It then applies the function as a property to the relevant class so that the
     item is accessible in the same manner as any other property as::
         object.property
 
+    Calls of the function are timed under the stage "attribute.<name>" when
+    timing is enabled (see timing.py).
+
     Args:
         class\_: The class that the attribute function may be called on
         instances of
@@ -357,14 +1037,45 @@ def attribute(class_, name, plottable=False, trainable=None):
 
         trainable: Whether the attribute can be used in machine learning
         algorithms (defaults to the value of plottable)
+
+        cost: One of COST_CONSTANT, COST_LINEAR or COST_EXPENSIVE, a hint
+        of how expensive the attribute is to calculate
     """
-    if not trainable:
+    if trainable is None:
         trainable = plottable
     def decorator(function):
-        attribute_table[name] = (function, class_, plottable, trainable)
+        function = timing.timed("attribute." + name)(function)
+        attribute_table[name] = (function, class_, plottable, trainable, cost)
         setattr(class_, function.__name__, property(function))
         return function
     return decorator
 
+def attribute_value(obj, name, cache=False):
+    """
+    Returns the value of the attribute name (a key of attribute_table) of
+    obj, using the value held in obj.indexed_attributes if there is one (eg.
+    a cluster read from a dataset index) rather than calculating it.
+
+    Args:
+        obj: A Frame or Cluster
+
+        name: The name of the attribute
+
+        cache: Whether to keep the value in obj.attribute_cache, and use the
+        value kept there by an earlier call, until the hits of obj change
+    """
+    indexed = getattr(obj, "indexed_attributes", None)
+    if indexed and name in indexed:
+        return indexed[name]
+    if not cache:
+        return attribute_table[name][0](obj)
+    if obj.attribute_cache is None:
+        obj.attribute_cache = {}
+    elif name in obj.attribute_cache:
+        return obj.attribute_cache[name]
+    value = attribute_table[name][0](obj)
+    obj.attribute_cache[name] = value
+    return value
+
 # Import attributes
 from attributes import *
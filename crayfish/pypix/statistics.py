@@ -0,0 +1,193 @@
+"""
+Per-pixel statistics of many frames, for monitoring the health of a detector:
+the mean, variance, standard deviation and maximum of each pixel's count
+(counting the frames it wasn't hit in as 0), and its occupancy (the fraction
+of frames it was hit in).
+
+An Accumulator gathers the statistics frame by frame with Welford's algorithm,
+updating only the pixels each frame hits, and the zero counts of the frames
+that missed a pixel are folded in when it is next hit (or the result is
+taken). The resulting PixelStatistics only hold the pixels that were hit, and
+statistics gathered separately, eg. of sub folders or in worker processes, are
+merged exactly by adding them to an Accumulator in turn (Chan et al.'s
+parallel form of Welford's algorithm).
+"""
+import numpy
+
+# The statistics that may be rendered as an image of the frame, see
+# PixelStatistics.layer
+LAYERS = ["Mean", "Variance", "Std. dev.", "Occupancy", "Maximum"]
+
+class PixelStatistics(object):
+    """
+    The statistics of the pixels hit in a number of frames, held as arrays
+    aligned with the flat indices (y * width + x) of the hit pixels.
+
+    Args:
+        width, height: The dimensions of the frames
+
+        frames: The number of frames
+
+        pixels: The flat indices of the pixels hit in any of the frames
+
+        means: The mean count of each pixel
+
+        m2s: The sum of the squared differences of each pixel's count from
+        its mean
+
+        maxima: The maximum count of each pixel
+
+        occupancy: The number of frames each pixel was hit in
+    """
+    __slots__ = ("width", "height", "frames", "pixels", "means", "m2s", "maxima", "occupancy")
+
+    def __init__(self, width, height, frames=0, pixels=(), means=(), m2s=(), maxima=(),
+                 occupancy=()):
+        self.width = width
+        self.height = height
+        self.frames = frames
+        self.pixels = numpy.asarray(pixels, dtype=numpy.int64)
+        self.means = numpy.asarray(means, dtype=float)
+        self.m2s = numpy.asarray(m2s, dtype=float)
+        self.maxima = numpy.asarray(maxima, dtype=numpy.int64)
+        self.occupancy = numpy.asarray(occupancy, dtype=numpy.int64)
+
+    @classmethod
+    def from_hits(cls, width, height, xs, ys, counts):
+        """
+        Returns the statistics of a single frame, given as arrays of the
+        co-ordinates and counts of its hits.
+        """
+        counts = numpy.asarray(counts)
+        return cls(width, height, 1, numpy.asarray(ys, dtype=numpy.int64) * width + xs, counts,
+                   numpy.zeros(len(counts)), counts, numpy.ones(len(counts), dtype=numpy.int64))
+
+    @classmethod
+    def merge(cls, parts, width=0, height=0):
+        """
+        Returns the statistics of all of the frames of the statistics parts,
+        which are as large as the largest of them, and at least width x
+        height pixels.
+        """
+        accumulator = Accumulator(width, height)
+        for part in parts:
+            accumulator.add(part)
+        return accumulator.result()
+
+    @property
+    def variances(self):
+        """
+        The (population) variance of the count of each pixel.
+        """
+        return self.m2s / self.frames if self.frames else self.m2s
+
+    def layer(self, name):
+        """
+        Returns the statistic called name (one of LAYERS) as a 2D numpy array
+        indexed as grid[y][x], for rendering.
+        """
+        if name == "Mean":
+            values = self.means
+        elif name == "Variance":
+            values = self.variances
+        elif name == "Std. dev.":
+            values = numpy.sqrt(self.variances)
+        elif name == "Occupancy":
+            values = self.occupancy / float(self.frames or 1)
+        elif name == "Maximum":
+            values = self.maxima
+        else:
+            raise ValueError("Unknown statistic: " + name)
+        grid = numpy.zeros(self.width * self.height)
+        grid[self.pixels] = values
+        return grid.reshape(self.height, self.width)
+
+class Accumulator(object):
+    """
+    Gathers the statistics of frames one at a time, see the module docstring.
+    The accumulator grows to fit frames larger than those already added.
+    """
+    def __init__(self, width=0, height=0):
+        self.width = width
+        self.height = height
+        self.frames = 0
+        size = width * height
+        self._means = numpy.zeros(size)
+        self._m2s = numpy.zeros(size)
+        self._maxima = numpy.zeros(size, dtype=numpy.int64)
+        self._occupancy = numpy.zeros(size, dtype=numpy.int64)
+        # The number of frames included in the mean and m2 of each pixel,
+        # the rest (which didn't hit it) are folded in as zeros when it is next
+        # updated
+        self._seen = numpy.zeros(size, dtype=numpy.int64)
+
+    def _grow(self, width, height):
+        """
+        Enlarges the accumulator to at least width x height pixels.
+        """
+        if width <= self.width and height <= self.height:
+            return
+        width, height = max(width, self.width), max(height, self.height)
+        old = numpy.arange(self.width * self.height)
+        new = old % self.width + (old // self.width) * width if self.width else old
+        for name in ["_means", "_m2s", "_maxima", "_occupancy", "_seen"]:
+            array = getattr(self, name)
+            grown = numpy.zeros(width * height, dtype=array.dtype)
+            grown[new] = array
+            setattr(self, name, grown)
+        self.width, self.height = width, height
+
+    def _fold_zeros(self, pixels):
+        """
+        Folds the zero counts of the frames that haven't been included in the
+        mean and m2 of pixels into them.
+        """
+        if not self.frames:
+            return
+        seen = self._seen[pixels]
+        means = self._means[pixels]
+        self._m2s[pixels] += means**2 * seen * (self.frames - seen) / float(self.frames)
+        self._means[pixels] = means * seen / float(self.frames)
+        self._seen[pixels] = self.frames
+
+    def add(self, statistics):
+        """
+        Adds the frames of statistics, a PixelStatistics.
+        """
+        self._grow(statistics.width, statistics.height)
+        pixels = statistics.pixels
+        if statistics.width != self.width and len(pixels):
+            pixels = pixels % statistics.width + (pixels // statistics.width) * self.width
+        self._fold_zeros(pixels)
+        frames = self.frames + statistics.frames
+        if frames:
+            deltas = statistics.means - self._means[pixels]
+            self._means[pixels] += deltas * statistics.frames / float(frames)
+            self._m2s[pixels] += (statistics.m2s +
+                                  deltas**2 * self.frames * statistics.frames / float(frames))
+        self._maxima[pixels] = numpy.maximum(self._maxima[pixels], statistics.maxima)
+        self._occupancy[pixels] += statistics.occupancy
+        self._seen[pixels] = frames
+        self.frames = frames
+
+    def add_hits(self, width, height, xs, ys, counts):
+        """
+        Adds a frame of width x height pixels, given as arrays of the
+        co-ordinates and counts of its hits.
+        """
+        self.add(PixelStatistics.from_hits(width, height, xs, ys, counts))
+
+    def add_empty(self, frames=1):
+        """
+        Adds frames with no hits.
+        """
+        self.frames += frames
+
+    def result(self):
+        """
+        Returns the PixelStatistics of the frames added.
+        """
+        hit = numpy.flatnonzero(self._occupancy)
+        self._fold_zeros(hit)
+        return PixelStatistics(self.width, self.height, self.frames, hit, self._means[hit],
+                               self._m2s[hit], self._maxima[hit], self._occupancy[hit])
@@ -0,0 +1,397 @@
+"""
+Generates synthetic frames, for benchmarking and testing pypix at occupancies
+and sizes that are not available in real data.
+
+Three kinds of track are modelled, loosely following the shapes seen in
+Medipix frames:
+
+    Alpha: A dense, roughly circular blob with high counts
+
+    Beta: A thin curling track with low counts
+
+    Muon: A long straight line with moderate counts
+
+Plus isolated noise hits. All randomness comes from a random.Random instance
+seeded by the caller, so the same arguments always give the same frame.
+
+Whole datasets of frame files may be written with write_dataset, optionally
+using several processes, along with the ground truth of which track (and so
+which class) every hit pixel came from. This may also be run from the command
+line, eg::
+
+    python synthetic.py output_folder --frames 10000 --folders 10 --processes 4
+"""
+import argparse
+import json
+import math
+import multiprocessing
+import os
+import random
+
+from pypix import Frame, Hit
+import events
+
+# The relative frequency of each track type when a frame is filled to a given
+# occupancy
+TRACK_MIX = [("Alpha", 1), ("Beta", 4), ("Muon", 1)]
+
+# The mean number of each track type per frame of a generated dataset. The
+# number in each frame is Poisson distributed.
+DATASET_RATES = {"Alpha": 3.0, "Beta": 8.0, "Muon": 1.0, "Noise": 20.0}
+
+# The file extension used for each file format when writing datasets
+EXTENSIONS = {"lsc": ".lsc", "ascii_matrix": ".txt"}
+
+def alpha_blob(rng, centre, radius, peak=200):
+    """
+    Returns a dictionary mapping (x,y) to count for an alpha-like blob.
+
+    Args:
+        rng: A random.Random instance
+
+        centre: The (x,y) centre of the blob
+
+        radius: The radius of the blob in pixels
+
+        peak: The approximate count at the centre of the blob
+    """
+    centre_x, centre_y = centre
+    pixels = {}
+    extent = int(math.ceil(radius))
+    for x in range(centre_x - extent, centre_x + extent + 1):
+        for y in range(centre_y - extent, centre_y + extent + 1):
+            distance_squared = (x - centre_x)**2 + (y - centre_y)**2
+            if distance_squared <= radius**2:
+                falloff = math.exp(-float(distance_squared)/radius**2)
+                pixels[(x, y)] = max(1, int(peak * falloff * rng.uniform(0.8, 1.2)))
+    return pixels
+
+def _in_bounds(pixel, bounds):
+    """
+    Returns True if bounds is None or pixel lies within a (width, height)
+    frame.
+    """
+    if bounds is None:
+        return True
+    return 0 <= pixel[0] < bounds[0] and 0 <= pixel[1] < bounds[1]
+
+def beta_curl(rng, start, length, mean_count=40, bounds=None):
+    """
+    Returns a dictionary mapping (x,y) to count for a beta-like track, a walk
+    of length steps whose direction drifts as it goes.
+
+    Args:
+        rng: A random.Random instance
+
+        start: The (x,y) position the track starts from
+
+        length: The number of steps in the walk
+
+        mean_count: The mean count of each pixel of the track
+
+        bounds: The (width, height) of the frame. If given the walk stops
+        when it leaves the frame, so that it can't re-enter as a separate
+        trace.
+    """
+    x, y = start
+    angle = rng.uniform(0, 2*math.pi)
+    curvature = rng.uniform(-0.3, 0.3)
+    pixels = {}
+    for _ in range(length):
+        pixel = (int(round(x)), int(round(y)))
+        if not _in_bounds(pixel, bounds):
+            break
+        pixels[pixel] = max(1, int(rng.expovariate(1.0/mean_count)))
+        angle += curvature + rng.gauss(0, 0.2)
+        x += math.cos(angle)
+        y += math.sin(angle)
+    return pixels
+
+def muon_line(rng, start, length, mean_count=60, bounds=None):
+    """
+    Returns a dictionary mapping (x,y) to count for a muon-like track, a
+    straight line of length pixels in a random direction.
+
+    Args:
+        rng: A random.Random instance
+
+        start: The (x,y) position the track starts from
+
+        length: The length of the track in pixels
+
+        mean_count: The mean count of each pixel of the track
+
+        bounds: The (width, height) of the frame. If given the line stops
+        when it leaves the frame.
+    """
+    x, y = start
+    angle = rng.uniform(0, 2*math.pi)
+    pixels = {}
+    for step in range(length):
+        pixel = (int(round(x + step*math.cos(angle))),
+                 int(round(y + step*math.sin(angle))))
+        if not _in_bounds(pixel, bounds):
+            break
+        pixels[pixel] = max(1, int(rng.gauss(mean_count, mean_count/4.0)))
+    return pixels
+
+def random_track(rng, track_type, width=256, height=256,
+                 alpha_radius=(1.5, 3.5), beta_length=(10, 60),
+                 muon_length=(40, 150)):
+    """
+    Returns a dictionary mapping (x,y) to count for a track of track_type
+    ("Alpha", "Beta" or "Muon") at a random position in a width*height frame.
+    Alpha blobs near the edge may have pixels off the frame, which are not
+    removed. Betas and muons stop at the edge of the frame.
+
+    The *_radius and *_length arguments are (minimum, maximum) ranges that the
+    size of the track is drawn uniformly from.
+    """
+    position = (rng.randrange(width), rng.randrange(height))
+    if track_type == "Alpha":
+        return alpha_blob(rng, position, rng.uniform(*alpha_radius))
+    elif track_type == "Beta":
+        return beta_curl(rng, position, rng.randint(*beta_length),
+                         bounds=(width, height))
+    elif track_type == "Muon":
+        return muon_line(rng, position, rng.randint(*muon_length),
+                         bounds=(width, height))
+    raise ValueError("Unknown track type: " + track_type)
+
+def synthetic_frame(alphas=0, betas=0, muons=0, noise=0, occupancy=None,
+                    width=256, height=256, seed=None, **track_options):
+    """
+    Returns a new Frame containing randomly placed tracks. Where tracks
+    overlap their counts are summed.
+
+    Args:
+        alphas, betas, muons: The number of tracks of each type
+
+        noise: The number of isolated single pixel hits
+
+        occupancy: If given, further tracks (mixed as in TRACK_MIX) are added
+        until at least this fraction of the pixels of the frame are hit
+
+        width, height: The dimensions of the frame
+
+        seed: The seed of the random number generator
+
+        track_options: Passed on to random_track to control the size of the
+        tracks
+    """
+    return synthetic_frame_with_truth(alphas, betas, muons, noise, occupancy,
+                                      width, height, seed, **track_options)[0]
+
+def synthetic_frame_with_truth(alphas=0, betas=0, muons=0, noise=0, occupancy=None,
+                               width=256, height=256, seed=None, **track_options):
+    """
+    As synthetic_frame, but returns a 2-element tuple. The first item is the
+    frame, and the second is the ground truth: a list of 2-element tuples
+    (track type, pixels) for each track in the order they were added, where
+    pixels is a dictionary mapping (x,y) to the count the track contributed.
+    Isolated noise hits have the track type "Noise".
+    """
+    rng = random.Random(seed)
+    tracks = (["Alpha"] * alphas + ["Beta"] * betas + ["Muon"] * muons)
+    frame = Frame(width, height)
+    truth = []
+
+    def add_track(track_type, pixels):
+        pixels = dict((pixel, count) for pixel, count in pixels.items()
+                      if frame.in_grid(pixel))
+        for pixel, count in pixels.items():
+            frame[pixel] = Hit(frame.get(pixel, Hit(0)).value + count)
+        truth.append((track_type, pixels))
+
+    for track_type in tracks:
+        add_track(track_type, random_track(rng, track_type, width, height, **track_options))
+    for _ in range(noise):
+        add_track("Noise", {(rng.randrange(width), rng.randrange(height)): rng.randint(1, 30)})
+    if occupancy is not None:
+        mix = [track_type for track_type, weight in TRACK_MIX for _ in range(weight)]
+        while len(frame) < occupancy * width * height:
+            track_type = rng.choice(mix)
+            add_track(track_type, random_track(rng, track_type, width, height, **track_options))
+    return frame, truth
+
+def synthetic_events(frames=1, frame_time=1e6, track_time=100.0, width=256, height=256,
+                     seed=None, **frame_options):
+    """
+    Returns events.Events of a time-resolved stream of tracks, sorted by time
+    of arrival. The tracks of frames synthetic frames are spread over
+    consecutive periods of frame_time, each starting at a random time in its
+    period, with the hits of a track arriving within track_time of its start.
+    The count of each hit is used as its ToT.
+
+    Args:
+        frame_options: Passed on to synthetic_frame_with_truth, eg. alphas=5
+    """
+    rng = random.Random(seed)
+    columns = ([], [], [], [])
+    for number in range(frames):
+        frame, truth = synthetic_frame_with_truth(width=width, height=height,
+                                                  seed=rng.random(), **frame_options)
+        for track_type, pixels in truth:
+            start = (number + rng.random()) * frame_time
+            for (x, y), count in sorted(pixels.items()):
+                for column, value in zip(columns, (x, y, start + rng.random() * track_time, count)):
+                    column.append(value)
+    return events.Events(*columns).sorted()
+
+def poisson(rng, mean):
+    """
+    Returns a random integer from a Poisson distribution with mean, using
+    random.Random instance rng.
+    """
+    # Knuth's algorithm, which is fine for the small means used here
+    limit = math.exp(-mean)
+    count = 0
+    product = rng.random()
+    while product > limit:
+        count += 1
+        product *= rng.random()
+    return count
+
+def write_frame(frame, filepath, file_format="lsc"):
+    """
+    Writes frame to filepath in a format that Frame.from_file can read.
+
+    Args:
+        frame: The frame to write
+
+        filepath: The filepath of the file to write
+
+        file_format: Either "lsc" or "ascii_matrix"
+    """
+    with open(filepath, "w") as f:
+        if file_format == "lsc":
+            f.write("// width: %d\n// height: %d\n" % (frame.width, frame.height))
+            for (x, y), hit in sorted(frame.items(), key=lambda item: (item[0][1], item[0][0])):
+                f.write("%d,%d\t%d\n" % (x, y, hit.value))
+        elif file_format == "ascii_matrix":
+            for row in frame.render_energy():
+                f.write(" ".join([str(count) for count in row]) + "\n")
+        else:
+            raise Exception("File format not supported: " + file_format)
+
+def _write_dataset_frame(job):
+    """
+    Generates and writes a single frame of a dataset, returning its ground
+    truth record (see write_dataset). Defined at module level so that it may
+    be run in a multiprocessing pool.
+    """
+    directory, relative_path, file_format, rates, seed, width, height, track_options = job
+    rng = random.Random(seed)
+    counts = dict((track_type, poisson(rng, rates.get(track_type, 0)))
+                  for track_type in ["Alpha", "Beta", "Muon", "Noise"])
+    frame, truth = synthetic_frame_with_truth(counts["Alpha"], counts["Beta"],
+            counts["Muon"], counts["Noise"], width=width, height=height,
+            seed=rng.random(), **track_options)
+    write_frame(frame, os.path.join(directory, relative_path), file_format)
+    return {"path": relative_path,
+            "tracks": [{"class": track_type,
+                        "pixels": [[x, y, count] for (x, y), count in sorted(pixels.items())]}
+                       for track_type, pixels in truth]}
+
+def write_dataset(directory, frames=100, folders=1, file_format="lsc",
+                  rates=DATASET_RATES, seed=0, processes=1,
+                  width=256, height=256, **track_options):
+    """
+    Writes a dataset of synthetic frames to directory, spread evenly over
+    sub folders, and writes the ground truth to ground_truth.jsonl in
+    directory.
+
+    The ground truth file has one JSON object per line for each frame, with
+    keys "path" (the frame file path relative to directory) and "tracks" (a
+    list of objects with keys "class" and "pixels", a list of [x, y, count]
+    that the track contributed to the frame). Each track is a single
+    connected trace, so every track's pixels should end up in one cluster;
+    tracks that overlap or touch are expected to share a cluster.
+
+    Each frame is seeded from seed and its index, so the dataset is the same
+    whatever the number of processes.
+
+    Args:
+        directory: The folder to write to, which is created if needed
+
+        frames: The total number of frames
+
+        folders: The number of sub folders to spread the frames over. If 1 the
+        frames are written directly to directory.
+
+        file_format: Either "lsc" or "ascii_matrix"
+
+        rates: A dictionary mapping track type to the mean number of tracks of
+        that type per frame, see DATASET_RATES
+
+        seed: The seed of the dataset
+
+        processes: The number of processes used to generate frames
+
+        width, height: The dimensions of the frames
+
+        track_options: Passed on to random_track to control the size of the
+        tracks
+
+    Returns the list of ground truth records.
+    """
+    jobs = []
+    for index in range(frames):
+        sub_folder = "run%03d" % (index % folders) if folders > 1 else ""
+        if not os.path.isdir(os.path.join(directory, sub_folder)):
+            os.makedirs(os.path.join(directory, sub_folder))
+        relative_path = os.path.join(sub_folder, "frame%06d%s" % (index, EXTENSIONS[file_format]))
+        jobs.append((directory, relative_path, file_format, rates,
+                     "%s-%d" % (seed, index), width, height, track_options))
+    if processes > 1:
+        pool = multiprocessing.Pool(processes)
+        try:
+            records = pool.map(_write_dataset_frame, jobs, chunksize=16)
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        records = [_write_dataset_frame(job) for job in jobs]
+    with open(os.path.join(directory, "ground_truth.jsonl"), "w") as f:
+        for record in records:
+            f.write(json.dumps(record) + "\n")
+    return records
+
+def read_ground_truth(directory):
+    """
+    Reads the ground truth written by write_dataset.
+
+    Returns a dictionary mapping each frame path (relative to directory) to
+    a list of 2-element tuples (class, pixels), where pixels is a dictionary
+    mapping (x,y) to count.
+    """
+    truth = {}
+    with open(os.path.join(directory, "ground_truth.jsonl")) as f:
+        for line in f:
+            record = json.loads(line)
+            truth[record["path"]] = [(track["class"],
+                    dict(((x, y), count) for x, y, count in track["pixels"]))
+                    for track in record["tracks"]]
+    return truth
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Write a dataset of synthetic Medipix frames.")
+    parser.add_argument("directory", help="Folder to write the dataset to")
+    parser.add_argument("--frames", type=int, default=100, help="Number of frames (default: 100)")
+    parser.add_argument("--folders", type=int, default=1, help="Number of sub folders (default: 1)")
+    parser.add_argument("--format", default="lsc", choices=sorted(EXTENSIONS),
+                        help="Frame file format (default: lsc)")
+    parser.add_argument("--seed", default="0", help="Dataset seed (default: 0)")
+    parser.add_argument("--processes", type=int, default=1,
+                        help="Number of processes to generate frames with (default: 1)")
+    for track_type in sorted(DATASET_RATES):
+        parser.add_argument("--" + track_type.lower() + "s", type=float,
+                            default=DATASET_RATES[track_type],
+                            help="Mean number of %s tracks per frame (default: %s)"
+                                 % (track_type, DATASET_RATES[track_type]))
+    args = parser.parse_args()
+    rates = dict((track_type, getattr(args, track_type.lower() + "s"))
+                 for track_type in DATASET_RATES)
+    write_dataset(args.directory, args.frames, args.folders, args.format, rates,
+                  args.seed, args.processes)
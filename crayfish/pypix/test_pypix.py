@@ -1,5 +1,22 @@
+import hashlib
+import os
+import shutil
+import tempfile
+import threading
+import time
 import unittest
+import warnings
+
+import numpy
+
 from pypix import *
+import synthetic
+import filters
+import events
+import statistics
+import calibration
+import kernels
+import moments
 
 # Dictionaries of frame data, seperated into a list corresponding to cluster
 CLUSTERS = [{
@@ -116,6 +133,21 @@ class TestFrame(unittest.TestCase):
         # Test 7.4
         self.assertEqual(self.f.max_y, 255)
 
+    def test_summary_statistics(self):
+        # Test 7.5
+        self.assertEqual(self.f.sum_of_counts, sum(TEST_FRAME_DATA.values()))
+        # Test 7.6
+        self.assertEqual(self.f.sum_of_squares,
+                sum([count**2 for count in TEST_FRAME_DATA.values()]))
+        # Replacing a hit should replace its contribution to the statistics
+        # Test 7.7
+        self.f[(175,10)] = Hit(1)
+        self.assertEqual(self.f.sum_of_counts, sum(TEST_FRAME_DATA.values()) - 50)
+        # Removing the only hit on the bounding box edge should shrink it
+        # Test 7.8
+        del self.f[(75,75)]
+        self.assertEqual(self.f.bounding_box, (91, 10, 176, 255))
+
     def test_number_of_neighbours(self):
         # Test 8.1
         self.assertEqual(self.f.number_of_neighbours((175,11)), 8)
@@ -124,6 +156,16 @@ class TestFrame(unittest.TestCase):
         # Test 8.3
         self.assertEqual(self.f.number_of_neighbours((93,177)), 4)
 
+    def test_neighbour_counts_kernel(self):
+        # Test 8.4
+        occupancy = [[1, 1, 0],
+                     [0, 1, 0],
+                     [0, 0, 1]]
+        self.assertEqual(morphology.neighbour_counts(occupancy).tolist(),
+                [[2, 2, 2],
+                 [3, 3, 3],
+                 [1, 2, 1]])
+
     def test_get_max_neighbours(self):
         # Test 9
         self.assertEqual(self.f.get_max_neighbours(), (8, [(175, 11)]))
@@ -140,5 +182,719 @@ class TestFrame(unittest.TestCase):
         correct_cluster_pixels = [cluster.keys().sort() for cluster in CLUSTERS]
         self.assertItemsEqual(frame_cluster_pixels, correct_cluster_pixels)
 
+    def test_render_energy(self):
+        # Test 11.1
+        grid = self.f.render_energy()
+        self.assertEqual(grid.shape, (self.f.height, self.f.width))
+        self.assertEqual(grid[10][175], 51)
+        self.assertEqual(grid.sum(), sum(TEST_FRAME_DATA.values()))
+        # Test 11.2
+        grid = self.f.render_energy_zoomed(174, 10, 176, 12)
+        self.assertEqual(grid.tolist(), [[6, 51, 82], [59, 117, 62], [46, 128, 9]])
+
+    def test_energy_patch(self):
+        # Test 12
+        self.f.calculate_clusters()
+        cluster = self.f[(147,240)].cluster
+        self.assertEqual(cluster.patch_origin, (147, 240))
+        self.assertEqual(cluster.energy_patch.tolist(), [[25, 219]])
+        # The cached patch should be the same object on subsequent calls
+        self.assertIs(cluster.energy_patch, cluster.energy_patch)
+
+class TestClassRegistry(unittest.TestCase):
+
+    def setUp(self):
+        self.f = Frame.from_file("test_frame.lsc")
+        self.f.calculate_clusters()
+
+    def test_codes(self):
+        # Test 13.1
+        self.assertEqual(class_registry.code("Unclassified"), UNCLASSIFIED)
+        # Test 13.2
+        self.assertEqual(class_registry.name(class_registry.code("Beta")), "Beta")
+
+    def test_cluster_classes(self):
+        # Test 14.1
+        cluster = self.f.clusters[0]
+        self.assertEqual(cluster.manual_class, "Unclassified")
+        # Test 14.2
+        cluster.manual_class = "Alpha"
+        self.assertEqual(cluster.manual_class_code, class_registry.code("Alpha"))
+        # Test 14.3
+        self.assertEqual(list(class_codes(self.f.clusters)),
+                [class_registry.code("Alpha")] + [UNCLASSIFIED] * (len(CLUSTERS) - 1))
+
+    def test_class_counts(self):
+        # Test 15
+        self.f.clusters[0].algorithm_class = "Gamma"
+        self.f.clusters[1].algorithm_class = "Gamma"
+        counts = self.f.class_counts("algorithm_class")
+        self.assertEqual(counts["Gamma"], 2)
+        self.assertEqual(counts["Unclassified"], len(CLUSTERS) - 2)
+
+    def test_group_codes(self):
+        # Test 16
+        groups = group_codes([2, 0, 2, 1, 0])
+        self.assertEqual(dict((code, list(indices)) for code, indices in groups.items()),
+                {0: [1, 4], 1: [3], 2: [0, 2]})
+
+class TestSynthetic(unittest.TestCase):
+
+    def test_reproducible(self):
+        # Test 17.1
+        frame1 = synthetic.synthetic_frame(alphas=2, betas=3, muons=1, noise=5, seed=7)
+        frame2 = synthetic.synthetic_frame(alphas=2, betas=3, muons=1, noise=5, seed=7)
+        self.assertEqual(dict((pixel, hit.value) for pixel, hit in frame1.items()),
+                dict((pixel, hit.value) for pixel, hit in frame2.items()))
+
+    def test_occupancy(self):
+        # Test 17.2
+        frame = synthetic.synthetic_frame(occupancy=0.02, seed=3)
+        self.assertTrue(len(frame) >= 0.02 * frame.width * frame.height)
+
+    def test_write_frame(self):
+        # Test 17.3
+        frame = synthetic.synthetic_frame(alphas=3, betas=3, seed=11)
+        directory = tempfile.mkdtemp()
+        try:
+            for file_format in ["lsc", "ascii_matrix"]:
+                path = os.path.join(directory, "frame")
+                synthetic.write_frame(frame, path, file_format)
+                read_frame = Frame.from_file(path, file_format)
+                self.assertEqual(read_frame.render_energy().tolist(),
+                        frame.render_energy().tolist())
+        finally:
+            shutil.rmtree(directory)
+
+    def test_dataset_ground_truth(self):
+        # Test 17.4
+        directory = tempfile.mkdtemp()
+        try:
+            synthetic.write_dataset(directory, frames=4, folders=2, seed=5)
+            truth = synthetic.read_ground_truth(directory)
+            self.assertEqual(len(truth), 4)
+            for path, tracks in truth.items():
+                frame = Frame.from_file(os.path.join(directory, path))
+                frame.calculate_clusters()
+                # Every pixel of a track should be in the same cluster
+                for track_type, pixels in tracks:
+                    clusters = set([id(frame[pixel].cluster) for pixel in pixels])
+                    self.assertEqual(len(clusters), 1)
+        finally:
+            shutil.rmtree(directory)
+
+    def test_large_cluster(self):
+        # Test 17.5
+        # Clusters far larger than the recursion limit
+        frame = synthetic.synthetic_frame(occupancy=0.3, seed=1)
+        frame.calculate_clusters()
+        self.assertEqual(sum([len(cluster) for cluster in frame.clusters]), len(frame))
+
+class TestTiming(unittest.TestCase):
+
+    def tearDown(self):
+        timing.enable(False)
+        timing.reset()
+
+    def test_disabled(self):
+        # Test 18.1
+        Frame.from_file("test_frame.lsc")
+        self.assertEqual(timing.report(), {"stages": {}, "counters": {}})
+
+    def test_enabled(self):
+        # Test 18.2
+        timing.enable()
+        frame = Frame.from_file("test_frame.lsc")
+        frame.calculate_clusters()
+        report = timing.report()
+        self.assertEqual(report["stages"]["Frame.from_file"]["calls"], 1)
+        self.assertEqual(report["counters"]["hits read"], len(TEST_FRAME_DATA))
+        self.assertEqual(report["counters"]["clusters found"], len(CLUSTERS))
+
+    def test_recursion(self):
+        # Test 18.3
+        timing.enable()
+        @timing.timed("recursive")
+        def recursive(n):
+            if n:
+                recursive(n - 1)
+        recursive(3)
+        self.assertEqual(timing.report()["stages"]["recursive"]["calls"], 4)
+
+    def test_threads(self):
+        # Test 18.4
+        timing.enable()
+        started = threading.Event()
+        release = threading.Event()
+        @timing.timed("stage")
+        def stage(wait):
+            if wait:
+                started.set()
+                release.wait()
+            else:
+                time.sleep(0.05)
+        thread = threading.Thread(target=stage, args=(True,))
+        thread.start()
+        started.wait()
+        # A call in another thread during the first isn't taken for a
+        # recursive call, so both calls are timed
+        stage(False)
+        release.set()
+        thread.join()
+        stats = timing.report()["stages"]["stage"]
+        self.assertEqual(stats["calls"], 2)
+        self.assertTrue(stats["total"] >= 0.095)
+        threads = [threading.Thread(target=lambda: [timing.count("counted") for i in range(2000)])
+                   for j in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(timing.report()["counters"]["counted"], 8000)
+
+class TestFilters(unittest.TestCase):
+
+    def setUp(self):
+        self.frame = Frame.from_file("test_frame.lsc")
+        self.frame.calculate_clusters()
+
+    def test_parse(self):
+        # Test 19.1
+        frame_filter = filters.Filter.parse("No. of clusters > 2 and No. of hits <= 100")
+        # Cheap attributes are evaluated first
+        self.assertEqual([predicate.name for predicate in frame_filter.predicates],
+                         ["No. of hits", "No. of clusters"])
+        self.assertRaises(ValueError, filters.Filter.parse, "Unknown > 1")
+        self.assertRaises(ValueError, filters.Filter.parse, "Volume > many")
+        self.assertRaises(ValueError, filters.Filter.parse, "Radius > 1", Frame)
+
+    def test_filter(self):
+        # Test 19.2
+        cluster_filter = filters.Filter.parse("Volume > 300 and No. of hits >= 4")
+        accepted = [cluster for cluster in self.frame.clusters if cluster_filter(cluster)]
+        self.assertEqual(len(accepted), len([cluster for cluster in CLUSTERS
+                if sum(cluster.values()) > 300 and len(cluster) >= 4]))
+        self.assertTrue(filters.Filter.parse("")(self.frame))
+        self.assertFalse(filters.Filter.parse("No. of hits < 1")(self.frame))
+
+    def test_indexed_attributes(self):
+        # Test 19.3
+        cluster = self.frame.clusters[0]
+        cluster.indexed_attributes = {"Volume": -1}
+        self.assertTrue(filters.Filter.parse("Volume < 0")(cluster))
+
+class TestCluster(unittest.TestCase):
+
+    def setUp(self):
+        self.f = Frame.from_file("test_frame.lsc")
+        self.f.calculate_clusters()
+        self.cluster = self.f[(175,10)].cluster
+
+    def test_hit_slots(self):
+        # Test 20.1
+        self.assertFalse(hasattr(Hit(1), "__dict__"))
+
+    def test_mapping(self):
+        # Test 20.2
+        cluster_data = CLUSTERS[0]
+        self.assertEqual(len(self.cluster), len(cluster_data))
+        self.assertEqual(sorted(self.cluster.hit_pixels), sorted(cluster_data))
+        self.assertEqual(dict((pixel, hit.value) for pixel, hit in self.cluster.items()),
+                         cluster_data)
+        self.assertEqual(self.cluster[(175,11)].value, 117)
+        self.assertIs(self.cluster[(175,11)].cluster, self.cluster)
+        self.assertEqual(self.cluster[(0,0)].value, 0)
+        self.assertIn((174,12), self.cluster)
+        self.assertNotIn((0,0), self.cluster)
+        self.assertRaises(KeyError, lambda: self.cluster[(500,500)])
+
+    def test_parent_frame(self):
+        # Test 20.3
+        self.assertIs(self.cluster.frame, self.f)
+        del self.f
+        # Only a weak reference to the frame is kept
+        self.assertIs(self.cluster.frame, None)
+        self.assertEqual(self.cluster.volume, sum(CLUSTERS[0].values()))
+
+    def test_modify(self):
+        # Test 20.4
+        self.cluster[(175,11)] = Hit(17)
+        self.assertEqual(self.cluster.volume, sum(CLUSTERS[0].values()) - 100)
+        self.assertEqual(self.cluster.energy_patch[1][1], 17)
+        del self.cluster[(174,10)]
+        self.assertEqual(len(self.cluster), len(CLUSTERS[0]) - 1)
+        self.cluster.add((173,10), Hit(5))
+        self.assertEqual(self.cluster.bounding_box, (173, 10, 176, 12))
+
+    def test_lookup(self):
+        # Test 20.5
+        for pixel, count in CLUSTERS[0].items():
+            self.assertEqual(self.cluster[pixel].value, count)
+            self.assertTrue(pixel in self.cluster)
+        self.assertEqual(self.cluster[(173,10)].value, 0)
+        self.assertEqual(self.cluster.get((0,0)), None)
+        self.assertFalse((-1,10) in self.cluster)
+        self.assertFalse((self.cluster.width + 174,9) in self.cluster)
+        self.assertEqual(self.cluster.UUID, hashlib.sha1(self.cluster.ascii_grid).hexdigest())
+        # Looking up hits doesn't leave a dense grid on the cluster
+        self.assertIs(self.cluster._energy_patch, None)
+
+class TestLargeFrames(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        # A quad frame with a track across the boundary between the chips
+        self.frame = synthetic.synthetic_frame(alphas=20, betas=20, muons=10,
+                width=512, height=512, seed=8)
+        for x in range(250, 262):
+            self.frame[(x, 256)] = Hit(10)
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_dimensions(self):
+        # Test 21.1
+        path = os.path.join(self.directory, "frame")
+        for file_format in ["lsc", "ascii_matrix"]:
+            synthetic.write_frame(self.frame, path, file_format)
+            frame = Frame.from_file(path, file_format)
+            self.assertEqual((frame.width, frame.height), (512, 512))
+        # Without a header, the frame is the smallest assembly of chips that
+        # holds its hits
+        with open(path, "w") as f:
+            f.write("300,10\t5\n")
+        frame = Frame.from_file(path)
+        self.assertEqual((frame.width, frame.height), (512, 256))
+        self.assertRaises(Exception, Frame.from_file, path, "lsc", 256, 256)
+
+    def test_tiled_clusters(self):
+        # Test 21.2
+        expected = sorted(sorted(cluster.hit_pixels) for cluster in
+                          Frame(512, 512, self.frame).calculate_clusters())
+        for tile_size, processes in [(CHIP_SIZE, 1), (CHIP_SIZE, 2), (5, 1)]:
+            frame = Frame(512, 512, dict((pixel, Hit(hit.value))
+                                         for pixel, hit in self.frame.items()))
+            clusters = frame.calculate_clusters(tile_size, processes)
+            self.assertEqual(sorted(sorted(cluster.hit_pixels) for cluster in clusters),
+                             expected)
+            self.assertIs(frame[(250, 256)].cluster, frame[(261, 256)].cluster)
+
+class TestEvents(unittest.TestCase):
+
+    def setUp(self):
+        self.events = synthetic.synthetic_events(frames=5, alphas=2, betas=3, muons=1,
+                                                 noise=10, seed=2)
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def cluster_hits(self, clusters):
+        return sorted(sorted(zip(cluster.hit_pixels, cluster.counts)) for cluster in clusters)
+
+    def test_read_write(self):
+        # Test 22.1
+        for file_format in ["t3pa", "events"]:
+            path = os.path.join(self.directory, "stream." + file_format)
+            events.write_events(self.events, path, file_format)
+            read = events.Events.concatenate(events.read_events(path, file_format,
+                                                                chunk_bytes=1000))
+            self.assertEqual(read.xs.tolist(), self.events.xs.tolist())
+            self.assertEqual(read.ys.tolist(), self.events.ys.tolist())
+            self.assertEqual(read.tots.tolist(), self.events.tots.tolist())
+            # t3pa times are rounded to the fine ToA clock
+            self.assertTrue(abs(read.toas - self.events.toas).max() <= events.FTOA_CLOCK)
+
+    def test_label_events(self):
+        # Test 22.2
+        stream = events.Events([0, 1, 2, 2, 5, 5], [0, 1, 1, 1, 5, 6],
+                               [0, 10, 100, 15, 0, 0], [1, 2, 3, 4, 5, 6])
+        self.assertEqual(events.label_events(stream, 10).tolist(), [0, 0, 1, 0, 2, 2])
+        self.assertEqual(events.label_events(stream, 100).tolist(), [0, 0, 0, 0, 1, 1])
+        # With the hits of a frame arriving at once, the clusters are those of
+        # the frame
+        frame = synthetic.synthetic_frame(alphas=5, betas=5, muons=2, seed=4)
+        pixels = frame.hit_pixels
+        stream = events.Events([x for x, y in pixels], [y for x, y in pixels],
+                               [0] * len(pixels), frame.counts)
+        clusters = events.clusters_from_events(stream, events.label_events(stream, 1))
+        self.assertEqual(self.cluster_hits(clusters),
+                         self.cluster_hits(frame.calculate_clusters()))
+
+    def test_stream_clusters(self):
+        # Test 22.3
+        expected = self.cluster_hits(events.clusters_from_events(self.events,
+                events.label_events(self.events, 500)))
+        chunks = [self.events[i:i + 100] for i in range(0, len(self.events), 100)]
+        clusters = [cluster for completed in events.stream_clusters(chunks, 500)
+                    for cluster in completed]
+        self.assertEqual(self.cluster_hits(clusters), expected)
+        windows = list(events.time_windows(chunks, 1e6, start=0))
+        self.assertEqual([start for start, window in windows], [0, 1e6, 2e6, 3e6, 4e6])
+        self.assertEqual(sum(len(window) for start, window in windows), len(self.events))
+
+    def test_stream_boundary(self):
+        # Test 22.5
+        # Hits exactly time_gap apart are connected, also across chunks
+        stream = events.Events([0, 50, 1], [0, 50, 1], [0, 10, 10], [1, 2, 3])
+        self.assertEqual(events.label_events(stream, 10).tolist(), [0, 1, 0])
+        chunks = [stream[:2], stream[2:]]
+        clusters = [cluster for completed in events.stream_clusters(chunks, 10)
+                    for cluster in completed]
+        self.assertEqual(self.cluster_hits(clusters),
+                         self.cluster_hits(events.clusters_from_events(stream, numpy.array([0, 1, 0]))))
+
+    def test_time_resolved_cluster(self):
+        # Test 22.4
+        frame = events.Events([3, 4, 4], [3, 3, 4], [20, 10, 15], [5, 6, 7]).to_frame()
+        self.assertEqual(frame[(4, 3)].toa, 10)
+        cluster = frame.calculate_clusters()[0]
+        self.assertEqual(cluster.time_of_arrival, 10)
+        self.assertEqual(cluster.duration, 10)
+        del cluster[(4, 3)]
+        cluster[(5, 5)] = Hit(8, toa=30)
+        self.assertEqual(cluster[(5, 5)].toa, 30)
+        self.assertEqual(cluster.duration, 15)
+
+class TestPixelMask(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        pixel_mask.clear()
+        shutil.rmtree(self.directory)
+
+    def test_from_statistics(self):
+        # Test 23.1
+        # (1, 1) is hit in every frame and (2, 2) in one frame with a high count
+        mask = Mask.from_statistics(10, [1, 2, 3], [1, 2, 3], [10, 1, 2], [50, 900, 20])
+        self.assertEqual(sorted(mask), [(1, 1)])
+        mask = Mask.from_statistics(10, [1, 2, 3], [1, 2, 3], [10, 1, 2], [50, 900, 20],
+                                    max_mean_count=100)
+        self.assertEqual(sorted(mask), [(1, 1), (2, 2)])
+        self.assertEqual(len(Mask.from_statistics(0, [], [], [], [])), 0)
+
+    def test_from_file(self):
+        # Test 23.2
+        frame = Frame.from_file("test_frame.lsc")
+        hot_pixel = frame.hit_pixels[0]
+        path = os.path.join(self.directory, "hot.mask")
+        Mask([hot_pixel, (0, 0)]).save(path)
+        pixel_mask.load(path)
+        self.assertEqual(sorted(pixel_mask), sorted([hot_pixel, (0, 0)]))
+        masked = Frame.from_file("test_frame.lsc")
+        self.assertNotIn(hot_pixel, masked)
+        self.assertEqual(len(masked), len(frame) - 1)
+        self.assertEqual(masked.volume, frame.volume - frame[hot_pixel].value)
+        self.assertEqual(len(Frame.from_file("test_frame.lsc", mask=Mask())), len(frame))
+
+class TestPixelStatistics(unittest.TestCase):
+
+    def setUp(self):
+        frames = [synthetic.synthetic_frame(alphas=2, betas=3, noise=30, seed=seed)
+                  for seed in range(6)]
+        self.parts = [statistics.PixelStatistics.from_hits(frame.width, frame.height,
+                                                          *frame.hit_arrays())
+                      for frame in frames]
+        self.dense = numpy.zeros((len(frames), CHIP_SIZE * CHIP_SIZE))
+        for i, frame in enumerate(frames):
+            xs, ys, counts = frame.hit_arrays()
+            self.dense[i, ys * CHIP_SIZE + xs] = counts
+
+    def assertStatistics(self, result):
+        self.assertEqual(result.frames, len(self.dense))
+        self.assertTrue(numpy.allclose(result.layer("Mean").ravel(), self.dense.mean(0)))
+        self.assertTrue(numpy.allclose(result.layer("Variance").ravel(), self.dense.var(0)))
+        self.assertTrue(numpy.allclose(result.layer("Occupancy").ravel(),
+                                       (self.dense > 0).mean(0)))
+        self.assertTrue((result.layer("Maximum").ravel() == self.dense.max(0)).all())
+
+    def test_accumulate(self):
+        # Test 24.1
+        accumulator = statistics.Accumulator()
+        for part in self.parts:
+            accumulator.add(part)
+        self.assertStatistics(accumulator.result())
+
+    def test_merge(self):
+        # Test 24.2
+        halves = [statistics.PixelStatistics.merge(self.parts[:2]),
+                  statistics.PixelStatistics.merge(self.parts[2:])]
+        self.assertStatistics(statistics.PixelStatistics.merge(halves))
+        # Larger frames are merged into a larger result
+        quad = statistics.PixelStatistics.from_hits(512, 512, [300], [300], [9])
+        merged = statistics.PixelStatistics.merge(halves + [quad])
+        self.assertEqual((merged.width, merged.height, merged.frames), (512, 512, 7))
+        self.assertEqual(merged.layer("Maximum")[300, 300], 9)
+
+class TestCalibration(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.cache_dir = os.path.join(self.directory, "cache")
+        self.parameters = {"a": 1.5, "b": 20.0, "c": 300.0, "t": 2.0}
+        for name, value in self.parameters.items():
+            matrix = numpy.empty((256, 256))
+            matrix.fill(value)
+            # Vary one pixel to check the matrices are indexed [y][x]
+            matrix[10, 175] = 2 * value
+            numpy.savetxt(os.path.join(self.directory, name + ".txt"), matrix)
+
+    def tearDown(self):
+        energy_calibration.clear()
+        shutil.rmtree(self.directory)
+
+    def test_energies(self):
+        # Test 25.1
+        calibration_ = Calibration()
+        self.assertFalse(calibration_)
+        calibration_.load(self.directory, self.cache_dir)
+        self.assertTrue(calibration_)
+        self.assertTrue(all(isinstance(matrix, numpy.memmap) for matrix in calibration_.matrices))
+        self.assertEqual(len(os.listdir(self.cache_dir)), 4)
+        energies = numpy.array([5.0, 30.0, 600.0])
+        a, b, c, t = [self.parameters[name] for name in calibration.PARAMETERS]
+        tots = calibration.surrogate(energies, a, b, c, t)
+        numpy.testing.assert_allclose(calibration_.energies([0, 1, 2], [0, 1, 2], tots), energies)
+        tots = calibration.surrogate(energies, 2 * a, 2 * b, 2 * c, 2 * t)
+        numpy.testing.assert_allclose(calibration_.energies([175] * 3, [10] * 3, tots), energies)
+        # Hits outside of the calibration have no energy
+        self.assertTrue(numpy.isnan(calibration_.energies([300], [0], [50])).all())
+        # Loading again reuses the converted matrices
+        digest = calibration_.digest()
+        calibration_.load(self.directory, self.cache_dir)
+        self.assertEqual(len(os.listdir(self.cache_dir)), 4)
+        self.assertEqual(calibration_.digest(), digest)
+
+    def test_from_file(self):
+        # Test 25.2
+        self.assertEqual(Frame.from_file("test_frame.lsc")[(175, 10)].energy, None)
+        energy_calibration.load(self.directory, self.cache_dir)
+        version = load_version()
+        frame = Frame.from_file("test_frame.lsc")
+        tot = frame[(175, 10)].value
+        self.assertAlmostEqual(frame[(175, 10)].energy,
+                               energy_calibration.energies([175], [10], [tot])[0])
+        frame.calculate_clusters()
+        for cluster in frame.clusters:
+            self.assertEqual(len(cluster.energies), len(cluster))
+            self.assertAlmostEqual(cluster.energy,
+                                   sum(frame[pixel].energy for pixel in cluster.hit_pixels))
+        energy_calibration.clear()
+        self.assertNotEqual(load_version(), version)
+        uncalibrated = Frame.from_file("test_frame.lsc")
+        uncalibrated.calculate_clusters()
+        self.assertEqual(uncalibrated.clusters[0].energy, 0)
+
+class TestMoments(unittest.TestCase):
+
+    def setUp(self):
+        self.frame = synthetic.synthetic_frame(alphas=5, betas=10, muons=2, noise=20, seed=1)
+        self.frame.calculate_clusters()
+
+    def test_shape(self):
+        # Test 26.1
+        # A straight track of 10 pixels along the x axis
+        cluster = Cluster(256, 256)
+        cluster.set_hits(range(10, 20), [5] * 10, [3] * 10)
+        self.assertAlmostEqual(cluster.track_length, 10)
+        self.assertAlmostEqual(cluster.linearity, 1)
+        self.assertAlmostEqual(cluster.eccentricity, 1)
+        self.assertAlmostEqual(cluster.density, 1)
+        self.assertAlmostEqual(cluster.minor_axis, 0)
+        self.assertAlmostEqual(cluster.orientation, 0)
+        # A square, whose charge is mostly in one corner
+        cluster.set_hits([1, 2, 1, 2], [1, 1, 2, 2], [1, 1, 1, 5])
+        self.assertAlmostEqual(cluster.major_axis, cluster.minor_axis)
+        self.assertAlmostEqual(cluster.linearity, 0)
+        self.assertEqual(cluster.centre_of_mass, (1.75, 1.75))
+        # A single pixel
+        cluster.set_hits([4], [4], [1])
+        self.assertEqual((cluster.track_length, cluster.eccentricity, cluster.density),
+                         (1, 0, 1))
+
+    def test_frame(self):
+        # Test 26.2
+        # The moments calculated for the whole frame at once are those of
+        # each cluster
+        for cluster in self.frame.clusters:
+            shape, mass = moments.from_hits(*cluster.hit_arrays())
+            for name in moments.SUMS:
+                self.assertAlmostEqual(getattr(cluster.moments, name), getattr(shape, name))
+                self.assertAlmostEqual(getattr(cluster.count_moments, name), getattr(mass, name))
+            xs, ys, counts = cluster.hit_arrays()
+            self.assertAlmostEqual(cluster.centre_of_mass[0], (xs * counts).sum() / float(counts.sum()))
+            var_x, cov_xy, var_y = cluster.moments.covariance
+            covariance = numpy.cov(numpy.vstack([xs, ys]), bias=1)
+            self.assertAlmostEqual(var_x, covariance[0, 0])
+            self.assertAlmostEqual(cov_xy, covariance[0, 1])
+            self.assertAlmostEqual(var_y, covariance[1, 1])
+        # Moments are recalculated when a cluster's hits change
+        cluster = self.frame.clusters[0]
+        cluster.set_hits([0, 1], [0, 0], [1, 1])
+        self.assertAlmostEqual(cluster.track_length, 2)
+
+class TestAttributeCache(unittest.TestCase):
+
+    def test_cache(self):
+        # Test 27.1
+        frame = Frame.from_file("test_frame.lsc")
+        frame.calculate_clusters()
+        cluster = frame.clusters[0]
+        self.assertEqual(cluster.attribute_cache, None)
+        uuid = attribute_value(cluster, "UUID", cache=True)
+        self.assertEqual(cluster.attribute_cache, {"UUID": uuid})
+        # Cached values are used until the hits change
+        cluster.attribute_cache["UUID"] = "cached"
+        self.assertEqual(attribute_value(cluster, "UUID", cache=True), "cached")
+        self.assertEqual(attribute_value(cluster, "UUID"), uuid)
+        cluster.set_hits(*cluster.hit_arrays())
+        self.assertEqual(attribute_value(cluster, "UUID", cache=True), uuid)
+        self.assertEqual(attribute_value(frame, "No. of clusters", cache=True), len(frame.clusters))
+        frame[(0, 0)] = Hit(1)
+        self.assertEqual(frame.attribute_cache, None)
+
+class TestFromLines(unittest.TestCase):
+
+    def test_from_lines(self):
+        # Test 28.1
+        with open("test_frame.lsc") as f:
+            lines = f.read().splitlines()
+        frame = Frame.from_lines(lines)
+        expected = Frame.from_file("test_frame.lsc")
+        self.assertEqual((frame.width, frame.height), (expected.width, expected.height))
+        self.assertEqual(dict((pixel, hit.value) for pixel, hit in frame.items()),
+                         dict((pixel, hit.value) for pixel, hit in expected.items()))
+        self.assertRaises(Exception, Frame.from_lines, ["0,0 1", "garbage"])
+
+class KernelTests(object):
+    """
+    The tests of the kernels, which are run against every backend by the
+    TestKernels classes below. Results are compared exactly with those of the
+    python backend.
+    """
+    backend = None
+
+    def setUp(self):
+        self.previous_backend = kernels.backend()
+        kernels.use(self.backend)
+
+    def tearDown(self):
+        kernels.use(self.previous_backend)
+
+    def reference(self, kernel, *args):
+        """
+        Returns the result of kernel with the python backend.
+        """
+        kernels.use("python")
+        try:
+            return kernel(*args)
+        finally:
+            kernels.use(self.backend)
+
+    def test_label(self):
+        # Test 29.1
+        pixels = [(0, 0), (1, 1), (5, 5), (2, 2), (6, 7), (5, 6), (9, 0)]
+        self.assertEqual(kernels.label(pixels), [0, 0, 1, 0, 1, 1, 2])
+        self.assertEqual(kernels.label([]), [])
+        frame = synthetic.synthetic_frame(occupancy=0.05, seed=4)
+        pixels = frame.keys()
+        self.assertEqual(kernels.label(pixels), self.reference(kernels.label, pixels))
+
+    def test_neighbour_counts(self):
+        # Test 29.2
+        occupancy = [[1, 1, 0],
+                     [0, 1, 0],
+                     [0, 0, 1]]
+        counts = kernels.neighbour_counts(occupancy)
+        self.assertEqual(counts.dtype, numpy.uint8)
+        self.assertEqual(counts.tolist(), [[2, 2, 2], [3, 3, 3], [1, 2, 1]])
+        self.assertEqual(kernels.neighbour_counts([[True]]).tolist(), [[0]])
+        occupancy = synthetic.synthetic_frame(occupancy=0.05, seed=5).render_energy() != 0
+        self.assertEqual(kernels.neighbour_counts(occupancy).tolist(),
+                         self.reference(kernels.neighbour_counts, occupancy).tolist())
+
+    def test_max_square_distance(self):
+        # Test 29.3
+        xs, ys = numpy.array([0, 3, 1]), numpy.array([0, 4, 1])
+        self.assertEqual(kernels.max_square_distance(xs, ys, 0.5, 0.5), 18.5)
+        self.assertRaises(ValueError, kernels.max_square_distance, [], [], 0, 0)
+        frame = synthetic.synthetic_frame(alphas=5, betas=5, muons=5, seed=6)
+        frame.calculate_clusters()
+        for cluster in frame.clusters:
+            xs, ys, counts = cluster.hit_arrays()
+            x, y = cluster.centre_of_mass
+            self.assertEqual(kernels.max_square_distance(xs, ys, x, y),
+                             self.reference(kernels.max_square_distance, xs, ys, x, y))
+
+    def test_square_distances(self):
+        # Test 29.4
+        points, others = [[0, 0], [1, 2]], [[3, 4], [1, 2], [0, 0]]
+        self.assertEqual(kernels.square_distances(points, others).tolist(),
+                         [[25, 5, 0], [8, 0, 5]])
+        self.assertEqual(kernels.square_distances(numpy.zeros((2, 0)), numpy.zeros((3, 0))).tolist(),
+                         [[0, 0, 0], [0, 0, 0]])
+        rng = numpy.random.RandomState(7)
+        points, others = rng.normal(size=(20, 6)), rng.normal(size=(30, 6)) * 100
+        self.assertEqual(kernels.square_distances(points, others).tolist(),
+                         self.reference(kernels.square_distances, points, others).tolist())
+
+    def test_clusters(self):
+        # Test 29.5
+        frame = Frame.from_file("test_frame.lsc")
+        frame.calculate_clusters()
+        self.assertEqual(sorted(sorted(cluster.hit_pixels) for cluster in frame.clusters),
+                         sorted(sorted(cluster) for cluster in CLUSTERS))
+        self.assertEqual(frame.get_max_neighbours(), (8, [(175, 11)]))
+        # The clusters, and their attributes, are the same as those of the
+        # python backend
+        def clusters(seed):
+            frame = synthetic.synthetic_frame(occupancy=0.05, seed=seed)
+            frame.calculate_clusters()
+            return [(cluster.hit_pixels, cluster.radius, cluster.most_neighbours)
+                    for cluster in frame.clusters]
+        self.assertEqual(clusters(8), self.reference(clusters, 8))
+
+class TestKernelsPython(KernelTests, unittest.TestCase):
+    backend = "python"
+
+class TestKernelsNumpy(KernelTests, unittest.TestCase):
+    backend = "numpy"
+
+@unittest.skipUnless("numba" in kernels.available(), "Numba isn't installed")
+class TestKernelsNumba(KernelTests, unittest.TestCase):
+    backend = "numba"
+
+class TestKernelSelection(unittest.TestCase):
+
+    def setUp(self):
+        self.previous_backend = kernels.backend()
+        self.previous_variable = os.environ.get("CRAYFISH_KERNELS")
+
+    def tearDown(self):
+        if self.previous_variable is None:
+            os.environ.pop("CRAYFISH_KERNELS", None)
+        else:
+            os.environ["CRAYFISH_KERNELS"] = self.previous_variable
+        kernels.use(self.previous_backend)
+
+    def test_environment(self):
+        # Test 30.1
+        os.environ["CRAYFISH_KERNELS"] = "python"
+        kernels.use()
+        self.assertEqual(kernels.backend(), "python")
+        # A backend that isn't available falls back to the first available
+        os.environ["CRAYFISH_KERNELS"] = "fortran"
+        with warnings.catch_warnings(record=True) as caught:
+            warnings.simplefilter("always")
+            kernels.use()
+        self.assertEqual(kernels.backend(), kernels.available()[0])
+        self.assertEqual(len(caught), 1)
+        self.assertIn("fortran", str(caught[0].message))
+        # Unless it is named explicitly
+        self.assertRaises(ValueError, kernels.use, "fortran")
+        self.assertEqual(kernels.backend(), kernels.available()[0])
+
 # Run the tests
 unittest.main(verbosity=2)
@@ -0,0 +1,179 @@
+"""
+Lightweight instrumentation of the hot paths of pypix and Crayfish.
+
+Functions are timed by decorating them with timed(stage), and events counted
+with count(counter). Nothing is recorded until enable() is called, and while
+disabled a timed function costs one extra function call and a flag check, so
+the decorators may be left on hot paths permanently.
+
+Times are inclusive, ie. a stage's time includes the time of any stages it
+calls. Recursive calls of a stage (eg. FolderNode.calculate_aggregate on sub
+folders) are counted as calls, but only the outermost call is timed so that
+time isn't counted twice. Stages and counters may be recorded from several
+threads at once (eg. the prefetching threads of Crayfish), and calls of the
+same stage in different threads are each timed.
+
+The report may be formatted as text with format_report, or written as JSON
+with write_json for comparing between versions.
+"""
+import functools
+import json
+import threading
+import time
+
+_enabled = False
+# Maps stage name to [calls, total seconds, maximum seconds]
+_stages = {}
+# Maps counter name to count
+_counters = {}
+# Guards _stages and _counters
+_lock = threading.Lock()
+# The calls in progress in each thread, whose active attribute maps stage name
+# to the number of calls of it the thread is in
+_local = threading.local()
+
+def enable(enabled=True):
+    """
+    Starts (or, if enabled is False, stops) recording timings and counts.
+    """
+    global _enabled
+    _enabled = enabled
+
+def is_enabled():
+    """
+    Returns True if timings and counts are being recorded.
+    """
+    return _enabled
+
+def reset():
+    """
+    Discards all recorded timings and counts.
+    """
+    with _lock:
+        _stages.clear()
+        _counters.clear()
+
+def record(stage, seconds):
+    """
+    Records a call of stage that took seconds. Usually called by timed or
+    Timer rather than directly.
+    """
+    with _lock:
+        stats = _stages.get(stage)
+        if stats is None:
+            _stages[stage] = [1, seconds, seconds]
+        else:
+            stats[0] += 1
+            stats[1] += seconds
+            if seconds > stats[2]:
+                stats[2] = seconds
+
+def count(counter, n=1):
+    """
+    Adds n to counter, if recording is enabled.
+    """
+    if _enabled:
+        with _lock:
+            _counters[counter] = _counters.get(counter, 0) + n
+
+def _active():
+    """
+    Returns the dictionary of the calls of each stage in progress in the
+    current thread.
+    """
+    active = getattr(_local, "active", None)
+    if active is None:
+        active = _local.active = {}
+    return active
+
+class Timer(object):
+    """
+    A context manager that times the block it wraps as a call of stage, if
+    recording is enabled::
+
+        with Timer("stage name"):
+            ...
+    """
+    def __init__(self, stage):
+        self.stage = stage
+
+    def __enter__(self):
+        self.start = time.time() if _enabled else None
+        if self.start is not None:
+            active = _active()
+            active[self.stage] = active.get(self.stage, 0) + 1
+        return self
+
+    def __exit__(self, *exc_info):
+        if self.start is not None:
+            active = _active()
+            active[self.stage] -= 1
+            if active[self.stage]:
+                # A recursive call, so count it but leave the timing to the
+                # outermost call
+                record(self.stage, 0.0)
+            else:
+                record(self.stage, time.time() - self.start)
+        return False
+
+def timed(stage):
+    """
+    A function decorator that records the time taken by each call of the
+    function as a call of stage, if recording is enabled.
+
+    Args:
+        stage: The name the function's timings are reported under
+    """
+    def decorator(function):
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            if not _enabled:
+                return function(*args, **kwargs)
+            with Timer(stage):
+                return function(*args, **kwargs)
+        return wrapper
+    return decorator
+
+def report():
+    """
+    Returns the recorded timings and counts as a dictionary of the form::
+
+        {"stages": {stage: {"calls": ..., "total": ..., "mean": ..., "max": ...}},
+         "counters": {counter: count}}
+
+    with times in seconds.
+    """
+    stages = {}
+    with _lock:
+        for stage, (calls, total, maximum) in _stages.items():
+            stages[stage] = {"calls": calls, "total": total,
+                             "mean": total/calls, "max": maximum}
+        counters = dict(_counters)
+    return {"stages": stages, "counters": counters}
+
+def format_report():
+    """
+    Returns the recorded timings and counts as a human readable table, with
+    the slowest stages first.
+    """
+    data = report()
+    lines = ["%-40s %8s %10s %10s %10s" % ("Stage", "Calls", "Total (s)", "Mean (ms)", "Max (ms)")]
+    for stage, stats in sorted(data["stages"].items(), key=lambda item: -item[1]["total"]):
+        lines.append("%-40s %8d %10.3f %10.3f %10.3f" % (stage, stats["calls"],
+                stats["total"], stats["mean"]*1000, stats["max"]*1000))
+    if data["counters"]:
+        lines.append("")
+        lines.append("%-40s %8s" % ("Counter", "Count"))
+        for counter, value in sorted(data["counters"].items()):
+            lines.append("%-40s %8d" % (counter, value))
+    return "\n".join(lines)
+
+def write_json(filepath):
+    """
+    Writes the report, along with the time it was written, to filepath as
+    JSON.
+    """
+    data = report()
+    data["timestamp"] = time.time()
+    with open(filepath, "w") as f:
+        json.dump(data, f, indent=2, sort_keys=True)
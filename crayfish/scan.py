@@ -0,0 +1,267 @@
+"""
+Indexes directory trees of frame files, for building the file tree quickly on
+large archives and network filesystems.
+
+Folders are listed with scandir where available (os.scandir, or the scandir
+backport on Python 2), which reuses the file type returned with each
+directory entry rather than making a stat call per entry to find folders.
+Subtrees may be scanned with several threads at once, so that the latency of
+a network filesystem is overlapped.
+
+The index may be saved as a JSON manifest of the folders, and the name, size
+and modification time of every frame file, so that reopening a large archive
+doesn't walk the filesystem again. A manifest's folders are revalidated
+lazily: each folder is only relisted if its modification time, or the size or
+modification time of one of its files, has changed since it was indexed.
+Files rewritten in place don't change the modification time of their folder,
+so they are stat'ed as well.
+"""
+import fnmatch
+import hashlib
+import json
+import os
+import re
+from multiprocessing.pool import ThreadPool
+
+try:
+    from os import scandir
+except ImportError:
+    try:
+        from scandir import scandir
+    except ImportError:
+        scandir = None
+
+from pypix import timing
+import archive
+
+# Where manifests are saved by default
+MANIFEST_DIR = os.path.join(os.path.expanduser("~"), ".crayfish", "manifests")
+MANIFEST_VERSION = 2
+
+# The number of threads used to scan subtrees
+SCAN_THREADS = 8
+
+def compile_pattern(extension_pattern):
+    """
+    Returns a function that returns True if a file name matches the shell
+    style extension_pattern, eg. "*.lsc". This behaves as fnmatch.fnmatch but
+    compiles the pattern only once.
+    """
+    match = re.compile(fnmatch.translate(os.path.normcase(extension_pattern))).match
+    return lambda name: match(os.path.normcase(name)) is not None
+
+def list_folder(path, matches):
+    """
+    Lists the folder at path.
+
+    Args:
+        path: The path of the folder
+
+        matches: A function that returns True for the names of files to
+        include, see compile_pattern
+
+    Returns a dictionary with keys "mtime" (the modification time of the
+    folder), "folders" (a sorted list of the names of sub folders), "files"
+    (a sorted list of [name, size, mtime] for each matching file) and
+    "archives" (the same for each archive, see archive.py).
+    """
+    folders = []
+    files = []
+    archives = []
+    if scandir is not None:
+        for entry in scandir(path):
+            if entry.is_dir():
+                folders.append(entry.name)
+            elif matches(entry.name) or archive.is_archive(entry.name):
+                stat = entry.stat()
+                (files if matches(entry.name) else archives).append(
+                        [entry.name, stat.st_size, stat.st_mtime])
+    else:
+        for name in os.listdir(path):
+            item_path = os.path.join(path, name)
+            if os.path.isdir(item_path):
+                folders.append(name)
+            elif matches(name) or archive.is_archive(name):
+                stat = os.stat(item_path)
+                (files if matches(name) else archives).append([name, stat.st_size, stat.st_mtime])
+    timing.count("folders listed")
+    return {"mtime": os.stat(path).st_mtime, "folders": sorted(folders),
+            "files": sorted(files), "archives": sorted(archives)}
+
+class DirectoryIndex(object):
+    """
+    An index of the frame files in the directory tree below root that match
+    extension_pattern.
+
+    Folders are indexed on demand by folder, or in bulk by scan.
+    """
+    def __init__(self, root, extension_pattern):
+        self.root = os.path.abspath(root)
+        self.extension_pattern = extension_pattern
+        self._matches = compile_pattern(extension_pattern)
+        # Maps absolute folder path to its listing, see list_folder
+        self.folders = {}
+        # Folders loaded from a manifest, which must be revalidated before use
+        self._unvalidated = set()
+        self.modified = False
+
+    @staticmethod
+    def manifest_path(root, extension_pattern):
+        """
+        Returns the default manifest filepath for root and extension_pattern.
+        """
+        key = "%s\n%s" % (os.path.abspath(root), extension_pattern)
+        if not isinstance(key, bytes):
+            key = key.encode("utf-8")
+        return os.path.join(MANIFEST_DIR, hashlib.sha1(key).hexdigest() + ".json")
+
+    @classmethod
+    def open(cls, root, extension_pattern, manifest_path=None):
+        """
+        Returns an index of root, loaded from its manifest if one exists.
+
+        Args:
+            manifest_path: The manifest filepath, defaults to manifest_path()
+        """
+        index = cls(root, extension_pattern)
+        if manifest_path is None:
+            manifest_path = cls.manifest_path(root, extension_pattern)
+        try:
+            with open(manifest_path) as f:
+                manifest = json.load(f)
+        except (IOError, OSError, ValueError):
+            return index
+        if (manifest.get("version") == MANIFEST_VERSION and
+                manifest.get("extension_pattern") == extension_pattern):
+            for relative_path, listing in manifest["folders"].items():
+                path = os.path.normpath(os.path.join(index.root, relative_path))
+                index.folders[path] = listing
+            index._unvalidated = set(index.folders)
+        return index
+
+    def save(self, manifest_path=None):
+        """
+        Saves the index as a JSON manifest, if it has changed since it was
+        opened.
+
+        Args:
+            manifest_path: The manifest filepath, defaults to manifest_path()
+        """
+        if not self.modified:
+            return
+        if manifest_path is None:
+            manifest_path = self.manifest_path(self.root, self.extension_pattern)
+        if not os.path.isdir(os.path.dirname(manifest_path)):
+            os.makedirs(os.path.dirname(manifest_path))
+        folders = dict((os.path.relpath(path, self.root), listing)
+                       for path, listing in self.folders.items())
+        with open(manifest_path, "w") as f:
+            json.dump({"version": MANIFEST_VERSION,
+                       "extension_pattern": self.extension_pattern,
+                       "folders": folders}, f)
+        self.modified = False
+
+    def _is_current(self, path):
+        """
+        Returns True if the indexed listing of path is still valid, checking
+        the modification time of the folder, and the size and modification
+        time of each of its files, if it came from a manifest or has been
+        invalidated.
+        """
+        if path not in self.folders:
+            return False
+        if path in self._unvalidated:
+            if not self._unchanged(path):
+                return False
+            self._unvalidated.discard(path)
+        return True
+
+    def _unchanged(self, path):
+        """
+        Returns True if the modification time of the folder at path, and the
+        size and modification time of each of its files, are those of its
+        indexed listing. Doesn't modify the index, so it may be called from
+        the threads of scan.
+        """
+        listing = self.folders[path]
+        try:
+            if os.stat(path).st_mtime != listing["mtime"]:
+                return False
+            for name, size, mtime in listing["files"] + listing.get("archives", []):
+                stat = os.stat(os.path.join(path, name))
+                if (stat.st_size, stat.st_mtime) != (size, mtime):
+                    return False
+        except OSError:
+            return False
+        return True
+
+    def _refresh(self, path):
+        """
+        Returns a new listing of the folder at path, or None if its indexed
+        listing is still valid (see _is_current). Doesn't modify the index.
+        """
+        if path in self.folders and (path not in self._unvalidated or self._unchanged(path)):
+            return None
+        return list_folder(path, self._matches)
+
+    def invalidate(self, path=None):
+        """
+        Marks the indexed folders at and below path (defaults to root) to be
+        revalidated against the modification times of the folders and their
+        files when they are next used, to pick up changes made since they
+        were listed.
+        """
+        path = os.path.abspath(path or self.root)
+        prefix = os.path.join(path, "")
+        self._unvalidated.update(folder_path for folder_path in self.folders
+                                 if folder_path == path or folder_path.startswith(prefix))
+
+    def _store(self, path, listing):
+        self.folders[path] = listing
+        self._unvalidated.discard(path)
+        self.modified = True
+
+    def folder(self, path):
+        """
+        Returns the listing of the folder at path (see list_folder), listing
+        it if it isn't indexed or has changed.
+        """
+        path = os.path.abspath(path)
+        if not self._is_current(path):
+            self._store(path, list_folder(path, self._matches))
+        return self.folders[path]
+
+    @timing.timed("DirectoryIndex.scan")
+    def scan(self, path=None, threads=SCAN_THREADS):
+        """
+        Indexes every folder below path (defaults to root), revalidating or
+        listing the folders of each level of the tree concurrently with
+        threads threads.
+        """
+        pending = [os.path.abspath(path or self.root)]
+        # The pool is only started once there are folders to revalidate or
+        # list concurrently, as rescanning a validated tree does neither
+        pool = None
+        try:
+            while pending:
+                # The folders that aren't indexed or must be revalidated,
+                # whose files are stat'ed in the pool along with the listing
+                stale = [folder_path for folder_path in pending
+                         if folder_path not in self.folders or folder_path in self._unvalidated]
+                if threads > 1 and len(stale) > 1:
+                    if pool is None:
+                        pool = ThreadPool(threads)
+                    listings = pool.map(self._refresh, stale)
+                else:
+                    listings = [self._refresh(folder_path) for folder_path in stale]
+                for folder_path, listing in zip(stale, listings):
+                    if listing is None:
+                        self._unvalidated.discard(folder_path)
+                    else:
+                        self._store(folder_path, listing)
+                pending = [os.path.join(folder_path, name) for folder_path in pending
+                           for name in self.folders[folder_path]["folders"]]
+        finally:
+            if pool:
+                pool.close()
+                pool.join()
@@ -0,0 +1,710 @@
+import os
+import shutil
+import tarfile
+import tempfile
+import threading
+import unittest
+import zipfile
+
+import numpy
+
+import pypix
+from pypix import filters, synthetic, timing
+import algorithms
+import archive
+import batch
+import dataset
+import folder
+import prefetch
+import scan
+
+def write_frames(directory, names, seed=0, **track_counts):
+    """
+    Writes a synthetic frame to each of names in directory, creating the
+    directory if it doesn't exist, and returns the paths of the frames.
+    """
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+    paths = []
+    for i, name in enumerate(names):
+        frame = synthetic.synthetic_frame(seed=seed + i, **(track_counts or {"alphas": 2, "betas": 2}))
+        paths.append(os.path.join(directory, name))
+        synthetic.write_frame(frame, paths[-1])
+    return paths
+
+def set_mtime(path, mtime):
+    os.utime(path, (mtime, mtime))
+
+def training_data(frame):
+    """
+    Returns the training data of the clusters of frame, as written by the
+    GUI, with the clusters given the default classes in turn.
+    """
+    names = [name for name in pypix.class_registry.names if name != "Unclassified"]
+    for i, cluster in enumerate(frame.clusters):
+        cluster.manual_class = names[i % len(names)]
+    header = ["UUID", "Classification"] + [attr for attr in pypix.attribute_table
+                if issubclass(pypix.Cluster, pypix.attribute_table[attr][1]) and
+                    pypix.attribute_table[attr][3]]
+    return [",".join(header)] + frame.get_training_rows().split("\n")
+
+class TestScan(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        write_frames(self.directory, ["b.lsc", "a.lsc"])
+        write_frames(os.path.join(self.directory, "run2"), ["c.lsc"])
+        write_frames(os.path.join(self.directory, "run1"), ["d.lsc"])
+        open(os.path.join(self.directory, "notes.txt"), "w").close()
+        open(os.path.join(self.directory, "frames.zip"), "w").close()
+        self.matches = scan.compile_pattern("*.lsc")
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+        timing.enable(False)
+        timing.reset()
+
+    def list_folder(self, path, scandir):
+        previous, scan.scandir = scan.scandir, scandir
+        try:
+            return scan.list_folder(path, self.matches)
+        finally:
+            scan.scandir = previous
+
+    def test_list_folder(self):
+        # Test 1.1
+        listing = self.list_folder(self.directory, None)
+        self.assertEqual(listing["folders"], ["run1", "run2"])
+        self.assertEqual([name for name, size, mtime in listing["files"]], ["a.lsc", "b.lsc"])
+        self.assertEqual([name for name, size, mtime in listing["archives"]], ["frames.zip"])
+        stat = os.stat(os.path.join(self.directory, "a.lsc"))
+        self.assertEqual(listing["files"][0][1:], [stat.st_size, stat.st_mtime])
+        self.assertEqual(listing["mtime"], os.stat(self.directory).st_mtime)
+
+    @unittest.skipUnless(scan.scandir is not None, "scandir isn't installed")
+    def test_list_folder_scandir(self):
+        # Test 1.2
+        self.assertEqual(self.list_folder(self.directory, scan.scandir),
+                         self.list_folder(self.directory, None))
+
+    def test_manifest(self):
+        # Test 1.3
+        manifest_path = os.path.join(tempfile.mkdtemp(), "manifests", "manifest.json")
+        self.addCleanup(shutil.rmtree, os.path.dirname(os.path.dirname(manifest_path)))
+        index = scan.DirectoryIndex(self.directory, "*.lsc")
+        index.scan()
+        self.assertTrue(index.modified)
+        index.save(manifest_path)
+        self.assertFalse(index.modified)
+        # The folders of a manifest are reused without listing them again
+        timing.enable()
+        loaded = scan.DirectoryIndex.open(self.directory, "*.lsc", manifest_path)
+        self.assertEqual(loaded.folders, index.folders)
+        loaded.scan()
+        self.assertEqual(loaded.folder(self.directory), index.folder(self.directory))
+        self.assertFalse(loaded.modified)
+        self.assertEqual(timing.report()["counters"].get("folders listed", 0), 0)
+        # Manifests of another version or pattern are ignored
+        with open(manifest_path) as f:
+            manifest = f.read()
+        self.assertEqual(scan.DirectoryIndex.open(self.directory, "*.txt", manifest_path).folders, {})
+        with open(manifest_path, "w") as f:
+            f.write(manifest.replace('"version": %d' % scan.MANIFEST_VERSION,
+                                     '"version": %d' % (scan.MANIFEST_VERSION - 1)))
+        self.assertEqual(scan.DirectoryIndex.open(self.directory, "*.lsc", manifest_path).folders, {})
+
+    def test_invalidate(self):
+        # Test 1.4
+        index = scan.DirectoryIndex(self.directory, "*.lsc")
+        index.scan()
+        run1 = os.path.join(self.directory, "run1")
+        timing.enable()
+        # Changes aren't looked for until the folders are invalidated
+        write_frames(run1, ["e.lsc"])
+        set_mtime(run1, os.stat(run1).st_mtime + 10)
+        self.assertTrue(index._is_current(run1))
+        # Invalidated folders are only listed again if they have changed
+        index.invalidate()
+        self.assertTrue(index._is_current(self.directory))
+        self.assertFalse(index._is_current(run1))
+        index.scan()
+        self.assertEqual(timing.report()["counters"]["folders listed"], 1)
+        self.assertEqual([name for name, size, mtime in index.folder(run1)["files"]],
+                         ["d.lsc", "e.lsc"])
+
+    def test_revalidate_threads(self):
+        # Test 1.5
+        index = scan.DirectoryIndex(self.directory, "*.lsc")
+        index.scan()
+        threads = {}
+        unchanged = index._unchanged
+        def record(path):
+            threads[path] = threading.current_thread()
+            return unchanged(path)
+        index._unchanged = record
+        # The files of each level of folders are stat'ed by the pool
+        index.invalidate()
+        timing.enable()
+        index.scan(threads=2)
+        self.assertEqual(sorted(threads), sorted([self.directory, os.path.join(self.directory, "run1"),
+                                                  os.path.join(self.directory, "run2")]))
+        self.assertIs(threads.pop(self.directory), threading.current_thread())
+        self.assertTrue(all(thread is not threading.current_thread() for thread in threads.values()))
+        self.assertEqual(timing.report()["counters"].get("folders listed", 0), 0)
+        self.assertFalse(index._unvalidated)
+        # A file rewritten in place is listed again
+        run2 = os.path.join(self.directory, "run2")
+        write_frames(run2, ["c.lsc"], seed=5, alphas=6)
+        set_mtime(os.path.join(run2, "c.lsc"), os.stat(os.path.join(run2, "c.lsc")).st_mtime + 10)
+        index.invalidate()
+        index.scan(threads=2)
+        self.assertEqual(timing.report()["counters"]["folders listed"], 1)
+        self.assertEqual(index.folder(run2)["files"][0][1:],
+                         [os.stat(os.path.join(run2, "c.lsc")).st_size,
+                          os.stat(os.path.join(run2, "c.lsc")).st_mtime])
+
+class TestBatch(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        frame = synthetic.synthetic_frame(alphas=10, betas=10, muons=5, noise=10, seed=1)
+        frame.calculate_clusters()
+        self.classifier = algorithms.KNN(None)
+        self.classifier.train(training_data(frame))
+        self.classifier.k = 5
+        self.classifier._dimensions = [0, 2, 3, 6]
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def classify(self, cluster):
+        """
+        The per-cluster classification of KNN before classify_all, with ties
+        of the modal class going to the lowest code.
+        """
+        dimensions = self.classifier.selected_dimensions()
+        point = [self.classifier.functions[i](cluster) for i in dimensions]
+        distances = []
+        for code, training_point in self.classifier.training_data:
+            differences = [point[j] - training_point[i] for j, i in enumerate(dimensions)]
+            distances.append((sum([d * d for d in differences]), code))
+        nearest = [code for distance, code in sorted(distances, key=lambda x: x[0])[:self.classifier.k]]
+        counts = dict((code, nearest.count(code)) for code in nearest)
+        return min(code for code in counts if counts[code] == max(counts.values()))
+
+    def test_classify_all(self):
+        # Test 2.1
+        frame = synthetic.synthetic_frame(alphas=20, betas=20, muons=10, noise=20, seed=2)
+        frame.calculate_clusters()
+        previous, algorithms.KNN.CHUNK_SIZE = algorithms.KNN.CHUNK_SIZE, 7
+        try:
+            self.classifier.classify_all(frame.clusters)
+        finally:
+            algorithms.KNN.CHUNK_SIZE = previous
+        self.assertEqual([cluster.algorithm_class_code for cluster in frame.clusters],
+                         [self.classify(cluster) for cluster in frame.clusters])
+        self.assertTrue(len(set(cluster.algorithm_class_code for cluster in frame.clusters)) > 1)
+
+    def test_processes(self):
+        # Test 2.2
+        paths = write_frames(os.path.join(self.directory, "frames"),
+                             ["%d.lsc" % i for i in range(7)], seed=3, alphas=3, betas=3, muons=1)
+        open(os.path.join(self.directory, "frames", "broken.lsc"), "w").write("1\t2\n")
+        paths.insert(3, os.path.join(self.directory, "frames", "broken.lsc"))
+        results = []
+        for processes in (1, 3):
+            results_path = os.path.join(self.directory, "%d.csv" % processes)
+            summary = batch.classify_frames(self.classifier, paths, results_path,
+                                            processes=processes, chunk_size=2)
+            with open(results_path) as f:
+                results.append((f.read(), summary))
+        self.assertEqual(results[0], results[1])
+        self.assertEqual(summary["frames"], 7)
+        self.assertEqual([path for path, message in summary["errors"]], [paths[3]])
+        self.assertEqual(len(results[0][0].splitlines()), summary["clusters"] + 1)
+
+class TestDataset(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.root = os.path.join(self.directory, "frames")
+        self.paths = write_frames(self.root, ["a.lsc", "b.lsc"], seed=0)
+        self.paths += write_frames(os.path.join(self.root, "run1"), ["c.lsc", "d.lsc"], seed=2,
+                                   alphas=1, betas=4, muons=1)
+        for i, path in enumerate(self.paths):
+            set_mtime(path, 1000 + 100 * i)
+        self.index_path = os.path.join(self.directory, "index.sqlite")
+        self.dataset = dataset.Dataset(self.index_path, self.root, "*.lsc")
+        self.assertEqual(self.dataset.update(), 4)
+
+    def tearDown(self):
+        self.dataset.close()
+        pypix.pixel_mask.clear()
+        pypix.energy_calibration.clear()
+        shutil.rmtree(self.directory)
+
+    def reopen(self):
+        self.dataset.close()
+        self.dataset = dataset.Dataset(self.index_path)
+
+    def test_update(self):
+        # Test 3.1
+        self.reopen()
+        self.assertEqual(self.dataset.root, self.root)
+        self.assertEqual(self.dataset.update(), 0)
+        # Only new and changed frames are indexed again
+        write_frames(self.root, ["a.lsc"], seed=5, alphas=5)
+        os.remove(self.paths[1])
+        write_frames(os.path.join(self.root, "run2"), ["e.lsc"])
+        self.assertEqual(self.dataset.update(processes=2), 2)
+        self.assertEqual([row["path"] for row in self.dataset.frames()],
+                         ["a.lsc", os.path.join("run1", "c.lsc"), os.path.join("run1", "d.lsc"),
+                          os.path.join("run2", "e.lsc")])
+        self.assertEqual(self.dataset.folder(self.root)["folders"], ["run1", "run2"])
+        frame = pypix.Frame.from_file(self.paths[0])
+        frame.calculate_clusters()
+        row = self.dataset.frames(max_hits=len(frame))[0]
+        self.assertEqual((row["path"], row["number_of_hits"], row["number_of_clusters"]),
+                         ("a.lsc", len(frame), len(frame.clusters)))
+        self.assertEqual(self.dataset._get_meta("mask"), pypix.pixel_mask.digest())
+
+    def test_frames(self):
+        # Test 3.2
+        def paths(**conditions):
+            return [row["path"] for row in self.dataset.frames(**conditions)]
+        run1 = [os.path.join("run1", "c.lsc"), os.path.join("run1", "d.lsc")]
+        self.assertEqual(paths(), ["a.lsc", "b.lsc"] + run1)
+        self.assertEqual(paths(path=os.path.join(self.root, "run1")), run1)
+        self.assertEqual(paths(path=self.root), paths())
+        self.assertEqual(paths(start=1100, end=1300), ["b.lsc", run1[0]])
+        hits = sorted(row["number_of_hits"] for row in self.dataset.frames())
+        self.assertEqual(len(paths(min_hits=hits[1], max_hits=hits[2])), 2)
+        clusters = dict((row["path"], row["number_of_clusters"]) for row in self.dataset.frames())
+        self.assertEqual(paths(min_clusters=clusters["b.lsc"], max_clusters=clusters["b.lsc"]),
+                         [path for path in sorted(clusters) if clusters[path] == clusters["b.lsc"]])
+
+    def test_aggregate(self):
+        # Test 3.3
+        expected = folder.FolderNode(self.root).calculate_aggregate("*.lsc")
+        aggregate = self.dataset.aggregate()
+        self.assertEqual(dict((pixel, hit.value) for pixel, hit in aggregate.items()),
+                         dict((pixel, hit.value) for pixel, hit in expected.items()))
+        self.assertEqual(len(aggregate.clusters), len(expected.clusters))
+        self.assertEqual(aggregate.pixel_statistics.frames, 4)
+        numpy.testing.assert_allclose(aggregate.pixel_statistics.layer("Mean"),
+                                      expected.pixel_statistics.layer("Mean"))
+        # The attributes of the clusters are read from the index
+        volumes = sorted(cluster.indexed_attributes["Volume"] for cluster in aggregate.clusters)
+        self.assertEqual(volumes, sorted(cluster.volume for cluster in expected.clusters))
+        self.assertEqual(sorted(self.dataset.cluster_column("Volume").tolist()), volumes)
+        # Filters are evaluated on the indexed attributes
+        filtered = self.dataset.aggregate(os.path.join(self.root, "run1"),
+                                          cluster_filter=filters.Filter.parse("Volume > 100"))
+        self.assertTrue(filtered.clusters)
+        self.assertTrue(all(cluster.volume > 100 for cluster in filtered.clusters))
+        self.assertEqual(filtered.pixel_statistics.frames, 2)
+
+    def test_layout(self):
+        # Test 3.4
+        previous, dataset.SCHEMA_VERSION = dataset.SCHEMA_VERSION, dataset.SCHEMA_VERSION + 1
+        try:
+            self.reopen()
+            self.assertEqual(self.dataset.frames(), [])
+            self.assertEqual(self.dataset.update(), 4)
+        finally:
+            dataset.SCHEMA_VERSION = previous
+        # The index is rebuilt again for the original layout
+        self.reopen()
+        self.assertEqual(self.dataset.frames(), [])
+
+    def test_invalidation(self):
+        # Test 3.5
+        pypix.pixel_mask.set_pixels([(0, 0)])
+        self.assertEqual(self.dataset.update(), 4)
+        self.assertEqual(self.dataset.update(), 0)
+        calibration = os.path.join(self.directory, "calibration")
+        os.makedirs(calibration)
+        for name in pypix.calibration.PARAMETERS:
+            numpy.save(os.path.join(calibration, name + ".npy"), numpy.ones((256, 256)))
+        pypix.energy_calibration.load(calibration)
+        self.assertEqual(self.dataset.update(), 4)
+        pypix.energy_calibration.clear()
+        self.assertEqual(self.dataset.update(), 4)
+        self.assertEqual(self.dataset.update(), 0)
+
+class TestAggregate(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.paths = write_frames(self.directory, ["a.lsc", "b.lsc"], seed=0)
+        self.paths += write_frames(os.path.join(self.directory, "run1"), ["c.lsc"], seed=2)
+        self.paths += write_frames(os.path.join(self.directory, "run2"), ["d.lsc"], seed=3)
+        for path in [self.directory] + [os.path.dirname(path) for path in self.paths[2:]]:
+            set_mtime(path, 1000)
+        self.node = folder.FolderNode(self.directory)
+        self.node.calculate_aggregate("*.lsc")
+        timing.enable()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+        timing.enable(False)
+        timing.reset()
+
+    def assertCurrent(self, aggregate):
+        """
+        Asserts that aggregate is the aggregate of a node that hasn't been
+        aggregated before. The reads of the new node aren't counted.
+        """
+        counters = dict(timing.report()["counters"])
+        expected = folder.FolderNode(self.directory).calculate_aggregate("*.lsc")
+        timing.reset()
+        for name, value in counters.items():
+            timing.count(name, value)
+        self.assertEqual(dict((pixel, hit.value) for pixel, hit in aggregate.items()),
+                         dict((pixel, hit.value) for pixel, hit in expected.items()))
+        self.assertEqual(aggregate.volume, expected.volume)
+        self.assertEqual(len(aggregate.clusters), len(expected.clusters))
+        self.assertEqual(aggregate.pixel_statistics.frames, expected.pixel_statistics.frames)
+
+    def frames_read(self):
+        return timing.report()["counters"].get("frames read", 0)
+
+    def test_merge(self):
+        # Test 4.1
+        chip = folder.Aggregate.from_hits(256, 256, [10, 20], [20, 0], [5, 1], ["a"])
+        quad = folder.Aggregate.from_hits(512, 512, [10, 300], [20, 400], [3, 7], ["b", "c"])
+        merged = folder.Aggregate.merge([chip, quad])
+        self.assertEqual((merged.width, merged.height), (512, 512))
+        self.assertEqual(merged.pixels.tolist(), [20, 20 * 512 + 10, 400 * 512 + 300])
+        self.assertEqual(merged.counts.tolist(), [1, 8, 7])
+        self.assertEqual(merged.clusters, ["a", "b", "c"])
+        self.assertEqual(merged.statistics.frames, 2)
+        self.assertEqual(merged.statistics.layer("Maximum")[20, 10], 5)
+        frame = merged.to_frame()
+        self.assertEqual((frame[(10, 20)].value, frame[(300, 400)].value), (8, 7))
+        # Empty aggregates are at least the size of a chip
+        self.assertEqual((folder.Aggregate.merge([]).width, folder.Aggregate.merge([]).height),
+                         (256, 256))
+
+    def test_reuse(self):
+        # Test 4.2
+        run1, run2 = self.node.sub_folders
+        run1_aggregate = run1._memo[-1]
+        frames_aggregate = self.node._memo[-2]
+        # Unchanged folders aren't aggregated again
+        aggregate = self.node.calculate_aggregate("*.lsc")
+        self.assertIs(self.node._memo[-1], self.node._frame_aggregate)
+        self.assertEqual(self.frames_read(), 0)
+        # Only the changed sub folder is, and the rest are merged,
+        write_frames(os.path.join(self.directory, "run2"), ["e.lsc"], seed=4)
+        set_mtime(os.path.join(self.directory, "run2"), 1010)
+        aggregate = self.node.calculate_aggregate("*.lsc")
+        # Of which only the new frame is read
+        self.assertEqual(self.frames_read(), 1)
+        self.assertIs(run1._memo[-1], run1_aggregate)
+        self.assertIs(self.node._memo[-2], frames_aggregate)
+        self.assertCurrent(aggregate)
+
+    def test_invalidation(self):
+        # Test 4.3
+        # Rewrite a frame in place, which leaves its folder's modification
+        # time unchanged
+        write_frames(self.directory, ["b.lsc"], seed=5, alphas=6)
+        set_mtime(self.paths[1], os.stat(self.paths[1]).st_mtime + 10)
+        set_mtime(self.directory, 1000)
+        aggregate = self.node.calculate_aggregate("*.lsc")
+        self.assertEqual(self.frames_read(), 1)
+        self.assertCurrent(aggregate)
+        # Removing a frame removes its part of the aggregate
+        os.remove(self.paths[0])
+        aggregate = self.node.calculate_aggregate("*.lsc")
+        self.assertEqual(self.frames_read(), 1)
+        self.assertCurrent(aggregate)
+        # And the aggregate is remade when the pixel mask changes
+        pypix.pixel_mask.set_pixels([(0, 0)])
+        try:
+            self.node.calculate_aggregate("*.lsc")
+        finally:
+            pypix.pixel_mask.clear()
+        self.assertEqual(self.frames_read(), 4)
+
+class StubNode(object):
+    """
+    A stand in for a folder.FrameNode, which reads a synthetic frame and
+    counts its reads. Reads set the event started, then wait for the event
+    gate if given.
+    """
+    def __init__(self, path, gate=None):
+        self.path = path
+        self.gate = gate
+        self.started = threading.Event()
+        self.reads = 0
+        self._frame = None
+        self._load_version = None
+
+    @property
+    def is_read(self):
+        return self._frame is not None and self._load_version == pypix.load_version()
+
+    @property
+    def frame(self):
+        if not self.is_read:
+            self.keep(self.read_file(), pypix.load_version())
+        return self._frame
+
+    def read_file(self):
+        self.started.set()
+        if self.gate is not None:
+            self.gate.wait()
+        self.reads += 1
+        return synthetic.synthetic_frame(alphas=1, betas=1, seed=len(self.path))
+
+    def keep(self, frame, load_version):
+        self._frame = frame
+        self._load_version = load_version
+
+    def release(self):
+        self._frame = None
+
+class TestPrefetch(unittest.TestCase):
+
+    def setUp(self):
+        self.nodes = [StubNode("frame%d" % i) for i in range(10)]
+
+    def tearDown(self):
+        pypix.pixel_mask.clear()
+
+    def prefetcher(self, **options):
+        prefetcher = prefetch.Prefetcher(**options)
+        self.addCleanup(prefetcher.stop)
+        return prefetcher
+
+    def wait(self, prefetcher):
+        """
+        Waits for prefetcher to finish reading its queue.
+        """
+        with prefetcher._condition:
+            while prefetcher._queue or prefetcher._loading:
+                prefetcher._condition.wait()
+
+    def test_hits(self):
+        # Test 5.1
+        prefetcher = self.prefetcher(lookahead=2)
+        frame = prefetcher.select(self.nodes[0], self.nodes)
+        self.assertTrue(frame.clusters)
+        self.wait(prefetcher)
+        self.assertEqual([node.reads for node in self.nodes[:4]], [1, 1, 1, 0])
+        # Stepping forwards selects the prefetched frames
+        for node in self.nodes[1:3]:
+            self.assertTrue(prefetcher.select(node, self.nodes).clusters)
+            self.wait(prefetcher)
+        self.assertEqual(prefetcher.stats, {"hits": 2, "misses": 1, "cancelled": 0})
+        self.assertEqual([node.reads for node in self.nodes[:5]], [1, 1, 1, 1, 1])
+        # Stepping backwards prefetches the previous frames
+        prefetcher.select(self.nodes[9], self.nodes)
+        prefetcher.select(self.nodes[8], self.nodes)
+        self.wait(prefetcher)
+        self.assertEqual([node.reads for node in self.nodes[5:]], [0, 1, 1, 1, 1])
+
+    def test_select_remade_nodes(self):
+        # Test 5.2
+        prefetcher = self.prefetcher(lookahead=2)
+        prefetcher.select(self.nodes[0], self.nodes)
+        self.wait(prefetcher)
+        # The nodes of a folder listed again are matched by path
+        remade = [StubNode(node.path) for node in self.nodes]
+        prefetcher.select(remade[1], remade)
+        self.wait(prefetcher)
+        self.assertEqual(prefetcher.stats["hits"], 1)
+        self.assertEqual([node.reads for node in remade[:4]], [0, 0, 0, 1])
+        # A node that isn't one of the siblings is read without prefetching
+        other = StubNode("other")
+        self.assertTrue(prefetcher.select(other, remade[:3]).clusters)
+        self.wait(prefetcher)
+        self.assertEqual(other.reads, 1)
+        self.assertEqual(sum(node.reads for node in remade), 1)
+
+    def test_cancel(self):
+        # Test 5.3
+        gate = threading.Event()
+        self.nodes = [StubNode("frame%d" % i, gate) for i in range(10)]
+        prefetcher = self.prefetcher(lookahead=3)
+        gate.set()
+        prefetcher.get(self.nodes[0])
+        gate.clear()
+        prefetcher.prefetch(self.nodes[1:4])
+        # Wait for the first prefetch to start, then move on
+        self.nodes[1].started.wait()
+        prefetcher.prefetch(self.nodes[6:9])
+        self.assertEqual(prefetcher.stats["cancelled"], 2)
+        prefetcher.clear()
+        self.assertEqual(prefetcher.stats["cancelled"], 2)
+        gate.set()
+        self.wait(prefetcher)
+        self.assertEqual([node.reads for node in self.nodes], [1, 1, 0, 0, 0, 0, 0, 0, 0, 0])
+
+    def test_eviction(self):
+        # Test 5.4
+        prefetcher = self.prefetcher(lookahead=4, max_frames=2)
+        prefetcher.select(self.nodes[0], self.nodes)
+        self.wait(prefetcher)
+        self.assertEqual(list(prefetcher._frames), ["frame3", "frame4"])
+        # The oldest prefetched frames are dropped
+        prefetcher.get(self.nodes[1])
+        prefetcher.get(self.nodes[3])
+        self.assertEqual((prefetcher.stats["hits"], prefetcher.stats["misses"]), (1, 2))
+        # As are the frames of all but the last max_frames nodes selected
+        self.assertEqual([node.is_read for node in self.nodes[:4]], [False, True, False, True])
+        # Unless they have been classified by hand
+        node = folder.FrameNode("frame.lsc", "*.lsc")
+        frame = synthetic.synthetic_frame(alphas=1, seed=0)
+        frame.calculate_clusters()
+        node.keep(frame, pypix.load_version())
+        node.release()
+        self.assertFalse(node.is_read)
+        frame.clusters[0].manual_class = "Alpha"
+        node.keep(frame, pypix.load_version())
+        node.release()
+        self.assertTrue(node.is_read)
+
+    def test_load_version(self):
+        # Test 5.5
+        prefetcher = self.prefetcher(lookahead=1)
+        prefetcher.select(self.nodes[0], self.nodes)
+        self.wait(prefetcher)
+        # Frames prefetched before the pixel mask changed are read again
+        pypix.pixel_mask.set_pixels([(0, 0)])
+        prefetcher.select(self.nodes[1], self.nodes)
+        self.assertEqual(prefetcher.stats["misses"], 2)
+        self.assertEqual(self.nodes[1].reads, 2)
+        self.assertTrue(self.nodes[1].is_read)
+        # And queued frames aren't skipped as already read
+        self.wait(prefetcher)
+        self.assertEqual(self.nodes[2].reads, 1)
+        self.assertEqual(list(prefetcher._frames), ["frame2"])
+        self.assertEqual(prefetcher._frames["frame2"][0], pypix.load_version())
+
+def hits(frame):
+    return dict((pixel, hit.value) for pixel, hit in frame.items())
+
+class TestArchive(unittest.TestCase):
+    """
+    Tests a zip archive of a tree of frames against the extracted tree.
+    """
+    archive_name = "frames.zip"
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.tree = os.path.join(self.directory, "tree")
+        # The members of the archive, in the order they are stored
+        self.members = ["run2/c.lsc", "run1/b.lsc", "d.lsc", "run1/a.lsc", "notes.txt"]
+        for i, member in enumerate(self.members):
+            write_frames(os.path.join(self.tree, os.path.dirname(member)),
+                         [os.path.basename(member)], seed=i)
+        self.path = os.path.join(self.directory, self.archive_name)
+        self.write_archive()
+        self.index = archive.ArchiveIndex(self.path, "*.lsc")
+
+    def tearDown(self):
+        self.index.archive.close()
+        shutil.rmtree(self.directory)
+        timing.enable(False)
+        timing.reset()
+
+    def write_archive(self):
+        with zipfile.ZipFile(self.path, "w", zipfile.ZIP_DEFLATED) as f:
+            for member in self.members:
+                f.write(os.path.join(self.tree, member), member)
+
+    def test_listing(self):
+        # Test 6.1
+        archive_ = archive.Archive.open(self.path)
+        self.assertIs(archive.Archive.open(self.path), archive_)
+        self.assertEqual(list(archive_.members), self.members)
+        self.assertEqual([size for size, mtime, info in archive_.members.values()],
+                         [os.stat(os.path.join(self.tree, member)).st_size
+                          for member in self.members])
+        self.assertEqual(archive_.folders[""][0], set(["run1", "run2"]))
+        self.assertEqual([entry[0] for entry in archive_.folders["run1"][1]], ["b.lsc", "a.lsc"])
+        # The archive is listed again once it changes
+        self.members.remove("d.lsc")
+        self.write_archive()
+        set_mtime(self.path, archive_.mtime + 10)
+        self.assertNotIn("d.lsc", archive.Archive.open(self.path).members)
+
+    def test_folder(self):
+        # Test 6.2
+        def names(entries):
+            return [entry[0] for entry in entries]
+        listing = self.index.folder(self.path)
+        self.assertEqual(listing["folders"], ["run1", "run2"])
+        self.assertEqual(names(listing["files"]), ["d.lsc"])
+        self.assertEqual(listing["mtime"], os.stat(self.path).st_mtime)
+        listing = self.index.folder(os.path.join(self.path, "run1"))
+        self.assertEqual((listing["folders"], names(listing["files"])), ([], ["a.lsc", "b.lsc"]))
+        self.assertEqual(self.index.folder(os.path.join(self.path, "missing"))["files"], [])
+
+    def test_read(self):
+        # Test 6.3
+        for member in ["run1/a.lsc", "run2/c.lsc", "run1/b.lsc", "d.lsc", "run1/a.lsc"]:
+            frame = self.index.read_frame(os.path.join(self.path, member), "lsc")
+            self.assertEqual(hits(frame), hits(pypix.Frame.from_file(os.path.join(self.tree, member))))
+
+    def test_frames(self):
+        # Test 6.4
+        # Count the opens of a tar file after it has been listed
+        self.index.archive.close()
+        reads = []
+        previous = archive._open_tar
+        def open_tar(path, stream=False):
+            reads.append(stream)
+            return previous(path, stream)
+        archive._open_tar = open_tar
+        try:
+            frames = list(self.index.frames(self.path, "lsc"))
+            run1 = list(self.index.frames(os.path.join(self.path, "run1"), "lsc"))
+        finally:
+            archive._open_tar = previous
+        # The frames are read in the order they are stored, each tar file in
+        # one pass over a stream
+        def tree_hits(members):
+            return [hits(pypix.Frame.from_file(os.path.join(self.tree, member)))
+                    for member in members]
+        self.assertEqual([hits(frame) for frame in frames],
+                         tree_hits([member for member in self.members if member.endswith(".lsc")]))
+        self.assertEqual([hits(frame) for frame in run1], tree_hits(["run1/b.lsc", "run1/a.lsc"]))
+        self.assertEqual(reads, [] if self.index.archive.is_zip else [True, True])
+
+    def test_aggregate(self):
+        # Test 6.5
+        node = folder.FolderNode(self.directory)
+        node.get_children("*.lsc")
+        tree_node, archive_node = node.sub_folders
+        self.assertEqual((archive_node.path, tree_node.path), (self.path, self.tree))
+        timing.enable()
+        aggregate = archive_node.calculate_aggregate("*.lsc")
+        expected = tree_node.calculate_aggregate("*.lsc")
+        self.assertEqual(hits(aggregate), hits(expected))
+        self.assertEqual(len(aggregate.clusters), len(expected.clusters))
+        self.assertEqual(aggregate.pixel_statistics.frames, 4)
+        # The aggregate is reused until the archive changes
+        archive_node.calculate_aggregate("*.lsc")
+        self.assertEqual(timing.report()["counters"]["aggregates reused"], 1)
+        sub_folder = archive_node.get_children("*.lsc")[0][0]
+        self.assertEqual(hits(sub_folder.calculate_aggregate("*.lsc")),
+                         hits(tree_node.get_children("*.lsc")[0][0].calculate_aggregate("*.lsc")))
+
+class TestTarArchive(TestArchive):
+    """
+    Tests a gzip compressed tar archive, as TestArchive.
+    """
+    archive_name = "frames.tar.gz"
+
+    def write_archive(self):
+        with tarfile.open(self.path, "w:gz") as f:
+            for member in self.members:
+                f.add(os.path.join(self.tree, member), member)
+
+# Run the tests
+if __name__ == "__main__":
+    unittest.main(verbosity=2)